@@ -2,16 +2,192 @@
 from __future__ import unicode_literals
 
 import copy
-from collections import defaultdict
+import csv
+import functools
+import heapq
+import itertools
+from collections import defaultdict,namedtuple,OrderedDict
+import gc
+import io
+import json
+import multiprocessing
+import operator
+import os
+import re
+import string
+import struct
+import sys
+import threading
 import time
 import types
+import zlib
+from bisect import bisect_left,bisect_right,insort
+
+try:
+    import cPickle as pickle # Python 2
+except ImportError:
+    import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if sys.version_info[0] >= 3:
+    _STRING_TYPES = (str,)
+    _chr = chr
+else:
+    _STRING_TYPES = (basestring,)
+    _chr = unichr
+
+try:
+    from threading import get_ident as _get_ident
+except ImportError: # Python 2
+    from thread import get_ident as _get_ident
+
+# The indices of the items matching a value are stored as the keys of an 
+# insertion ordered dict (values are None). This gives O(1) removal while
+# keeping a deterministic order
+if sys.version_info >= (3,7):
+    _posting = dict
+else:
+    _posting = OrderedDict
+
+_CHUNK_BITS = 12 # Bitmap chunks are 4096 bits
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+_CacheInfo = namedtuple('CacheInfo',['hits','misses','maxsize','currsize'])
+
+# Inline flags that make a pattern case-insensitive or verbose
+_INLINE_FLAGS = re.compile(r'\(\?[aiLmsux]*[ix][aiLmsux]*\)')
+# A repetition. Any other '{' is a literal
+_QUANTIFIER = re.compile(r'\{\d*(,\d*)?\}')
+
+_SNAPSHOT_MAGIC = b'LDDBSNP1' # Includes the format version
+_SNAPSHOT_SKIP = {'_cache','_cache_hits','_cache_misses','_time','_multi', # Not saved
+                  '_journal','_journal_path','_journal_synced','_lock',
+                  '_cache_lock'}
+
+class _RWLock(object):
+    """
+    Reentrant readers-writer lock that prefers writers. Any number of 
+    threads may read at once. A writer waits for the readers to finish and
+    new readers wait for waiting writers (so they are not starved).
+    
+    A thread may read or write again while it holds either but can not 
+    start writing while it is reading (it would wait on itself)
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0 # Threads reading
+        self._writer = None # Thread writing
+        self._writes = 0 # Depth of the writer
+        self._waiting = 0 # Writers waiting
+        self._local = threading.local() # Read depth of each thread
+    
+    def acquire_read(self):
+        local = self._local
+        depth = getattr(local,'depth',0)
+        if depth > 0 or self._writer == _get_ident(): # Already has it
+            local.depth = depth + 1
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting > 0:
+                self._cond.wait()
+            self._readers += 1
+        local.depth = 1
+        local.counted = True
+    
+    def release_read(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0 and getattr(local,'counted',False):
+            local.counted = False
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+    
+    def acquire_write(self):
+        me = _get_ident()
+        if self._writer == me:
+            self._writes += 1
+            return
+        if getattr(self._local,'depth',0) > 0:
+            raise RuntimeError('Cannot change the DB while reading it (e.g. in a filter)')
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers > 0:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+    
+    def release_write(self):
+        self._writes -= 1
+        if self._writes == 0:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+class _NoLock(object):
+    """
+    Does nothing as a context manager
+    """
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        return False
+
+_NOLOCK = _NoLock()
+
+def _reader(method):
+    """
+    Decorate a method that reads the DB to hold the read lock (if threadsafe)
+    """
+    @functools.wraps(method)
+    def locked(self,*A,**K):
+        lock = self._lock
+        if lock is None:
+            return method(self,*A,**K)
+        lock.acquire_read()
+        try:
+            return method(self,*A,**K)
+        finally:
+            lock.release_read()
+    return locked
+
+def _writer(method):
+    """
+    Decorate a method that changes the DB to hold the write lock (if 
+    threadsafe)
+    """
+    @functools.wraps(method)
+    def locked(self,*A,**K):
+        lock = self._lock
+        if lock is None:
+            return method(self,*A,**K)
+        lock.acquire_write()
+        try:
+            return method(self,*A,**K)
+        finally:
+            lock.release_write()
+    return locked
 
 class list_dict_DB(object):
 
     def __init__(self,items=None,attributes=None,default_attribute=None,  \
                     exclude_attributes=None,                              \
                     allowMultipleEdit=False,alwaysReturnList=True,        \
-                    indexObjects=False):
+                    indexObjects=False,sorted_attributes=None,            \
+                    autoVacuum=None,cacheSize=0,bitmap_attributes=None,   \
+                    column_attributes=None,journalSync='batch',           \
+                    journalInterval=1.0,threadsafe=False,              \
+                    indexProcesses=None,composite_indexes=None,        \
+                    trigram_attributes=None,expression_indexes=None,   \
+                    unique_attributes=None):
         """
         Create a multi-item DB from a list of dictionaries that may be
         queried by any specified attribute.
@@ -63,6 +239,81 @@ class list_dict_DB(object):
             Note 
                 * Changing to False after adding an object will cause issues.
                 * Does not support __slots__ since they are immutable
+        
+        cacheSize: [0] (int)
+            If set, the results of up to this many equality queries 
+            (attrib=val and/or dicts, not Qobjs) are cached until the DB is
+            next modified. See cache_info()
+        
+        autoVacuum: [None] (float, None)
+            If set, will call vacuum() after remove() once the fraction of
+            deleted entries exceeds this. Note that vacuum() renumbers the
+            item indices
+        
+        sorted_attributes [ *empty* ] (list)
+            Attributes to also keep in a sorted index. Range queries
+            (`<`, `<=`, `>`, `>=` and `between`) on these are O(log N + k)
+            instead of O(N). See add_sorted_index()
+        
+        bitmap_attributes [ *empty* ] (list)
+            Attributes to index with compressed bitmaps rather than a 
+            collection of indices per value. Best for dense, low-cardinality
+            attributes (flags, statuses, etc) where it uses much less memory
+            and the boolean query logic runs a machine word at a time. See 
+            add_bitmap_index()
+        
+        column_attributes [ *empty* ] (list)
+            Numeric attributes to also store in a NumPy array. Range queries
+            and vectorized filters (Qobj.vfilter) on these run in NumPy and 
+            DB.column() returns the values for aggregation. Requires NumPy. 
+            See add_column_index()
+        
+        journalSync ['batch'] ('always','batch','never')
+            How often an open journal (see open_journal()) is fsync'ed. 
+            'always' syncs every change, 'batch' syncs at most every 
+            `journalInterval` seconds (group commit) and 'never' leaves it
+            to the OS. Records are always flushed to the OS
+        
+        journalInterval [1.0] (float)
+            Seconds between syncs with journalSync='batch'
+        
+        indexProcesses [None] (int, None)
+            If set (to more than 1), reindex() and add_attribute() build the
+            lookups in this many forked processes (groups of attributes 
+            and/or ranges of items) which are then merged. Only worth it for
+            large DBs since starting the processes and returning the lookups
+            has a cost. Ignored where processes cannot be forked (Windows)
+            and for fewer than 10,000 items
+        
+        composite_indexes [ *empty* ] (list of tuples)
+            Groups of attributes to also index together, e.g. 
+            [('tenant','sku')]. A query with equalities on all of them is
+            then a single lookup rather than an intersection. See 
+            add_composite_index()
+        
+        trigram_attributes [ *empty* ] (list)
+            String attributes to also index by their 3 character substrings
+            (trigrams). Substring and regex queries (Qobj.contains and 
+            Qobj.matches) then only check the values that have all of the
+            trigrams of the query rather than every item. See 
+            add_trigram_index()
+        
+        expression_indexes [ *empty* ] (dict)
+            Indices of values computed from each item, {name: key function}, 
+            e.g. {'email_lc': lambda item: item['email'].lower()}. They are 
+            queried by name like attributes. See add_index()
+        
+        unique_attributes [ *empty* ] (list)
+            Attributes (or expression indices) whose values must be unique.
+            Adding or updating an item to a value another item has raises
+            a ValueError and get() is a single lookup. See 
+            add_unique_index()
+        
+        threadsafe [False] (bool)
+            If True, the DB may be shared between threads. Queries (and 
+            other reads) run in parallel while changes wait for them and run
+            one at a time (a readers-writer lock that prefers writers). 
+            Cannot be changed later. See Notes below
             
 
         Additional Opperations:
@@ -83,6 +334,15 @@ class list_dict_DB(object):
             
             * There is also an attribute called `_index` which can be used to
               query by index.
+        
+        Notes:
+        ------
+            * In threadsafe mode, iquery() finds all of the matches before
+              iterating and a change made while reading (e.g. in a filter) 
+              raises a RuntimeError. Qobjs do not expire when the DB changes
+              unless they include indices (Qobj(DB,ixs=...)). Iterating the DB (iteritems() or 
+              `for item in DB`) is not locked: changes made while iterating 
+              may or may not be seen. Changing items directly is never safe
 
         """
         
@@ -96,6 +356,13 @@ class list_dict_DB(object):
         self.allowMultipleEdit = allowMultipleEdit
         self.alwaysReturnList = alwaysReturnList        
         self.indexObjects = indexObjects
+        self.autoVacuum = autoVacuum
+        self.cacheSize = cacheSize
+        self.journalSync = journalSync
+        self.journalInterval = journalInterval
+        self.threadsafe = threadsafe
+        self.indexProcesses = indexProcesses
+        self._init_locks()
 
 
         self.attributes = attributes # Will be reset in first add        
@@ -108,26 +375,62 @@ class list_dict_DB(object):
 
         self._empty = _emptyList()
         self._ix = set()
+        
+        self._cache = OrderedDict() # LRU of query key: ixs
+        self._cache_hits = self._cache_misses = 0
+        self._time = 0 # Number of modifications. Expires Qobjs and iterators
+        self._multi = {} # attribute: (DB time,whether multivalued). See _multivalued()
+        
+        self._journal = None # Open file. See open_journal()
+        self._journal_path = None
+        self._journal_seq = 0 # Sequence number of the last change
+        self._journal_synced = 0
+        
+        self._sorted = {} # attribute: sorted list of the distinct values
+        for attribute in (sorted_attributes or []):
+            self.add_sorted_index(attribute)
+        
+        self._bitmaps = set()
+        for attribute in (bitmap_attributes or []):
+            self.add_bitmap_index(attribute)
+        
+        self._columns = {} # attribute: _Column
+        for attribute in (column_attributes or []):
+            self.add_column_index(attribute)
+        
+        self._composite = {} # (attributes): lookup of (values): indices
+        for attributes in (composite_indexes or []):
+            self.add_composite_index(*attributes)
+        
+        self._trigrams = {} # attribute: trigram: set of the distinct values
+        for attribute in (trigram_attributes or []):
+            self.add_trigram_index(attribute)
+        
+        self._expressions = {} # name: key function. Indexed in _lookup[name]
+        for name,key in (expression_indexes or {}).items():
+            self.add_index(name,key)
+        
+        self._unique = {} # attribute: value: index
+        for attribute in (unique_attributes or []):
+            self.add_unique_index(attribute)
 
         # Add the items
-        for item in items:
-            self.add(item)
-        
-        self._i = 0 # Counter for iterator if not called with iteritems
+        self.add_items(items)
         
-        self._time = time.time()
+        self._i = 0 # Counter for next(DB). Iterating the DB does not use it
     
         # Edge case: No items
         if self.attributes is None:
             self.attributes = []
         
+    @_writer
     def add(self,item):
         """
-        Add an item or items to the DB
+        Add an item or items to the DB. Lists, tuples and generators of items
+        are passed to add_items()
         """
         if isinstance(item,(list,tuple,types.GeneratorType)):
-            for it in item:
-                self.add(it)
+            self.add_items(item)
             return
         
         # handle other object types
@@ -135,41 +438,218 @@ class list_dict_DB(object):
         item = self._convert2dict(item)
         
         if self.N == 0:
-            attributes = self.attributes
-            if attributes is None:
-                attributes = list(item.keys())
-
-            self.attributes = [attrib for attrib in attributes \
-                                if attrib not in self.exclude_attributes] # Make a copy
-            
-
-            # Set up the lookup
-            self._lookup = {attribute:defaultdict(list) for attribute in self.attributes}
+            self._init_lookup(item)
         
         ix = len(self._list) # The length will be 1+ the last ix so do not change this
 
-        if self._is_attr_None: # Set to None which means we add all
-            for attrib in item.keys():
-                if attrib in self.exclude_attributes:
-                    continue
-                if attrib not in self.attributes:
-                    self.add_attribute(attrib,self.default_attribute)
-        # Add built in ones
+        added = [] # (attribute,filled) of new attributes. Undone if it raises
+        try:
+            if self._is_attr_None: # Set to None which means we add all
+                for attrib in item.keys():
+                    if attrib in self.exclude_attributes:
+                        continue
+                    if attrib not in self.attributes:
+                        added.append((attrib,self._add_attribute(attrib,self.default_attribute)))
+            # Add built in ones
+            for attrib in self.attributes:
+                if attrib not in item:
+                    if hasattr(self.default_attribute, '__call__'):
+                        item[attrib] = self.default_attribute()
+                    else:
+                        item[attrib] = self.default_attribute
+            
+            # Before changing anything else in case a key raises
+            expressions = self._expression_values(item)
+            if len(self._unique) > 0:
+                self._check_unique(item,expressions)
+            for attrib,column in self._columns.items():
+                column.check(item.get(attrib))
+        except Exception:
+            for attrib,filled in reversed(added):
+                self._drop_attribute(attrib,filled)
+            raise
+        
         for attrib in self.attributes:
-            if attrib not in item:
-                if hasattr(self.default_attribute, '__call__'):
-                    item[attrib] = self.default_attribute()
-                else:
-                    item[attrib] = self.default_attribute
-                    
-            value = item[attrib]
-            self._append(attrib,value,ix)
+            self._append(attrib,item[attrib],ix)
+        for name,value in expressions:
+            self._append(name,value,ix)
+        
+        for attributes,lookup in self._composites():
+            for key in self._composite_keys(item,attributes):
+                lookup[key][ix] = None
 
         # Finally add it
         self._list.append(item0)
         self.N += 1
         self._ix.add(ix)
-
+        self._log('add',[item0])
+    
+    @_writer
+    def add_items(self,items):
+        """
+        Add many items to the DB. 
+        
+        This is the same as calling add() on each item but the lookups are 
+        built directly in one pass and the DB is only marked as modified once
+        for the whole batch. It is used by the constructor and by add() when 
+        given a list, tuple or generator.
+        
+        Each item is checked before it is added. If one raises (e.g. a
+        duplicate of a unique index), the items before it stay added. If the
+        new values of a sorted attribute can not be compared with the others
+        (e.g. None and numbers), none of the batch is added.
+        """
+        added = [] # Journaled at the end
+        try:
+            self._add_items(_flatten(items),added)
+        finally:
+            if len(added) > 0:
+                self._modified()
+                self._log('add',added)
+    
+    def _add_items(self,items,added):
+        """
+        Add the items (see add_items()) and append them to `added` as they 
+        are added
+        """
+        exclude = set(self.exclude_attributes)
+        known = set(self.attributes or [])
+        
+        default = self.default_attribute
+        call_default = hasattr(default, '__call__')
+        
+        # New values of sorted (and trigram) attributes. Merged in at the 
+        # end rather than inserted one at a time
+        new_sorted = {attrib:[] for attrib in itertools.chain(self._sorted,self._trigrams)}
+        
+        targets = None # (attrib,lookup,new sorted values,column). Reset when they change
+        empty = self._empty
+        
+        try:
+            for item0 in items:
+                item = self._convert2dict(item0)
+            
+                if self.N == 0:
+                    self._init_lookup(item)
+                    known = set(self.attributes)
+                    targets = None
+            
+                ix = len(self._list)
+            
+                if self._is_attr_None: # Set to None which means we add all
+                    for attrib in item.keys():
+                        if attrib in known or attrib in exclude:
+                            continue
+                        self._add_attribute(attrib,default)
+                        known.add(attrib)
+                        targets = None
+            
+                if targets is None:
+                    targets = [(attrib,self._lookup[attrib],new_sorted.get(attrib),
+                                self._columns.get(attrib)) for attrib in self.attributes]
+                    composites = self._composites()
+                    expressions = [(self._lookup[name],new_sorted.get(name),key) \
+                                    for name,key in self._expressions.items()]
+                    names = list(self._expressions)
+                    columns = [column for _,_,_,column in targets if column is not None]
+                    uniques = [(attrib,unique,names.index(attrib) if attrib in names else None) \
+                                    for attrib,unique in self._unique.items() if attrib in self._lookup]
+                
+                # Before changing anything in case a key raises or a value is
+                # not unique
+                if len(expressions) > 0 or len(columns) > 0:
+                    for attrib,_,_,_ in targets:
+                        if attrib not in item:
+                            item[attrib] = default() if call_default else default
+                    values = [key(item) for _,_,key in expressions]
+                    for column in columns:
+                        column.check(item[column.attribute])
+                
+                for attrib,unique,pos in uniques:
+                    if pos is not None:
+                        value = values[pos]
+                    elif attrib in item:
+                        value = item[attrib]
+                    else:
+                        value = item[attrib] = default() if call_default else default
+                    for val in (value if isinstance(value,list) else [value]):
+                        if val in unique: # None is never in it
+                            raise ValueError("Duplicate value {0!r} of the unique attribute '{1}'".format(val,attrib))
+            
+                for attrib,lookup,new,column in targets:
+                    try:
+                        value = item[attrib]
+                    except KeyError:
+                        value = item[attrib] = default() if call_default else default
+                
+                    if column is not None:
+                        column.set(ix,value)
+                
+                    if not isinstance(value,list):
+                        value = [value]
+                    elif len(value) == 0:
+                        lookup[empty][ix] = None # empty list
+                        continue
+                
+                    for val in value:
+                        ixs = lookup[val]
+                        if new is not None and len(ixs) == 0:
+                            new.append(val)
+                        ixs[ix] = None
+                
+                if len(expressions) > 0:
+                    for (lookup,new,_),value in zip(expressions,values):
+                        _index_value(lookup,value,ix,empty,new)
+                
+                for attrib,unique,pos in uniques:
+                    value = item[attrib] if pos is None else values[pos]
+                    for val in (value if isinstance(value,list) else [value]):
+                        if val is not None:
+                            unique[val] = ix
+                
+                for attributes,lookup in composites:
+                    for key in self._composite_keys(item,attributes):
+                        lookup[key][ix] = None
+            
+                self._list.append(item0)
+                self.N += 1
+                self._ix.add(ix)
+                added.append(item0)
+        finally:
+            # Merged into new lists first since the values may not compare 
+            # (e.g. None and numbers). Then none of the batch is kept
+            merged = {}
+            try:
+                for attrib,new in new_sorted.items():
+                    if len(new) > 0 and attrib in self._sorted:
+                        merged[attrib] = sorted(itertools.chain(self._sorted[attrib],new))
+            except TypeError:
+                self._undo_add_items(len(added),new_sorted)
+                del added[:]
+                raise
+            self._sorted.update(merged)
+            
+            for attrib,new in new_sorted.items():
+                if len(new) > 0 and attrib in self._trigrams:
+                    index = self._trigrams[attrib]
+                    for val in new:
+                        _index_trigrams(index,val)
+    
+    def _undo_add_items(self,n,attributes):
+        """
+        Remove the last n items added by _add_items(). Their new values of 
+        the sorted and trigram `attributes` are not in those indices yet
+        """
+        sorted_values,trigrams = self._sorted,self._trigrams
+        self._sorted = {attr:keys for attr,keys in sorted_values.items() if attr not in attributes}
+        self._trigrams = {attr:index for attr,index in trigrams.items() if attr not in attributes}
+        try:
+            self._remove_ixs(range(len(self._list) - n,len(self._list)))
+            del self._list[len(self._list) - n:]
+        finally:
+            self._sorted,self._trigrams = sorted_values,trigrams
+    
+    @_reader
     def query(self,*A,**K):
         """
         Query the value for attribute. Will always return a
@@ -197,9 +677,35 @@ class list_dict_DB(object):
         >>> DB.query(DQ.attrib == val)            
         >>> DB.query( (Q.attrib1 == val1) &  (Q.attrib1 == val2) )  # Parentheses are important!
         >>> DB.query( (Q.attrib1 == val1) &  (Q.attrib1 != val2))
+        
+        Options: 
+        
+        limit, offset: Return at most `limit` matches after skipping the 
+                       first `offset`. Only the matches needed are found (see
+                       iquery()). 
+        
+        order_by: Attribute (or list of them) to order the matches by. Prefix
+                  with '-' for descending. If the (first) attribute has a 
+                  sorted index, it is walked in order until there are enough
+                  matches. Otherwise, the first `limit` are selected from the
+                  matches with a heap (O(k log limit) rather than sorting).
+                  Lists are ordered by their smallest element (largest if 
+                  descending) and empty lists and None are last.
+        
+        If any option is also an attribute, query it with a dictionary instead
+                       
+        >>> DB.query(attrib=val,limit=10)
+        >>> DB.query(account=X,order_by='-time',limit=20) # Latest 20
                                    
         """
-        ixs = self._ixs(*A,**K)
+        limit,offset,order_by = self._options(K,'limit','offset','order_by')
+        if order_by is not None:
+            count = None if limit is None else (offset or 0) + limit
+            ixs = self._ordered_ixs(order_by,A,K,count)[offset:]
+        elif limit is None and offset is None:
+            ixs = self._ixs(*A,**K)
+        else:
+            ixs = list(_islice(self._iter_ixs(*A,**K),offset,limit))
 
         if len(ixs) == 1 and not self.alwaysReturnList:
             return self._list[ixs[0]]
@@ -207,15 +713,128 @@ class list_dict_DB(object):
             return [self._list[ix] for ix in ixs]
         
 
+    @_reader
+    def iquery(self,*A,**K):
+        """
+        Same as query() but returns a generator of the matching items. Only
+        the matches needed are found so, for example, the first 10 matches 
+        of a common value do not require finding all of them.
+        
+        Also accepts the `limit`, `offset` and `order_by` options (see 
+        query()). Ordered results are found before iterating.
+        
+        >>> for item in DB.iquery(attrib=val,limit=10):
+        ...     pass
+        
+        Note that the DB may not be modified while iterating
+        """
+        limit,offset,order_by = self._options(K,'limit','offset','order_by')
+        if order_by is not None:
+            count = None if limit is None else (offset or 0) + limit
+            ixs = iter(self._ordered_ixs(order_by,A,K,count)[offset:])
+        else:
+            ixs = _islice(self._iter_ixs(*A,**K),offset,limit)
+        if self._lock is not None: # Can't hold the lock while iterating
+            return iter([self._list[ix] for ix in ixs])
+        return (self._list[ix] for ix in ixs)
+    
+    @_reader
     def isin(self,*A,**K):
         """
         Check if there is at least one item that matches the given query
         
+        see query() for usage. Same as exists()
+        """
+        return self.exists(*A,**K)
+    
+    @_reader
+    def exists(self,*A,**K):
+        """
+        Check if there is at least one item that matches the given query 
+        without finding all of the matches. The smallest posting list is 
+        iterated and it stops at the first match
+        
         see query() for usage
         """
+        for _ in self._iter_ixs(*A,**K):
+            return True
+        return False
+    
+    @_reader
+    def count(self,*A,**K):
+        """
+        Return the number of items that match the given query without 
+        building the list of them. 
+        
+        A single equality is O(1) and equalities that are and-ed together 
+        are counted by iterating the smallest posting list. Other conditions
+        (Qobjs) still need to be evaluated
+        
+        see query() for usage
+        """
+        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
+            return 0
+        
+        postings,conditions,cache_key = self._parse(A,K)
+        
+        ixs = self._cached(cache_key) if cache_key is not None else None
+        if ixs is not None:
+            return len(ixs)
+        
+        postings,tests = self._split(conditions,postings)
+        if len(tests) > 0:
+            ixs = self._match(tests,postings)
+            return len(ixs) if ixs is not None else 0
+        
+        if len(postings) == 0: # Ensure one match
+            return 0
+        if len(postings) == 1:
+            return len(postings[0])
+        if all(isinstance(ixs,_Bitmap) for ixs in postings):
+            return len(_intersect(postings))
+        
+        postings.sort(key=len)
+        first,rest = postings[0],postings[1:]
+        return sum(1 for ix in first if all(ix in ixs for ixs in rest))
 
-        return len(self._ixs(*A,**K))>0
-
+    @_reader
+    def get(self,*A,**K):
+        """
+        Return the one item that matches the query. With a single equality 
+        on an attribute with a unique index (see add_unique_index()), this 
+        is one lookup. Other queries (see query()) are found with query()
+        
+        Usage
+        -----
+        >>> DB.get(id=5)
+        >>> DB.get(id=5,default=None) # Rather than a KeyError
+        >>> DB.get({'first':'John','last':'Lennon'})
+        
+        Raises a KeyError if nothing matches (unless `default` is given and
+        is not an attribute) and a ValueError if more than one item does
+        """
+        has_default = 'default' in K and 'default' not in self._names()
+        default = K.pop('default',None) if has_default else None
+        
+        ixs = None
+        if len(A) == 0 and len(K) == 1:
+            (attrib,value), = K.items()
+            unique = self._unique.get(attrib)
+            if unique is not None and value is not None and not isinstance(value,list):
+                ix = unique.get(value)
+                ixs = [] if ix is None else [ix]
+        if ixs is None:
+            ixs = self._ixs(*A,**K)
+        
+        if len(ixs) == 1:
+            return self._list[ixs[0]]
+        if len(ixs) > 1:
+            raise ValueError('Query matched {0} items'.format(len(ixs)))
+        if has_default:
+            return default
+        raise KeyError('No matching item')
+    
+    @_writer
     def reindex(self,*args):
         """
         Reindex the dictionary for specified attributes (or all)
@@ -226,6 +845,7 @@ class list_dict_DB(object):
         >>> DB.reindex()                # All
         >>> DB.reindex('attrib')        # Reindex 'attrib'
         >>> DB.reindex('attrib1','attrib2') # Multiple
+        >>> DB.reindex('email_lc')      # An expression index (see add_index())
         
         See Also
         --------
@@ -237,21 +857,47 @@ class list_dict_DB(object):
             # Just an extra check (and makes a copy)
             attributes = [attr for attr in attributes \
                         if attr not in self.exclude_attributes]
+            attributes.extend(self._expressions)
         else:
             attributes = args
             if any(a in self.exclude_attributes for a in args):
                 raise ValueError('Cannot reindex an excluded attribute') 
+        if not hasattr(self,'_lookup'): # Nothing was added yet
+            return
 
+        # Build the lookups and check that the values of unique indices still
+        # are before changing anything
+        lookups = self._build_lookups(attributes)
+        uniques = {attr:_unique_index(attr,lookups[attr].items(),self._empty) \
+                        for attr in attributes if attr in self._unique}
+        
         for attribute in attributes:
-            self._lookup[attribute] = defaultdict(list) # Reset
+            if attribute in self._columns:
+                self._columns[attribute].clear()
         
-        for ix,item in enumerate(self._list):
-            if item is None: continue
-            item = self._convert2dict(item)
-            for attrib in attributes:
-                value = item[attrib]
-                self._append(attrib,value,ix)
+        # Sorted and trigram indices are faster to build once at the end
+        resort = [attr for attr in attributes if attr in self._sorted]
+        for attribute in resort:
+            del self._sorted[attribute]
+        regram = [attr for attr in attributes if attr in self._trigrams]
+        for attribute in regram:
+            self._trigrams[attribute] = defaultdict(set)
+        
+        try:
+            self._lookup.update(lookups)
+            self._unique.update(uniques)
+            self._fill_columns(attributes)
+            for composite in list(self._composite):
+                if any(attr in attributes for attr in composite):
+                    self._build_composite(composite)
+            self._modified()
+        finally:
+            for attribute in resort:
+                self._build_sorted(attribute)
+            for attribute in regram:
+                self._build_trigrams(attribute)
     
+    @_writer
     def update(self,*args,**queryKWs):
         """
         Update an entry without needing to reindex the DB (or a specific 
@@ -286,12 +932,10 @@ class list_dict_DB(object):
     
         Notes:
         ------
-            * Updating an item requires a deletion in a list that has length n 
-              equal to the number of items matching an attribute. This is O(n).
-              However changing the entry directly and reindexing is O(N) where
-              N is the size of the DB. If many items are changing and you do not
-              need to query them in between, it *may* be faster to directly
-              update the item and reindex
+            * Updating an item is O(1) per updated attribute (per matching 
+              item) while changing the entry directly and reindexing is O(N) 
+              where N is the size of the DB. Prefer update() unless a large
+              fraction of the DB is changing
         """
         
         if len(args) == 1:
@@ -321,11 +965,37 @@ class list_dict_DB(object):
         if len(ixs)>1 and not self.allowMultipleEdit:
             raise ValueError("Query returned multiple results. Set 'allowMultipleEdit' or change query")
         
+        self._update(ixs,updated_dict)
+        self._log('update',list(ixs),updated_dict)
+    
+    def _update(self,ixs,updated_dict):
+        """
+        Update the items at ixs with updated_dict
+        """
+        if len(self._unique) > 0:
+            self._check_unique_update(ixs,updated_dict)
+        for attrib,value in updated_dict.items():
+            if attrib in self._columns:
+                self._columns[attrib].check(value)
+        
+        composites = [(attributes,lookup) for attributes,lookup in self._composites() \
+                        if any(attrib in updated_dict for attrib in attributes)]
         for ix in ixs:
             # Get original item
             item = self._list[ix]
             item = self._convert2dict(item)
             
+            # The expressions may depend on anything. Before changing anything
+            # in case a key raises
+            expressions = []
+            if len(self._expressions) > 0:
+                new_item = dict(item)
+                new_item.update(updated_dict)
+                expressions = list(zip(self._expression_values(item),
+                                       self._expression_values(new_item)))
+            
+            self._unindex_composites(item,ix,composites)
+            
             # Allow the update to also include non DB attributes.
             # The intersection will eliminate any exclude_attributes
             attributes = set(updated_dict.keys()).intersection(self.attributes)
@@ -343,13 +1013,18 @@ class list_dict_DB(object):
                 # Add ix to any new value
                 self._append(attrib,value,ix)
                 
+            for (name,old),(_,new) in expressions:
+                if old != new:
+                    self._remove(name,old,ix)
+                    self._append(name,new,ix)
+            
             # Update the item
             item.update(updated_dict)
-        
-        return
-        
-        
-        
+            for attributes,lookup in composites:
+                for key in self._composite_keys(item,attributes):
+                    lookup[key][ix] = None
+    
+    @_writer
     def add_attribute(self,attribute,*default):
         """
         Add an attribute to the index attributes.
@@ -364,120 +1039,946 @@ class list_dict_DB(object):
         If the `default` is callable, it will call it instead. (such as `list`
         to add an empty list)
         
+        """
+        filled = self._add_attribute(attribute,*default)
+        self._log('add_attribute',attribute,filled)
+    
+    def _add_attribute(self,attribute,*default):
+        """
+        Add the attribute. Returns the (ix,value) of the items that were set
+        to the default
         """
         if attribute in self.exclude_attributes:
             raise ValueError("Can't add exclude_attributes")
+        if attribute in self._expressions:
+            raise ValueError("'{:s}' is the name of an expression index".format(attribute))
         
         attrib = attribute
         if not hasattr(self,'_lookup'):
             self._lookup = {}
-        self._lookup[attribute] = defaultdict(list)
+        self._lookup[attribute] = self._new_lookup(attribute)
+        if attribute in self._columns:
+            self._columns[attribute].clear()
+        resort = self._sorted.pop(attribute,None) is not None
+        regram = self._trigrams.pop(attribute,None) is not None
 
         set_default = False
         if len(default) >0:
             set_default = True
             default = default[0]
-
+        filled = []
+        
+        # Set any missing values first so that the lookup can be built in 
+        # one go (and in parallel)
         for ix,item in enumerate(self._list):
             if item is None: continue
             item = self._convert2dict(item)
-            try:
-                value = item[attribute]
-                self._append(attrib,value,ix)
-            except KeyError as KE:
-                if set_default:
-                    if hasattr(default, '__call__'):
-                        item[attribute] = default()
-                    else:
-                        item[attribute] = default
-                else:
-                    raise KeyError("Attribute {:s} not found".format(attrib))
-
-                value = item[attribute]
-                self._append(attrib,value,ix)
-
+            if attribute in item: continue
+            if not set_default:
+                raise KeyError("Attribute {:s} not found".format(attrib))
+            if hasattr(default, '__call__'):
+                item[attribute] = default()
+            else:
+                item[attribute] = default
+            filled.append((ix,item[attribute]))
+        
+        self._lookup.update(self._build_lookups([attribute]))
+        self._fill_columns([attribute])
+        self._modified()
+        
+        if resort:
+            self._build_sorted(attribute)
+        if regram:
+            self._build_trigrams(attribute)
         self.attributes.append(attribute)
+        if attribute in self._unique:
+            self._build_unique(attribute)
+        for composite in list(self._composite): # May now be complete
+            if attribute in composite:
+                self._build_composite(composite)
+        return filled
 
-    def remove(self,*A,**K):
+    @_writer
+    def add_sorted_index(self,attribute):
         """
-        Remove item that matches a given attribute or dict. See query() for
-        input specification
-
-
-        DB Options:
-        This is set at instantiation but can be changed directly
-        -----------
+        Keep a sorted index of the distinct values of `attribute`. It is 
+        maintained by all of the methods that modify the DB and makes range
+        queries O(log N + k) (where k is the number of matches) rather than
+        O(N)
         
-        DB.allowMultipleEdit
-                        - If True, this can remove multiple matching items
-
+        Usage
+        -----
+        >>> DB.add_sorted_index('born')
+        >>> Q = DB.Q()
+        >>> DB.query(Q.born >= 1940)
+        >>> DB.query(Q.born.between(1940,1943))
+        
+        Notes:
+        ------
+            * All values of the attribute must be comparable with each other
+              (e.g. do not mix None and numbers in Python 3)
+            * As with equality, list values are expanded so a list matches
+              if *any* of its elements match
         """
-
-        ixs = self._ixs(*A,**K)
-
-        if len(ixs)>1 and not self.allowMultipleEdit:
-            raise ValueError("Query returned multiple results. Set 'allowMultipleEdit' or change query")
-
-        if len(ixs) == 0:
-            raise ValueError('No matching items')
-
-        items = []
-
-        for ix in list(ixs): # Must remove it from everything.
-            # not sure what is happening, but it seems that I need to make a copy
-            # since Python is doing something strange here...
-
-            item = self._list[ix]
-            item = self._convert2dict(item)
-
-            for attrib in self.attributes:
-                value = item[attrib]
-                self._remove(attrib,value,ix)
-                
-            # Remove it from the list by setting to None. Do not reshuffle
-            # the indices. A None check will be performed elsewhere
-            self._list[ix] = None
-            self._ix.difference_update([ix])
-            self.N -= 1
+        if attribute in self.exclude_attributes:
+            raise ValueError("Can't index exclude_attributes")
+        
+        self._build_sorted(attribute)
+        self._log('add_sorted_index',attribute)
     
-    def items(self):
+    def _build_sorted(self,attribute):
         """
-        Return a list of items.
+        (Re)build the sorted index of attribute from its lookup
         """
-        return [a for a in self._list if a is not None]
-
-    def iteritems(self):
+        lookup = getattr(self,'_lookup',{}).get(attribute,{})
+        self._sorted[attribute] = sorted(val for val,ixs in lookup.items() \
+                                        if len(ixs) > 0 and val is not self._empty)
+    
+    @_writer
+    def add_index(self,name,key):
         """
-        Return an iterator over the items.
+        Index the value of key(item) for every item under `name`. It is 
+        queried like an attribute (equality, Qobjs, order_by, value_counts, 
+        etc) and is maintained by all of the methods that modify the DB. 
+        This avoids storing derived values in the items just to index them.
+        
+        Usage
+        -----
+        >>> DB.add_index('email_lc',key=lambda item: item['email'].lower())
+        >>> DB.add_index('day',key=lambda item: item['time'] // 86400)
+        >>> DB.query(email_lc='paul@example.com')
+        >>> DB.add_sorted_index('day') # Other indices work too
+        >>> DB.query(DB.Q().day >= 18000)
+        
+        Notes:
+        ------
+            * key is called with the item as a dict (after any missing 
+              attributes are set to the default) and should only depend on
+              it. It is called again when an item is updated or removed
+            * As with attributes, list values are expanded
+            * Items are not changed. Use add_attribute() to add a value
+            * Key functions that cannot be pickled (e.g. lambdas) are not 
+              saved in snapshots (see load()) and cannot be journaled
+            * Composite and column indices of them are not supported
         """
-        return (a for a in self._list if a is not None)
+        if name in (self.attributes or []) or name in self.exclude_attributes or name == '_index':
+            raise ValueError("'{:s}' is already an attribute".format(name))
+        if not hasattr(key,'__call__'):
+            raise TypeError('key must be callable')
+        if self._journal is not None and not _picklable(key):
+            raise ValueError('The key of an index must be picklable to be journaled')
+        
+        old = self._expressions.get(name)
+        self._expressions[name] = key
+        if hasattr(self,'_lookup'):
+            try:
+                self._lookup.update(self._build_lookups([name]))
+            except:
+                if old is None:
+                    del self._expressions[name]
+                else:
+                    self._expressions[name] = old
+                raise
+            if name in self._sorted:
+                self._build_sorted(name)
+            if name in self._trigrams:
+                self._build_trigrams(name)
+        self._modified()
+        self._log('add_index',name,key)
     
-    def Qobj(self):
+    @_writer
+    def add_unique_index(self,attribute):
         """
-        Query object already loaded with the DB
+        Require the values of `attribute` (or an expression index) to be 
+        unique and map each directly to its item. 
         
-            DB.Qobj() <==> DB.Qobj() <==> Qobj(DB)
+        add() and update() raise a ValueError (before changing anything) if
+        an item would have the same value as another and get() with the 
+        attribute is a single lookup. add_items() raises it when it gets to
+        that item, so the items before it are still added
+        
+        Usage
+        -----
+        >>> DB.add_unique_index('id')
+        >>> DB.get(id=5)
+        >>> DB.add({'id':5}) # ValueError
+        
+        Notes:
+        ------
+            * None values are not indexed so any number of items may have 
+              them (like NULL in SQL)
+            * List values are expanded and each element must be unique. 
+              Empty lists are not indexed
+            * Raises a ValueError if the values are already not unique
         """
-        return Qobj(self) 
+        if attribute in self.exclude_attributes:
+            raise ValueError("Can't index exclude_attributes")
+        
+        self._build_unique(attribute)
+        self._log('add_unique_index',attribute)
     
-    def Q(self):
+    def _build_unique(self,attribute):
         """
-        same as Qobj method
+        (Re)build the unique index of attribute from its lookup. Raises a
+        ValueError (and is not changed) if any value is not unique
         """
-        return Qobj(self)
+        lookup = getattr(self,'_lookup',{}).get(attribute,{})
+        self._unique[attribute] = _unique_index(attribute,lookup.items(),self._empty)
     
-    def _convert2dict(self,obj):
-        """ 
-        Convert objects to a regular dictionary for the sake of indexing
-        
-        Also return Qobjs untouched since they may be used in queries too
-        
-        If it not an Qobj or dict, it will try to get it's __dict__ and if 
-        that doesn't work, will just return it
+    def _check_unique(self,item,expressions=()):
         """
-        if isinstance(obj,Qobj):
-            return obj
-        
+        Raise a ValueError if item (a new item as a dict) has a value of a 
+        unique index that an item already has. The values of expression 
+        indices are given in expressions as (name,value)
+        """
+        expressions = dict(expressions)
+        for attrib,unique in self._unique.items():
+            if attrib in expressions:
+                value = expressions[attrib]
+            elif attrib in self.attributes:
+                value = item[attrib]
+            else:
+                continue
+            for val in _makelist(value):
+                if val in unique: # None is never in it
+                    raise ValueError("Duplicate value {0!r} of the unique attribute '{1}'".format(val,attrib))
+    
+    def _check_unique_update(self,ixs,updated_dict):
+        """
+        Raise a ValueError if updating the items at ixs with updated_dict 
+        would give two items the same value of a unique index. Values may 
+        move between the updated items
+        """
+        attributes = [attrib for attrib in self._unique \
+                        if attrib in updated_dict or attrib in self._expressions]
+        if len(attributes) == 0:
+            return
+        
+        updating = set(ixs)
+        claimed = {attrib:{} for attrib in attributes} # value: ix after the update
+        for ix in ixs:
+            item = dict(self._convert2dict(self._list[ix]))
+            item.update(updated_dict)
+            for attrib in attributes:
+                unique = self._unique[attrib]
+                for val in _makelist(self._value(item,attrib)):
+                    if val is None: continue
+                    if claimed[attrib].setdefault(val,ix) != ix or unique.get(val,ix) not in updating:
+                        raise ValueError("Duplicate value {0!r} of the unique attribute '{1}'".format(val,attrib))
+    
+    def _expression_values(self,item):
+        """
+        List of (name,key(item)) of the expression indices
+        """
+        return [(name,key(item)) for name,key in self._expressions.items()]
+    
+    def _value(self,item,attrib):
+        """
+        The value of attrib (an attribute or expression index) of item
+        """
+        key = self._expressions.get(attrib)
+        if key is None:
+            return item[attrib]
+        return key(item)
+    
+    @_writer
+    def add_trigram_index(self,attribute):
+        """
+        Index the (string) values of `attribute` by their 3 character 
+        substrings (trigrams). It is maintained by all of the methods that 
+        modify the DB.
+        
+        Substring and regex queries then only check the distinct values that
+        contain every trigram of the query (or of the literal text that any
+        match of the regex must contain) rather than every item
+        
+        Usage
+        -----
+        >>> DB.add_trigram_index('message')
+        >>> Q = DB.Q()
+        >>> DB.query(Q.message.contains('timed out'))
+        >>> DB.query(Q.message.matches(r'user \\d+ logged in'))
+        
+        Notes:
+        ------
+            * Each distinct value is indexed once so repeated values are 
+              cheap but, like a full-text index, it is several times larger 
+              than the text itself
+            * contains() of fewer than 3 characters and regexes without 3 
+              literal characters in a row (or with alternation at the top 
+              level or case-insensitive) check all of the distinct values. 
+              Still no more than a scan
+            * Non-string values are not indexed and never match
+        """
+        if attribute in self.exclude_attributes:
+            raise ValueError("Can't index exclude_attributes")
+        
+        self._build_trigrams(attribute)
+        self._modified()
+        self._log('add_trigram_index',attribute)
+    
+    def _build_trigrams(self,attribute):
+        """
+        (Re)build the trigram index of attribute from its lookup
+        """
+        index = defaultdict(set)
+        for val,ixs in getattr(self,'_lookup',{}).get(attribute,{}).items():
+            if len(ixs) > 0:
+                _index_trigrams(index,val)
+        self._trigrams[attribute] = index
+    
+    @_writer
+    def add_bitmap_index(self,attribute):
+        """
+        Index `attribute` with compressed bitmaps. Each value is stored as a
+        bitmap of the matching indices in chunks of 4096 bits.
+        
+        This is best for dense, low-cardinality attributes (flags, statuses,
+        etc) where it uses much less memory and the and/or/not of queries 
+        run a machine word at a time. It is wasteful for sparse attributes
+        (like unique IDs). Also makes the set of all indices a bitmap so that
+        negations (`!=`,`~`) are fast.
+        """
+        if attribute in self.exclude_attributes:
+            raise ValueError("Can't index exclude_attributes")
+        
+        self._bitmaps.add(attribute)
+        if not isinstance(self._ix,_Bitmap):
+            self._ix = _Bitmap(self._ix)
+        
+        if attribute in getattr(self,'_lookup',{}):
+            lookup = self._new_lookup(attribute)
+            for val,ixs in self._lookup[attribute].items():
+                lookup[val] = _Bitmap(ixs)
+            self._lookup[attribute] = lookup
+            self._modified()
+        self._log('add_bitmap_index',attribute)
+    
+    @_writer
+    def add_column_index(self,attribute,dtype='float64'):
+        """
+        Also store the numeric `attribute` in a NumPy array aligned with the
+        items. Requires NumPy.
+        
+        Range queries (`<`, `<=`, `>`, `>=`, and `between`) on the attribute
+        are then vectorized (unless it also has a sorted index which is used
+        instead) as are vectorized filters:
+        
+        >>> DB.add_column_index('price')
+        >>> DB.add_column_index('qty',dtype='int64')
+        >>> DB.query(Q.price < 10)
+        >>> DB.query(Q.vfilter(lambda c: c['price']*c['qty'] > 1000))
+        >>> DB.column('price',Q.qty > 5).mean() # Aggregations
+        
+        Values must be numbers (or None for missing). Missing values never 
+        match.
+        """
+        if np is None:
+            raise ImportError('NumPy is required for column indices')
+        if attribute in self.exclude_attributes:
+            raise ValueError("Can't index exclude_attributes")
+        if self.N > 0 and attribute not in self.attributes:
+            raise KeyError("'{:s}' is not an attribute".format(attribute))
+        
+        column = _Column(attribute,dtype,len(self._list))
+        for ix,item in enumerate(self._list):
+            if item is None: continue
+            item = self._convert2dict(item)
+            column.set(ix,item[attribute])
+        self._columns[attribute] = column
+        self._modified()
+        self._log('add_column_index',attribute,dtype)
+    
+    @_writer
+    def add_composite_index(self,*attributes):
+        """
+        Also index the combination of values of two or more attributes. A 
+        query with equalities on all of them (as keywords, dicts or and-ed 
+        Qobj conditions) is then one lookup rather than an intersection of 
+        posting lists that may be much larger than the result
+        
+        Usage
+        -----
+        >>> DB.add_composite_index('tenant','sku')
+        >>> DB.query(tenant=t,sku=s) # One lookup
+        
+        Notes:
+        ------
+            * List values are expanded so an item is indexed under every
+              combination of their elements. Avoid long lists in more than 
+              one of the attributes
+        """
+        attributes = tuple(attributes)
+        if len(attributes) < 2 or len(set(attributes)) < len(attributes):
+            raise ValueError('A composite index needs two or more different attributes')
+        if any(attrib in self.exclude_attributes for attrib in attributes):
+            raise ValueError("Can't index exclude_attributes")
+        if self.N > 0 and any(attrib not in self.attributes for attrib in attributes):
+            raise KeyError('All of {0} must be attributes'.format(attributes))
+        
+        self._build_composite(attributes)
+        self._modified()
+        self._log('add_composite_index',*attributes)
+    
+    def _build_composite(self,attributes):
+        """
+        (Re)build the composite index of attributes from the items
+        """
+        lookup = defaultdict(_posting)
+        if all(attrib in (self.attributes or []) for attrib in attributes):
+            for ix,item in enumerate(self._list):
+                if item is None: continue
+                for key in self._composite_keys(self._convert2dict(item),attributes):
+                    lookup[key][ix] = None
+        self._composite[attributes] = lookup
+    
+    def _composites(self,widest=False):
+        """
+        List of (attributes,lookup) of the composite indices in use (all of
+        their attributes are DB attributes). If widest, the ones with the 
+        most attributes are first
+        """
+        attributes = self.attributes or []
+        composites = [(attrs,lookup) for attrs,lookup in self._composite.items() \
+                        if all(attrib in attributes for attrib in attrs)]
+        if widest:
+            composites.sort(key=lambda composite: -len(composite[0]))
+        return composites
+    
+    def _composite_keys(self,item,attributes):
+        """
+        The keys of item in the composite index of attributes. Each 
+        combination of the elements of list values
+        """
+        parts = []
+        for attrib in attributes:
+            value = item[attrib]
+            if not isinstance(value,list):
+                parts.append((value,))
+            elif len(value) == 0:
+                parts.append((self._empty,))
+            else:
+                parts.append(value)
+        return itertools.product(*parts)
+    
+    def _unindex_composites(self,item,ix,composites=None):
+        """
+        Remove ix (with values from item) from the composite indices
+        """
+        for attributes,lookup in (self._composites() if composites is None else composites):
+            for key in self._composite_keys(item,attributes):
+                ixs = lookup.get(key)
+                if ixs is None: continue
+                ixs.pop(ix,None)
+                if len(ixs) == 0:
+                    del lookup[key]
+    
+    @_reader
+    def column(self,attribute,*A,**K):
+        """
+        Return a NumPy array of the values of a column attribute (see 
+        add_column_index()) for all items or those matching a query (see 
+        query() for usage). Missing values are excluded.
+        
+        Usage
+        -----
+        >>> DB.column('price').sum()
+        >>> DB.column('price',DB.Q().qty > 5).mean()
+        """
+        column = self._columns[attribute]
+        if len(A) == 0 and len(K) == 0:
+            ixs = np.flatnonzero(column.valid)
+        else:
+            ixs = np.array(self._ixs(*A,**K),dtype=np.intp)
+            ixs = ixs[column.valid[ixs]]
+        return column.values[ixs]
+    
+    @_reader
+    def value_counts(self,attribute,*A,**K):
+        """
+        Return a dictionary of each value of `attribute` and the number of
+        items with it. This is read from the index (O(number of values)) 
+        rather than the items. If a query is given (see query() for usage),
+        only the matches are counted.
+        
+        Usage
+        -----
+        >>> DB.value_counts('role')
+        >>> DB.value_counts('role',DB.Q().born < 1942)
+        
+        Notes:
+        ------
+            * As with queries, list values are expanded so an item is 
+              counted for each of its elements. Empty lists are not counted
+        """
+        return {value:len(ixs) for value,ixs in self._groups(attribute,A,K)}
+    
+    @_reader
+    def group_by(self,attribute,*A,**K):
+        """
+        Group the items by the values of `attribute` using the index. 
+        Returns a dictionary of value: list of items or, if `agg` is given,
+        value: agg(list of items). If a query is given (see query() for 
+        usage), only the matches are grouped.
+        
+        Usage
+        -----
+        >>> DB.group_by('role')
+        >>> DB.group_by('role',agg=len) # Same as value_counts('role')
+        >>> DB.group_by('role',DB.Q().born < 1942,
+        ...             agg=lambda items: min(item['born'] for item in items))
+        
+        Notes:
+        ------
+            * As with queries, list values are expanded so an item is in 
+              the group of each of its elements. Empty lists are not grouped
+            * If `agg` is an attribute, query it with a dictionary instead
+        """
+        agg, = self._options(K,'agg')
+        groups = {}
+        for value,ixs in self._groups(attribute,A,K):
+            items = [self._list[ix] for ix in ixs]
+            groups[value] = items if agg is None else agg(items)
+        return groups
+    
+    @_writer
+    def remove(self,*A,**K):
+        """
+        Remove item that matches a given attribute or dict. See query() for
+        input specification
+
+
+        DB Options:
+        This is set at instantiation but can be changed directly
+        -----------
+        
+        DB.allowMultipleEdit
+                        - If True, this can remove multiple matching items
+
+        """
+
+        ixs = self._ixs(*A,**K)
+
+        if len(ixs)>1 and not self.allowMultipleEdit:
+            raise ValueError("Query returned multiple results. Set 'allowMultipleEdit' or change query")
+
+        if len(ixs) == 0:
+            raise ValueError('No matching items')
+        
+        ixs = list(ixs) # Make a copy since it may be a lookup that changes
+        self._remove_ixs(ixs)
+        self._log('remove',ixs)
+        
+        if self.autoVacuum is not None \
+                and len(self._list) - self.N > self.autoVacuum * len(self._list):
+            self.vacuum()
+    
+    def _remove_ixs(self,ixs):
+        """
+        Remove the items at ixs
+        """
+        for ix in ixs: # Must remove it from everything.
+            item = self._list[ix]
+            item = self._convert2dict(item)
+
+            for attrib in self.attributes:
+                value = item[attrib]
+                self._remove(attrib,value,ix)
+            for name,value in self._expression_values(item):
+                self._remove(name,value,ix)
+            self._unindex_composites(item,ix)
+                
+            # Remove it from the list by setting to None. Do not reshuffle
+            # the indices. A None check will be performed elsewhere
+            self._list[ix] = None
+            self._ix.discard(ix)
+            self.N -= 1
+    
+    @_writer
+    def vacuum(self):
+        """
+        Reclaim the space of removed items.
+        
+        Removed items are left in place (as None) so that the indices of the
+        remaining items do not change. This drops them and renumbers the 
+        remaining items and their lookups. It is O(N) but iteration, items(),
+        reindex(), add_attribute(), filters and unsorted range queries no 
+        longer pay for the removed items. 
+        
+        Notes:
+        ------
+            * The index of items (`DB[ix]` and `_index`) will change
+            * Existing Qobjs will be out of date
+            * Can be called automatically with the `autoVacuum` option
+        """
+        if self.N == len(self._list):
+            return # Nothing to do
+        
+        new_ix = [None] * len(self._list) # old ix --> new ix
+        items = []
+        i = 0
+        for ix,item in enumerate(self._list):
+            if ix == self._i:
+                i = len(items) # keep the iterator at the same item
+            if item is None: 
+                continue
+            new_ix[ix] = len(items)
+            items.append(item)
+        if self._i >= len(self._list):
+            i = len(items)
+        
+        for lookup in itertools.chain(self._lookup.values(),self._composite.values()):
+            for val,ixs in lookup.items(): # Only replacing values is safe
+                lookup[val] = type(ixs).fromkeys(new_ix[ix] for ix in ixs)
+        for unique in self._unique.values():
+            for val,ix in unique.items():
+                unique[val] = new_ix[ix]
+        
+        if len(self._columns) > 0:
+            keep = [ix for ix,new in enumerate(new_ix) if new is not None]
+            for column in self._columns.values():
+                column.take(keep)
+        
+        self._list = items
+        self._ix = type(self._ix)(range(len(items)))
+        self._i = i
+        self._modified()
+        self._log('vacuum')
+    
+    @_reader
+    def items(self):
+        """
+        Return a list of items.
+        """
+        return [a for a in self._list if a is not None]
+
+    def iteritems(self):
+        """
+        Return an iterator over the items.
+        """
+        return (a for a in self._list if a is not None)
+    
+    @_reader
+    def save(self,path):
+        """
+        Save a binary snapshot of the DB (items, indices and settings) to 
+        `path` so that load() does not need to reindex anything.
+        
+        The file is a header, a pickle of the DB and then the NumPy column
+        arrays (if any) stored raw so that they can be memory mapped. It is 
+        written to a temporary file first and then moved into place.
+        
+        Notes:
+        ------
+            * Items must be picklable (e.g. when using indexObjects)
+            * The key functions of expression indices (see add_index()) 
+              that cannot be pickled (e.g. lambdas) are not saved and must
+              be given to load()
+            * This is *not* a portable interchange format. Like any pickle,
+              only load files you trust
+        """
+        state = {key:val for key,val in self.__dict__.items() \
+                    if key not in _SNAPSHOT_SKIP}
+        
+        # Key functions that cannot be pickled are given to load()
+        state['_expressions'] = {name:(key if _picklable(key) else None) \
+                                    for name,key in self._expressions.items()}
+        
+        # Columns are stored after the pickle. Offsets are from the start of
+        # that data (aligned)
+        columns,arrays = {},[]
+        offset = 0
+        size = len(self._list)
+        for attribute,column in self._columns.items():
+            values,valid = column.values[:size],column.valid[:size]
+            desc = [values.dtype.str,len(values)]
+            for array in (values,valid):
+                array = np.ascontiguousarray(array)
+                desc.append(offset)
+                arrays.append((offset,array))
+                offset = _align(offset + array.nbytes)
+            columns[attribute] = desc
+        state['_columns'] = columns
+        
+        head = pickle.dumps(state,protocol=pickle.HIGHEST_PROTOCOL)
+        
+        tmp = path + '.tmp'
+        with open(tmp,'wb') as F:
+            F.write(_SNAPSHOT_MAGIC)
+            F.write(struct.pack('<Q',len(head)))
+            F.write(head)
+            start = _align(F.tell())
+            for offset,array in arrays:
+                F.write(b'\0'*(start + offset - F.tell()))
+                F.write(array.tobytes())
+            F.flush()
+            os.fsync(F.fileno())
+        _replace(tmp,path)
+    
+    @classmethod
+    def load(cls,path,mmap=False,keys=None):
+        """
+        Load a DB saved with save(). Nothing is reindexed.
+        
+        Inputs:
+        -------
+        path (str)
+            Path of the snapshot
+        
+        mmap [False] (bool)
+            If True, NumPy column arrays are memory mapped (copy-on-write) 
+            rather than read so they are only loaded as they are used. The 
+            file is never modified
+        
+        keys [None] (dict)
+            Key functions of expression indices {name: key} that could not
+            be saved (see add_index()). They are required
+        
+        Usage
+        -----
+        >>> DB.save('DB.snapshot')
+        >>> DB = list_dict_DB.load('DB.snapshot')
+        >>> DB = list_dict_DB.load('DB.snapshot',keys={'email_lc':email_lc})
+        """
+        with open(path,'rb') as F:
+            if F.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+                raise ValueError('{0} is not a list_dict_DB snapshot'.format(path))
+            n, = struct.unpack('<Q',F.read(8))
+            enabled = gc.isenabled() # Unpickling many objects triggers it for nothing
+            gc.disable()
+            try:
+                state = pickle.loads(F.read(n))
+            finally:
+                if enabled:
+                    gc.enable()
+            start = _align(F.tell())
+            
+            columns = {}
+            for attribute,(typestr,size,values,valid) in state['_columns'].items():
+                column = _Column.__new__(_Column)
+                column.attribute = attribute
+                arrays = []
+                for dtype,offset in ((np.dtype(typestr),values),(np.dtype(bool),valid)):
+                    if mmap and size > 0:
+                        arrays.append(np.memmap(path,dtype=dtype,mode='c',
+                                                offset=start+offset,shape=(size,)))
+                    else:
+                        F.seek(start + offset)
+                        arrays.append(np.fromfile(F,dtype=dtype,count=size))
+                column.values,column.valid = arrays
+                columns[attribute] = column
+        
+        expressions = state['_expressions']
+        for name,key in (keys or {}).items():
+            if name in expressions:
+                expressions[name] = key
+        missing = [name for name,key in expressions.items() if key is None]
+        if len(missing) > 0:
+            raise ValueError('The key functions of {0} were not saved. Give them to load() '
+                             'with `keys`'.format(missing))
+        
+        DB = cls.__new__(cls)
+        DB.__dict__.update(state)
+        DB._columns = columns
+        DB._cache = OrderedDict()
+        DB._cache_hits = DB._cache_misses = 0
+        DB._journal = DB._journal_path = None
+        DB._journal_synced = 0
+        DB._init_locks()
+        DB._time = 0
+        DB._multi = {}
+        return DB
+    
+    @classmethod
+    def from_jsonl(cls,path,converters=None,chunksize=10000,progress=None,**kwargs):
+        """
+        Create a DB from a JSON-lines file (one object per line). The file is
+        read and indexed in chunks so that the whole file is never in 
+        memory at once (as it is with json.load() and then list_dict_DB()).
+        
+        Inputs:
+        -------
+        path (str or file)
+            Path or open (text) file to read
+        
+        converters [None] (dict)
+            attribute: function to convert the values of attribute (e.g. 
+            {'born':int}). None values are not converted
+        
+        chunksize [10000] (int)
+            Number of rows to add at a time
+        
+        progress [None] (callable)
+            Called with the number of rows read so far after each chunk
+        
+        All other keywords are passed to list_dict_DB()
+        
+        Usage
+        -----
+        >>> DB = list_dict_DB.from_jsonl('items.jsonl',sorted_attributes=['born'])
+        """
+        rows = _read_rows(path,_jsonl_rows,converters)
+        return cls._from_rows(rows,chunksize,progress,kwargs)
+    
+    @classmethod
+    def from_csv(cls,path,converters=None,chunksize=10000,progress=None,
+                 delimiter=',',**kwargs):
+        """
+        Create a DB from a CSV file with a header row. The file is read and
+        indexed in chunks (see from_jsonl()). 
+        
+        All values are strings unless converted with `converters`. Empty 
+        values of converted attributes are None.
+        
+        Inputs are the same as from_jsonl() plus the `delimiter`
+        
+        Usage
+        -----
+        >>> DB = list_dict_DB.from_csv('items.csv',converters={'born':int})
+        """
+        rows = _read_rows(path,lambda F:_csv_rows(F,delimiter,converters),converters)
+        return cls._from_rows(rows,chunksize,progress,kwargs)
+    
+    @classmethod
+    def _from_rows(cls,rows,chunksize,progress,kwargs):
+        """
+        Create a DB from the rows in chunks
+        """
+        DB = cls(**kwargs)
+        n = 0
+        for chunk in _chunks(rows,chunksize):
+            DB.add_items(chunk)
+            n += len(chunk)
+            if progress is not None:
+                progress(n)
+        return DB
+    
+    @_writer
+    def open_journal(self,path):
+        """
+        Journal all changes to the DB to `path` so that they are durable.
+        If the file exists, any changes in it that are newer than the DB 
+        (e.g. a snapshot loaded with load()) are replayed first.
+        
+        Each change is appended as a record as it happens. How often the 
+        file is fsync'ed is set by the journalSync and journalInterval 
+        options. Use compact_journal() to save a snapshot and start a new
+        (empty) journal.
+        
+        Usage
+        -----
+        >>> DB = list_dict_DB.load('DB.snapshot')
+        >>> DB.open_journal('DB.journal')  # Replays newer changes
+        >>> DB.add(item)                   # Journaled
+        >>> DB.compact_journal('DB.snapshot')
+        
+        Notes:
+        ------
+            * Journaled: add(), add_items(), update(), remove(), vacuum(),
+              add_attribute() and adding indices. Changing items directly 
+              and calling reindex() is *not* journaled. Use update()
+            * Changes are recorded by item index so the journal only applies
+              to the DB (or snapshot) it was started from
+            * An incomplete final record (e.g. from a crash) is dropped
+            * Items and updated values must be picklable
+            * With journalSync='batch', the last changes are synced by the 
+              next change after journalInterval. Call sync() or 
+              close_journal() to sync them sooner
+        """
+        if self._journal is not None:
+            raise ValueError('A journal is already open')
+        
+        end = 0 # End of the last good record
+        if os.path.exists(path):
+            for end,(seq,op,args) in _read_journal(path):
+                if seq > self._journal_seq:
+                    self._replay(op,args)
+                    self._journal_seq = seq
+        
+        self._journal = open(path,'ab')
+        self._journal.truncate(end) # Drop anything incomplete
+        self._journal_path = path
+        self._journal_synced = time.time()
+    
+    @_writer
+    def close_journal(self):
+        """
+        Sync and close the journal (if open). Changes are no longer journaled
+        """
+        if self._journal is None:
+            return
+        self.sync()
+        self._journal.close()
+        self._journal = self._journal_path = None
+    
+    @_writer
+    def sync(self):
+        """
+        fsync the journal (if open) regardless of the journalSync option
+        """
+        if self._journal is None:
+            return
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_synced = time.time()
+    
+    @_writer
+    def compact_journal(self,snapshot_path):
+        """
+        Save a snapshot of the DB to `snapshot_path` (see save()) and start
+        a new, empty journal. Reload with load() and then open_journal().
+        
+        If interrupted, the old journal is still consistent with the new 
+        snapshot since changes already in it are skipped
+        """
+        if self._journal is None:
+            raise ValueError('No open journal')
+        path = self._journal_path
+        self.sync()
+        self.save(snapshot_path)
+        
+        self._journal.close()
+        self._journal = None
+        with open(path + '.tmp','wb') as F:
+            os.fsync(F.fileno())
+        _replace(path + '.tmp',path)
+        self.open_journal(path)
+    
+    @_reader
+    def cache_info(self):
+        """
+        Return the (hits, misses, maxsize, currsize) of the query cache. See
+        the `cacheSize` option
+        """
+        return _CacheInfo(self._cache_hits,self._cache_misses,
+                          self.cacheSize,len(self._cache))
+    
+    def Qobj(self):
+        """
+        Query object already loaded with the DB
+        
+            DB.Qobj() <==> DB.Qobj() <==> Qobj(DB)
+        """
+        return Qobj(self) 
+    
+    def Q(self):
+        """
+        same as Qobj method
+        """
+        return Qobj(self)
+    
+    def _convert2dict(self,obj):
+        """ 
+        Convert objects to a regular dictionary for the sake of indexing
+        
+        Also return Qobjs untouched since they may be used in queries too
+        
+        If it not an Qobj or dict, it will try to get it's __dict__ and if 
+        that doesn't work, will just return it
+        """
+        if isinstance(obj,Qobj):
+            return obj
+        
         if isinstance(obj,dict): # Also accounts for OrderedDicts or ...
             return obj           # ... anything that inherits dict
         
@@ -487,129 +1988,1308 @@ class list_dict_DB(object):
         return obj
         
     
-    def _ixs(self,*args,**kwords):
-        """
-        Get the inde(x/ies) of matching information
-        """
-        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
-            return []
- 
-        # Make the entire kwords be lists with default of []. Edge case of
-        # multiple items
-        for key,val in kwords.items():
-            if not isinstance(val,list):
-                kwords[key] = [val]
-        kwords = defaultdict(list,kwords)
-        
-        Q = Qobj(self) # Empty object
-        for arg in args:
-            arg = self._convert2dict(arg) # handle other object types
-            if isinstance(arg,Qobj):
-                Q = Q & arg # Will add these conditions. If Q is empty, will just be arg
-                continue
-            if isinstance(arg,dict):
-                for key,val in arg.items(): # Add it rather than update in case it is already specified
-                    kwords[key].append(val)
+    def _ixs(self,*args,**kwords):
+        """
+        Get the inde(x/ies) of matching information
+        """
+        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
+            return []
+        
+        postings,conditions,cache_key = self._parse(args,kwords)
+        
+        if cache_key is not None:
+            ixs = self._cached(cache_key,miss=True)
+            if ixs is not None:
+                return ixs
+        
+        ixs = self._match(conditions,postings)
+        if ixs is None: # Ensure one match
+            return []
+        ixs = list(ixs)
+        
+        if cache_key is not None:
+            with self._cache_lock:
+                self._cache[cache_key] = ixs
+                while len(self._cache) > self.cacheSize:
+                    self._cache.popitem(last=False) # least recently used
+        return ixs
+    
+    def _cached(self,cache_key,miss=False):
+        """
+        Return the cached indices for cache_key (or None) and count the hit 
+        (and the miss if `miss`)
+        """
+        with self._cache_lock: # Readers share the cache in threadsafe mode
+            ixs = self._cache.pop(cache_key,None)
+            if ixs is None:
+                if miss:
+                    self._cache_misses += 1
+                return None
+            self._cache[cache_key] = ixs # Most recently used
+            self._cache_hits += 1
+            return ixs
+    
+    def _iter_ixs(self,*args,**kwords):
+        """
+        Return a generator of the inde(x/ies) of matching information.
+        
+        Rather than finding all of the matches first (like _ixs), the 
+        smallest posting list is iterated and the other conditions are checked
+        one index at a time so that it can stop early. 
+        
+        The query is planned (and any errors raised) before it is returned.
+        The DB may not be modified while iterating.
+        """
+        driver,check = self._plan(args,kwords)
+        
+        def _gen(time0=self._time):
+            for ix in driver:
+                if self._time != time0:
+                    raise RuntimeError('DB changed during iteration')
+                if check(ix):
+                    yield ix
+        return _gen()
+    
+    def _plan(self,args,kwords):
+        """
+        Plan a query for iterating. Returns the indices to iterate (the 
+        smallest posting list, a cheap condition, or all of them) and a 
+        function to check each one against the rest of the query
+        """
+        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
+            return [],_always
+        
+        postings,conditions,cache_key = self._parse(args,kwords)
+        
+        ixs = self._cached(cache_key) if cache_key is not None else None
+        if ixs is not None:
+            return ixs,_always
+        
+        postings,tests = self._split(conditions,postings)
+        tests.sort(key=Qobj._cost)
+        
+        if len(postings) > 0:
+            postings.sort(key=len)
+            driver,rest = postings[0],postings[1:]
+        elif len(tests) == 0: # Ensure one match
+            return [],_always
+        elif tests[0]._cost() <= 1: # Cheap enough to evaluate it all
+            driver,rest = tests.pop(0)._evaluate(),[]
+        else: # Scan
+            driver,rest = self._ix,[]
+        
+        if len(rest) == 0 and len(tests) == 0:
+            return driver,_always
+        
+        def check(ix):
+            return all(ix in ixs for ixs in rest) and all(C._test(ix) for C in tests)
+        return driver,check
+    
+    def _ordered_ixs(self,order_by,args,kwords,count=None):
+        """
+        Return the inde(x/ies) of matching information ordered by the 
+        attribute(s) in `order_by` ('-attrib' for descending). If `count` is 
+        given, only the first `count` are needed.
+        
+        If the first attribute has a sorted index and the query is not too
+        selective, its values are walked in order and the matches are found
+        until there are enough. Otherwise, the matches are found and the 
+        first `count` are selected with a heap, O(k log count)
+        """
+        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
+            return []
+        
+        keys = _order_keys(order_by,self._names())
+        
+        postings,conditions,_ = self._parse(args,dict(kwords))
+        if len(postings) == 0 and len(conditions) == 0: # Ensure one match
+            return []
+        
+        attrib,reverse = keys[0]
+        if attrib in self._sorted and count != 0:
+            # Walk the index unless the smallest posting list is small enough
+            # that selecting from it is cheaper
+            postings,_ = self._split(conditions,postings)
+            size = min(len(ixs) for ixs in postings) if len(postings) > 0 else self.N
+            if count is None and len(postings) == 0 or \
+                    count is not None and count*self.N < size*size:
+                return self._walk_sorted(keys,args,kwords,count)
+        
+        ixs = self._ixs(*args,**kwords)
+        key,reverse = self._order_key(keys)
+        if count is None:
+            return sorted(ixs,key=key,reverse=reverse)
+        return (heapq.nlargest if reverse else heapq.nsmallest)(count,ixs,key=key)
+    
+    def _walk_sorted(self,keys,args,kwords,count=None):
+        """
+        Ordered matches by walking the sorted index of the first key. Each
+        group of matches with the same value is ordered by the rest of the 
+        keys. 
+        
+        Only the values that match any range conditions (Qobjs) on the first
+        key are walked unless an item has a list of values. It is ordered by
+        its smallest/largest one which may be out of the range.
+        """
+        attrib,reverse = keys[0]
+        lookup = self._lookup[attrib]
+        values = self._sorted[attrib]
+        
+        lo,hi = 0,len(values)
+        if not self._multivalued(attrib):
+            for arg in args:
+                if not isinstance(arg,Qobj):
+                    continue
+                for C in arg._conjuncts():
+                    if C._attr == attrib and C._op in _COMPARE and C._op not in _TEXT_OPS:
+                        lo2,hi2 = C._sorted_range(values)
+                        lo,hi = max(lo,lo2),min(hi,len(values) if hi2 is None else hi2)
+            if lo > 0 or hi < len(values):
+                values = values[lo:hi]
+        if reverse:
+            values = reversed(values)
+        
+        driver,check = self._plan(args,kwords) # Matches are in the driver and pass check
+        if not isinstance(driver,(dict,set,_Bitmap)):
+            driver = set(driver)
+        match = lambda ix: ix in driver and check(ix)
+        key,key_reverse = self._order_key(keys[1:]) if len(keys) > 1 else (None,False)
+        
+        ixs = []
+        seen = set() # Items with list values are under more than one value
+        for value in values:
+            group = [ix for ix in lookup[value] if ix not in seen and match(ix)]
+            if key is not None and len(group) > 1:
+                group.sort(key=key,reverse=key_reverse)
+            seen.update(group)
+            ixs.extend(group)
+            if count is not None and len(ixs) >= count:
+                return ixs[:count]
+        
+        # Items with an empty list are last
+        rest = [ix for ix in lookup.get(self._empty,()) if ix not in seen and match(ix)]
+        if key is not None:
+            rest.sort(key=key,reverse=key_reverse)
+        ixs.extend(rest)
+        return ixs[:count]
+    
+    def _multivalued(self,attrib):
+        """
+        Whether any item has a list of more than one value for attrib, i.e.
+        it is in more than one posting list. Kept until the DB changes
+        """
+        time,multi = self._multi.get(attrib,(None,None))
+        if time != self._time:
+            multi = sum(len(ixs) for ixs in self._lookup[attrib].values()) > self.N
+            self._multi[attrib] = self._time,multi
+        return multi
+    
+    def _order_key(self,keys):
+        """
+        Return the sort key function of an index for the (attrib,reverse) 
+        keys and whether to reverse the sort. See _sort_key()
+        """
+        convert = self._convert2dict if self.indexObjects else None
+        return _sort_key(keys,self._list,convert,self._expressions)
+    
+    def _parse(self,args,kwords):
+        """
+        Split a query into the posting lists of its equality conditions, the 
+        Qobj conditions and the key for the query cache (or None if it is 
+        not cached)
+        """
+        # Make the entire kwords be lists with default of []. Edge case of
+        # multiple items
+        for key,val in kwords.items():
+            if not isinstance(val,list):
+                kwords[key] = [val]
+        kwords = defaultdict(list,kwords)
+        
+        conditions = [] # Qobjs. They are evaluated with the planner
+        for arg in args:
+            arg = self._convert2dict(arg) # handle other object types
+            if isinstance(arg,Qobj):
+                conditions.append(arg)
+                continue
+            if isinstance(arg,dict):
+                for key,val in arg.items(): # Add it rather than update in case it is already specified
+                    kwords[key].append(val)
+            else:
+                raise ValueError('unrecognized input of type {:s}'.format(str(type(arg))))
+        
+        # Only pure equality queries are cached. The key is independent of 
+        # the order and form (dict vs keyword) of the query
+        cache_key = None
+        if self.cacheSize and len(conditions) == 0:
+            try:
+                cache_key = frozenset((k,frozenset(_freeze(v) for v in vals)) \
+                                for k,vals in kwords.items())
+            except TypeError: # unhashable. Let the query raise the error
+                pass
+        
+        # Each equality condition is a posting list that must contain the index
+        postings = self._eq_postings(kwords)
+        
+        return postings,conditions,cache_key
+    
+    def _split(self,conditions,postings=()):
+        """
+        Split the conditions (Qobjs) that are and-ed together into posting 
+        lists (equality and already evaluated) and the rest
+        """
+        postings = list(postings)
+        rest = []
+        eqs = defaultdict(list)
+        for Q in conditions:
+            for C in Q._conjuncts():
+                C._valid()
+                if C._op == 'eq':
+                    eqs[C._attr].append(C._args[0])
+                elif C._op == 'ixs':
+                    postings.append(C._args[0])
+                elif C._result_time == self._time: # Already evaluated
+                    postings.append(C._result)
+                else:
+                    rest.append(C)
+        postings.extend(self._eq_postings(eqs))
+        return postings,rest
+    
+    def _eq_postings(self,eqs):
+        """
+        Return the posting lists of the equality conditions in eqs 
+        (attribute: list of values that must all match). Attributes with a 
+        composite index are looked up together
+        """
+        postings = []
+        if len(self._composite) > 0 and len(eqs) > 1:
+            eqs = dict(eqs)
+            for attributes,lookup in self._composites(widest=True):
+                if all(attrib in eqs for attrib in attributes):
+                    parts = [self._eq_values(eqs.pop(attrib)) for attrib in attributes]
+                    postings.extend(lookup.get(key,()) for key in itertools.product(*parts))
+        
+        for key,value in eqs.items():
+            if isinstance(value,list) and len(value) == 0:
+                value = [self._empty]
+            for val in _makelist(value):
+                postings.extend(self._postings(key,val))
+        return postings
+    
+    def _eq_values(self,values):
+        """
+        The values of a list of equality conditions with lists expanded
+        """
+        if len(values) == 0:
+            return [self._empty]
+        expanded = []
+        for value in values:
+            if not isinstance(value,list):
+                expanded.append(value)
+            elif len(value) == 0:
+                expanded.append(self._empty)
+            else:
+                expanded.extend(value)
+        return expanded
+    
+    def _match(self,conditions,postings=(),within=None):
+        """
+        Return the indices that are in all of the posting lists (and 
+        `within` if given) and match all of the conditions (Qobjs). Returns
+        None if there is nothing to match.
+        
+        The equality conditions are intersected first, starting from the
+        smallest, and the remaining conditions are only evaluated on what is
+        left (if anything)
+        """
+        postings,deferred = self._split(conditions,postings)
+        if within is not None:
+            postings.append(within)
+        
+        if len(postings) == 0 and len(deferred) == 0:
+            return None
+        
+        ixs = _intersect(postings) if len(postings) > 0 else None
+        for C in sorted(deferred,key=Qobj._cost):
+            if ixs is not None:
+                if len(ixs) == 0:
+                    break
+                if not isinstance(ixs,(set,_Bitmap)):
+                    ixs = set(ixs)
+            ixs = C._evaluate(within=ixs)
+        return ixs
+    
+    def _groups(self,attribute,A,K):
+        """
+        Yield each value of attribute and its indices, restricted to the 
+        matches of the query if there is one. The smaller of each posting 
+        list and the matches is iterated unless it is cheaper to group the
+        matches by their values
+        """
+        if attribute not in (self.attributes or []) and attribute not in self._expressions:
+            raise KeyError("'{:s}' is not an attribute".format(attribute))
+        if not hasattr(self,'_lookup') or self.N==0: # It may be empty
+            return
+        
+        within = None
+        if len(A) > 0 or len(K) > 0:
+            within = self._ixs(*A,**K)
+            if len(within) == 0:
+                return
+            within = _Bitmap(within) if attribute in self._bitmaps else set(within)
+        
+        lookup = self._lookup[attribute]
+        if within is not None and attribute not in self._bitmaps:
+            # Reading the value of each match costs a few lookups
+            cost = sum(min(len(ixs),len(within)) for ixs in lookup.values())
+            if 4*len(within) < cost:
+                groups = defaultdict(list)
+                for ix in within:
+                    value = self._value(self._convert2dict(self._list[ix]),attribute)
+                    # Lists are expanded but lookups only have an index once
+                    for val in (set(value) if isinstance(value,list) else [value]):
+                        groups[val].append(ix)
+                for value,ixs in groups.items():
+                    yield value,ixs
+                return
+        
+        for value,ixs in list(lookup.items()):
+            if value is self._empty:
+                continue
+            if within is not None:
+                if isinstance(ixs,_Bitmap):
+                    ixs = ixs & within
+                elif len(ixs) <= len(within):
+                    ixs = [ix for ix in ixs if ix in within]
+                else:
+                    ixs = [ix for ix in within if ix in ixs]
+            if len(ixs) > 0:
+                yield value,ixs
+    
+    def _init_locks(self):
+        """
+        Set up the locks for threadsafe mode (or dummies)
+        """
+        if self.threadsafe:
+            self._lock = _RWLock()
+            self._cache_lock = threading.Lock()
+        else:
+            self._lock = None
+            self._cache_lock = _NOLOCK
+    
+    def _log(self,op,*args):
+        """
+        Append a change to the journal (if open)
+        """
+        if self._journal is None:
+            return
+        self._journal_seq += 1
+        data = pickle.dumps((self._journal_seq,op,args),protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.write(struct.pack('<II',len(data),zlib.crc32(data) & 0xffffffff))
+        self._journal.write(data)
+        self._journal.flush()
+        
+        if self.journalSync == 'always' or (self.journalSync == 'batch' and \
+                time.time() - self._journal_synced >= self.journalInterval):
+            self.sync()
+    
+    def _replay(self,op,args):
+        """
+        Apply a change from the journal
+        """
+        if op == 'add':
+            self.add_items(args[0])
+        elif op == 'update':
+            self._update(*args)
+        elif op == 'remove':
+            self._remove_ixs(*args)
+        elif op == 'add_attribute':
+            attribute,filled = args
+            for ix,value in filled:
+                self._convert2dict(self._list[ix])[attribute] = value
+            self._add_attribute(attribute)
+        elif op in ('vacuum','add_sorted_index','add_bitmap_index','add_column_index',
+                    'add_composite_index','add_trigram_index','add_index',
+                    'add_unique_index'):
+            getattr(self,op)(*args)
+        else:
+            raise ValueError('Unknown journal record {0!r}'.format(op))
+        self._modified()
+    
+    def _options(self,K,*names):
+        """
+        Pop the query options `names` from the keywords K (or None) unless 
+        they are attributes
+        """
+        return _options(K,self._names(),*names)
+    
+    def _names(self):
+        """
+        The names that may be queried: attributes and expression indices
+        """
+        return (self.attributes or []) + list(self._expressions)
+    
+    def _modified(self):
+        """
+        Mark the DB as modified. This expires Qobjs and clears the cache
+        """
+        self._time += 1
+        if len(self._cache) > 0:
+            self._cache.clear()
+    
+    def _postings(self,attrib,value):
+        """
+        Return the posting lists that an index must be in to match 
+        attrib == value. Lists are expanded and an empty list matches
+        empty lists
+        """
+        if isinstance(value,list) and len(value) == 0:
+            value = [self._empty]
+        
+        if attrib == '_index':
+            return [self._index(val) for val in _makelist(value)]
+        
+        if attrib not in self.attributes and attrib not in self._expressions:
+            raise KeyError("'{:s}' is not an attribute".format(attrib))
+        
+        lookup = self._lookup[attrib]
+        return [lookup.get(val,()) for val in _makelist(value)] # Do not add val
+    
+    def _drop_attribute(self,attribute,filled):
+        """
+        Undo _add_attribute() of a new attribute. `filled` is what it 
+        returned
+        """
+        for ix,_ in filled:
+            del self._convert2dict(self._list[ix])[attribute]
+        self.attributes.remove(attribute)
+        del self._lookup[attribute]
+        if attribute in self._columns:
+            self._columns[attribute].clear()
+        if attribute in self._sorted:
+            self._sorted[attribute] = []
+        if attribute in self._trigrams:
+            self._trigrams[attribute] = defaultdict(set)
+        if attribute in self._unique:
+            self._unique[attribute] = {}
+        for composite in list(self._composite): # No longer complete
+            if attribute in composite:
+                self._build_composite(composite)
+        self._modified()
+    
+    def _build_lookups(self,attributes):
+        """
+        Return new lookups of the attributes built from the items. 
+        
+        With `indexProcesses`, they are built in forked processes. Each 
+        builds the partial lookups of a group of attributes over a range of
+        the items and they are merged in order.
+        """
+        global _building
+        attributes = list(attributes)
+        processes = self.indexProcesses or 1
+        context = None
+        if processes > 1 and len(self._list) >= _PARALLEL_MIN_ITEMS:
+            context = _fork_context()
+        
+        if context is None or len(attributes) == 0 or len(self._list) == 0:
+            tasks = [(attributes,0,len(self._list))]
+            results = [_partial_lookups(self,*tasks[0])]
+        else:
+            # Split by attribute and then, if there are not enough, by items
+            groups = [attributes[i::processes] for i in range(min(processes,len(attributes)))]
+            nranges = -(-processes // len(groups))
+            size = -(-len(self._list) // nranges)
+            tasks = [(group,start,start + size) for group in groups \
+                            for start in range(0,len(self._list),size)]
+            
+            with _building_lock:
+                _building = self # The processes are forked with it
+                try:
+                    pool = context.Pool(processes)
+                    try:
+                        results = pool.map(_build_partial,tasks,chunksize=1)
+                    finally:
+                        pool.close()
+                        pool.join()
+                finally:
+                    _building = None
+        
+        lookups = {attr:self._new_lookup(attr) for attr in attributes}
+        for (group,_,_),result in zip(tasks,results):
+            for attr,(partial,empty) in zip(group,result):
+                lookup = lookups[attr]
+                if len(lookup) == 0:
+                    lookup.update(partial)
+                else:
+                    for val,ixs in partial.items():
+                        if val in lookup:
+                            lookup[val].update(ixs)
+                        else:
+                            lookup[val] = ixs
+                if empty is not None: # Different _emptyList once pickled
+                    lookup[self._empty].update(empty)
+        return lookups
+    
+    def _fill_columns(self,attributes):
+        """
+        Set the values of any column attributes (after their lookups were
+        built elsewhere)
+        """
+        columns = [(attr,self._columns[attr]) for attr in attributes if attr in self._columns]
+        if len(columns) == 0:
+            return
+        for ix,item in enumerate(self._list):
+            if item is None: continue
+            item = self._convert2dict(item)
+            for attr,column in columns:
+                column.set(ix,item[attr])
+    
+    def _new_lookup(self,attrib):
+        """
+        Return a new (empty) lookup of value: indices for attrib
+        """
+        if attrib in self._bitmaps:
+            return defaultdict(_Bitmap)
+        return defaultdict(_posting)
+    
+    def _init_lookup(self,item):
+        """
+        Set up the attributes and lookup from the first item
+        """
+        attributes = self.attributes
+        if attributes is None:
+            attributes = list(item.keys())
+
+        self.attributes = [attrib for attrib in attributes \
+                            if attrib not in self.exclude_attributes] # Make a copy
+
+        # Set up the lookup
+        self._lookup = {attribute:self._new_lookup(attribute) \
+                            for attribute in itertools.chain(self.attributes,self._expressions)}
+    
+    def _index(self,ix):
+        """
+        Return ix if it hasn't been deleted
+        """
+        try:
+            item = self._list[ix]
+        except IndexError:
+            return []
+        
+        if item is None:
+            return []
+        
+        return [ix]
+    
+    def _append(self,attrib,value,ix):
+        """
+        Add to the lookup and update the modify time
+        """
+        # Final check but we should be guarded from this
+        if attrib in self.exclude_attributes:
+            print('BAD! Should guard against this in public methods!')
+            raise ValueError('Cannot reindex an excluded attribute') 
+        
+        lookup = self._lookup[attrib]
+        keys = self._sorted.get(attrib)
+        grams = self._trigrams.get(attrib)
+        unique = self._unique.get(attrib)
+        
+        valueL = _makelist(value)
+        for val in valueL: 
+            ixs = lookup[val]
+            if len(ixs) == 0: # New value
+                if keys is not None:
+                    insort(keys,val)
+                if grams is not None:
+                    _index_trigrams(grams,val)
+            ixs[ix] = None
+            if unique is not None and val is not None:
+                unique[val] = ix
+        if len(valueL) == 0:
+            lookup[self._empty][ix] = None # empty list
+        if attrib in self._columns:
+            self._columns[attrib].set(ix,value)
+        self._modified()
+    
+    def _remove(self,attrib,value,ix):
+        """
+        Remove from the lookup and update the modify time
+        """
+        lookup = self._lookup[attrib]
+        keys = self._sorted.get(attrib)
+        grams = self._trigrams.get(attrib)
+        unique = self._unique.get(attrib)
+        
+        valueL = _makelist(value)
+        for val in valueL: 
+            if unique is not None and unique.get(val) == ix: # May be another's in an update
+                del unique[val]
+            ixs = lookup[val]
+            del ixs[ix]
+            if len(ixs) == 0: # Last one so clean it up
+                del lookup[val]
+                if keys is not None:
+                    del keys[bisect_left(keys,val)]
+                if grams is not None:
+                    _unindex_trigrams(grams,val)
+        if len(valueL) == 0:
+            del lookup[self._empty][ix] # empty list
+        if attrib in self._columns:
+            self._columns[attrib].unset(ix)
+    
+        self._modified()
+    
+    def __contains__(self,check_diff):
+        check_diff = self._convert2dict(check_diff)
+        if not ( isinstance(check_diff,dict) or isinstance(check_diff,Qobj)):
+            raise ValueError('Python `in` queries should be a of {attribute:value} or Qobj')
+        return self.isin(check_diff)
+
+    def __len__(self):
+        return self.N
+
+    def __getitem__(self,item):
+        item = self._convert2dict(item)
+        if isinstance(item,dict) or isinstance(item,Qobj):
+            return self.query(item)
+        elif isinstance(item,int): # numbered item
+            if self._list[item] is not None:
+                return self._list[item]
+            else:
+                raise ValueError("Index has been deleted")
+        else:
+            raise ValueError("Must specify DB[{'attribute':val}] or DB[index]'")
+    __call__ = query
+    
+    def __iter__(self):
+        return self.iteritems()
+
+    def __next__(self):
+        while self._i < len(self._list):
+            self._i += 1 # Increment it but then search back
+            if self._list[self._i-1] is not None:
+                return self._list[self._i-1]
+        raise StopIteration()
+    next = __next__ # For compatability
+    
+    
+def _makelist(input):
+    if isinstance(input,list):
+        return input
+    return [input] 
+
+def _islice(iterable,offset=None,limit=None):
+    """
+    islice by offset and limit (either may be None)
+    """
+    offset = offset or 0
+    return itertools.islice(iterable,offset,None if limit is None else offset + limit)
+
+def _options(K,attributes,*names):
+    """
+    Pop the query options `names` from the keywords K (or None) unless 
+    they are attributes
+    """
+    return [K.pop(name) if name in K and name not in attributes else None \
+            for name in names]
+
+_PARALLEL_MIN_ITEMS = 10000 # Fewer are faster to index without processes
+_building = None # The DB that forked processes build lookups of
+_building_lock = threading.Lock()
+
+def _fork_context():
+    """
+    multiprocessing (context) that forks or None if not available
+    """
+    if not hasattr(os,'fork'):
+        return None
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError: # Python 2 always forks
+        return multiprocessing
+    except ValueError:
+        return None
+
+def _build_partial(task):
+    """
+    _partial_lookups() of the DB being built (in a forked process)
+    """
+    return _partial_lookups(_building,*task)
+
+def _partial_lookups(DB,attributes,start,stop):
+    """
+    Build the lookups of the attributes (and/or expression indices) over 
+    DB._list[start:stop]. Returns a list of (lookup as a dict,empty list 
+    indices) per attribute
+    """
+    lookups = [DB._new_lookup(attr) for attr in attributes]
+    empty = DB._empty
+    targets = [(attrib,lookup,DB._expressions.get(attrib)) \
+                    for attrib,lookup in zip(attributes,lookups)]
+    for ix in range(start,min(stop,len(DB._list))):
+        item = DB._list[ix]
+        if item is None: continue
+        item = DB._convert2dict(item)
+        for attrib,lookup,key in targets:
+            value = item[attrib] if key is None else key(item)
+            if not isinstance(value,list):
+                lookup[value][ix] = None
+            elif len(value) == 0:
+                lookup[empty][ix] = None # empty list
+            else:
+                for val in value:
+                    lookup[val][ix] = None
+    partials = []
+    for lookup in lookups:
+        empty_ixs = lookup.pop(empty,None)
+        partials.append((dict(lookup),empty_ixs))
+    return partials
+
+def _index_value(lookup,value,ix,empty,new=None):
+    """
+    Add ix to the lookup under value (each element of a list). Values that
+    are new to the lookup are appended to `new` (if not None)
+    """
+    if not isinstance(value,list):
+        value = [value]
+    elif len(value) == 0:
+        lookup[empty][ix] = None # empty list
+        return
+    for val in value:
+        ixs = lookup[val]
+        if new is not None and len(ixs) == 0:
+            new.append(val)
+        ixs[ix] = None
+
+def _unique_index(attribute,values,empty,unique=None):
+    """
+    Add the (value,indices) of a lookup to a unique index of attribute (a 
+    new one if None) and return it. Raises a ValueError for a value with 
+    more than one index
+    """
+    if unique is None:
+        unique = {}
+    for val,ixs in values:
+        if val is None or val is empty or len(ixs) == 0:
+            continue
+        if len(ixs) > 1:
+            raise ValueError("Duplicate value {0!r} of the unique attribute '{1}'".format(val,attribute))
+        unique[val] = next(iter(ixs))
+    return unique
+
+def _picklable(obj):
+    """
+    Whether obj can be pickled
+    """
+    try:
+        pickle.dumps(obj,protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+    return True
+
+def _order_keys(order_by,attributes):
+    """
+    Parse order_by (an attribute or list of them, '-attrib' for descending)
+    into a list of (attrib,reverse)
+    """
+    keys = []
+    for attrib in _makelist(order_by):
+        reverse = attrib.startswith('-') and attrib not in attributes
+        if reverse:
+            attrib = attrib[1:]
+        if attrib not in attributes:
+            raise KeyError("'{:s}' is not an attribute".format(attrib))
+        keys.append((attrib,reverse))
+    return keys
+
+def _sort_key(keys,_list,convert=None,expressions=None):
+    """
+    Return the sort key function of an index into _list for the 
+    (attrib,reverse) keys and whether to reverse the sort. Items are first
+    converted with convert (if not None). Lists are ordered by their 
+    smallest value (largest if reversed) and items without a value 
+    (None or []) are last. Attributes in `expressions` (name: key function)
+    are computed from the items.
+
+    If all of the keys are reversed, the whole sort is reversed rather 
+    than each value
+    """
+    reverse_all = all(reverse for _,reverse in keys)
+    missing = (0,None) if reverse_all else (1,None)
+    present = 1 if reverse_all else 0
+    wrap = not reverse_all and any(reverse for _,reverse in keys)
+    
+    expressions = expressions or {}
+
+    def one(value,reverse):
+        if isinstance(value,list):
+            value = (max if reverse else min)(value) if len(value) > 0 else None
+        if value is None:
+            return missing
+        return (present,_Reverse(value) if wrap and reverse else value)
+
+    if len(keys) == 1: 
+        attrib,reverse = keys[0]
+        get = expressions.get(attrib)
+        def key(ix):
+            item = _list[ix]
+            if convert is not None:
+                item = convert(item)
+            value = item.get(attrib) if get is None else get(item)
+            if value is None or isinstance(value,list):
+                return one(value,reverse)
+            return (present,value)
+    else:
+        getters = [(expressions.get(attrib) or operator.methodcaller('get',attrib),reverse) \
+                        for attrib,reverse in keys]
+        def key(ix):
+            item = _list[ix]
+            if convert is not None:
+                item = convert(item)
+            return [one(get(item),reverse) for get,reverse in getters]
+    return key,reverse_all
+
+def _prefix_range(keys,prefix):
+    """
+    The range [lo,hi) of the sorted keys that start with prefix
+    """
+    lo = bisect_left(keys,prefix)
+    if len(prefix) > 0 and ord(prefix[-1]) < sys.maxunicode:
+        # Everything from prefix up to (not including) the next prefix
+        return lo,bisect_left(keys,prefix[:-1] + _chr(ord(prefix[-1]) + 1),lo)
+    hi = lo
+    while hi < len(keys) and isinstance(keys[hi],_STRING_TYPES) and keys[hi].startswith(prefix):
+        hi += 1
+    return lo,hi
+
+def _trigrams(value):
+    """
+    Set of the 3 character substrings of value
+    """
+    return set(value[i:i+3] for i in range(len(value) - 2))
+
+def _index_trigrams(index,value):
+    """
+    Add a (string) value to a trigram index
+    """
+    if isinstance(value,_STRING_TYPES):
+        for i in range(len(value) - 2):
+            index[value[i:i+3]].add(value)
+
+def _unindex_trigrams(index,value):
+    """
+    Remove a (string) value from a trigram index
+    """
+    if isinstance(value,_STRING_TYPES):
+        for gram in _trigrams(value):
+            values = index.get(gram)
+            if values is None: continue
+            values.discard(value)
+            if len(values) == 0:
+                del index[gram]
+
+def _regex_literals(regex):
+    """
+    Runs of literal text that every match of regex (a pattern or string) 
+    must contain. This is a conservative scan of the pattern: groups, 
+    character classes and escapes other than punctuation are skipped and 
+    nothing is returned for top-level alternation or case-insensitive and
+    verbose patterns
+    """
+    pattern = getattr(regex,'pattern',regex)
+    flags = getattr(regex,'flags',0)
+    if not isinstance(pattern,_STRING_TYPES) or flags & (re.IGNORECASE | re.VERBOSE) \
+            or _INLINE_FLAGS.search(pattern):
+        return []
+    
+    runs,run = [],[]
+    literal = False # Whether the last thing was a literal character in run
+    i,n = 0,len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '\\':
+            c = pattern[i:i+1]
+            i += 1
+            if c and not (c.isalnum() or c == '_'): # Escaped punctuation
+                run.append(c)
+                literal = True
+                continue
+            # Classes, anchors, backreferences, etc. Skip their arguments
+            if c in ('x','u','U'):
+                size = {'x':2,'u':4,'U':8}[c]
+                while size > 0 and i < n and pattern[i] in string.hexdigits:
+                    i,size = i + 1,size - 1
+            elif c.isdigit():
+                while i < n and pattern[i].isdigit():
+                    i += 1
+            elif c == 'N' and pattern[i:i+1] == '{':
+                i = pattern.find('}',i) + 1 or n
+        elif c == '|':
+            return [] # Top-level alternation
+        elif c in '*?{':
+            if literal: # The previous character is optional
+                run.pop()
+            if c == '{':
+                quantifier = _QUANTIFIER.match(pattern,i - 1)
+                if quantifier is None: # A literal '{' (and maybe a '|' after it)
+                    return []
+                i = quantifier.end()
+        elif c in '([':
+            i = _skip_regex_group(pattern,i,c)
+        elif c not in '+.^$)':
+            run.append(c)
+            literal = True
+            continue
+        
+        literal = False
+        if len(run) > 0:
+            runs.append(''.join(run))
+            run = []
+    if len(run) > 0:
+        runs.append(''.join(run))
+    return runs
+
+def _skip_regex_group(pattern,i,opening):
+    """
+    Return the index after the group (or character class) opened just
+    before i in pattern
+    """
+    depth = 1
+    n = len(pattern)
+    if opening == '[': # A leading ^ and then ] are part of the class
+        if pattern[i:i+1] == '^':
+            i += 1
+        if pattern[i:i+1] == ']':
+            i += 1
+    while i < n and depth > 0:
+        c = pattern[i]
+        i += 1
+        if c == '\\':
+            i += 1
+        elif opening == '[':
+            if c == ']':
+                depth = 0
+        elif c == '[':
+            i = _skip_regex_group(pattern,i,'[')
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+    return i
+
+def _always(ix):
+    return True
+
+class _Reverse(object):
+    """
+    Wrap a value to reverse its order (for descending sort keys)
+    """
+    __slots__ = ('value',)
+    def __init__(self,value):
+        self.value = value
+    def __lt__(self,other):
+        return other.value < self.value
+    def __eq__(self,other):
+        return self.value == other.value
+
+def _flatten(items):
+    """
+    Yield the items with nested lists, tuples and generators expanded
+    """
+    for item in items:
+        if isinstance(item,(list,tuple,types.GeneratorType)):
+            for item in _flatten(item):
+                yield item
+        else:
+            yield item
+
+def _chunks(items,size):
+    """
+    Yield lists of up to `size` of the items
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items,size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def _read_rows(path,rows,converters=None):
+    """
+    Yield the dicts of rows(file) from the path (or open file) converted with
+    converters. The file is closed when done (if it was opened)
+    """
+    F = path
+    if not hasattr(path,'read'):
+        F = io.open(path,encoding='utf-8',newline='')
+    try:
+        for n,row in enumerate(rows(F),1):
+            if converters:
+                _coerce(row,converters,n)
+            yield row
+    finally:
+        if F is not path:
+            F.close()
+
+def _jsonl_rows(F):
+    for line in F:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def _csv_rows(F,delimiter=',',converters=None):
+    for row in csv.DictReader(F,delimiter=str(delimiter)):
+        for attrib in (converters or ()): # Empty is None when converted
+            if row.get(attrib) == '':
+                row[attrib] = None
+        yield row
+
+def _coerce(row,converters,n):
+    """
+    Convert the values of row (the nth) with converters (attribute:function)
+    """
+    for attrib,func in converters.items():
+        value = row.get(attrib)
+        if value is None:
+            continue
+        try:
+            row[attrib] = func(value)
+        except (TypeError,ValueError):
+            raise ValueError('Row {0}: Could not convert {1} {2!r}'.format(n,attrib,value))
+
+def _read_journal(path):
+    """
+    Yield the (end offset,record) of each complete record in the journal.
+    Stops at the first incomplete or corrupt record
+    """
+    with open(path,'rb') as F:
+        end = 0
+        while True:
+            head = F.read(8)
+            if len(head) < 8:
+                return
+            size,crc = struct.unpack('<II',head)
+            data = F.read(size)
+            if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+                return
+            try:
+                record = pickle.loads(data)
+            except Exception:
+                return
+            end += 8 + size
+            yield end,record
+
+def _align(offset,alignment=64):
+    """
+    Round offset up to the alignment
+    """
+    return -(-offset // alignment) * alignment
+
+_replace = getattr(os,'replace',os.rename) # Python 2 does not have os.replace
+
+def _freeze(value):
+    """
+    Hashable version of a query value. Lists (which are expanded) are kept 
+    distinct from tuples (which are values)
+    """
+    if isinstance(value,list):
+        return (list,tuple(_freeze(val) for val in value))
+    return value
+
+def _intersect(postings):
+    """
+    Return a list of the indices in all of the posting lists (anything that
+    supports len(), iteration and `in`). 
+    
+    The smallest is iterated and the others are only probed so the cost
+    is the length of the smallest, not of the largest. Bitmaps are first 
+    combined with each other and if there is nothing else, a _Bitmap is 
+    returned
+    """
+    bitmaps = [ixs for ixs in postings if isinstance(ixs,_Bitmap)]
+    if len(bitmaps) > 0:
+        bitmap = bitmaps[0]
+        for ixs in bitmaps[1:]:
+            bitmap = bitmap & ixs
+        if len(bitmaps) == len(postings):
+            return bitmap.copy() if len(bitmaps) == 1 else bitmap
+        postings = [ixs for ixs in postings if not isinstance(ixs,_Bitmap)]
+        postings.append(bitmap)
+    
+    postings = sorted(postings,key=len)
+    smallest,rest = postings[0],postings[1:]
+    if len(rest) == 0:
+        return list(smallest)
+    return [ix for ix in smallest if all(ix in ixs for ixs in rest)]
+
+def _and(A,B):
+    """
+    Intersection of two sets of indices (set or _Bitmap)
+    """
+    if isinstance(A,_Bitmap) and isinstance(B,_Bitmap):
+        return A & B
+    if isinstance(A,_Bitmap): # Iterate the set, probe the bitmap
+        A,B = B,A
+    if isinstance(B,_Bitmap):
+        return set(ix for ix in A if ix in B)
+    return A.intersection(B)
+
+def _or(A,B):
+    """
+    Union of two sets of indices (set or _Bitmap)
+    """
+    if isinstance(A,_Bitmap) and isinstance(B,_Bitmap):
+        return A | B
+    if isinstance(A,_Bitmap):
+        A,B = B,A
+    return A.union(B)
+
+def _sub(A,B):
+    """
+    Difference of two sets of indices (set or _Bitmap)
+    """
+    if isinstance(A,_Bitmap):
+        if isinstance(B,_Bitmap):
+            return A - B
+        A = A.copy()
+        for ix in B:
+            A.discard(ix)
+        return A
+    return set(ix for ix in A if ix not in B)
+
+def _popcount(word):
+    return bin(word).count('1')
+
+class _Bitmap(object):
+    """
+    Compressed set of non-negative integers (roaring-style). The integers
+    are split into chunks of 2**_CHUNK_BITS and each non-empty chunk is
+    stored as a Python int with the bits of its members set. 
+    
+    Supports the set operations used in queries (&, |, -) a chunk at a time
+    as well as the dict methods used on the posting lists (b[ix] = None, 
+    del b[ix], fromkeys) so it can be used in their place.
+    """
+    __slots__ = ('_chunks','_len')
+    
+    def __init__(self,ixs=()):
+        self._chunks = {}
+        self._len = 0
+        if isinstance(ixs,_Bitmap):
+            self._chunks = dict(ixs._chunks)
+            self._len = ixs._len
+            return
+        for ix in ixs:
+            self.add(ix)
+    
+    @classmethod
+    def fromkeys(cls,ixs):
+        return cls(ixs)
+    
+    def add(self,ix):
+        chunk,bit = ix >> _CHUNK_BITS, 1 << (ix & _CHUNK_MASK)
+        word = self._chunks.get(chunk,0)
+        if not word & bit:
+            self._chunks[chunk] = word | bit
+            if self._len is not None:
+                self._len += 1
+    
+    def discard(self,ix):
+        chunk,bit = ix >> _CHUNK_BITS, 1 << (ix & _CHUNK_MASK)
+        word = self._chunks.get(chunk,0)
+        if word & bit:
+            word ^= bit
+            if word:
+                self._chunks[chunk] = word
             else:
-                raise ValueError('unrecognized input of type {:s}'.format(str(type(arg))))
-        
-        # Construct a query for kwords
-        for key,value in kwords.items():
-            if isinstance(value,list) and len(value) == 0:
-                value = [self._empty]
-            for val in _makelist(value):
-                Qtmp = Qobj(self)
-                Qtmp._attr = key
-                Q = Q & (Qtmp == val)
-
-        ixs = Q._ixs
-        # Ensure one match
-        if ixs is None: 
-            ixs = []
-        return list(ixs)        
-        
+                del self._chunks[chunk]
+            if self._len is not None:
+                self._len -= 1
+            return True
+        return False
     
-    def _index(self,ix):
-        """
-        Return ix if it hasn't been deleted
-        """
-        try:
-            item = self._list[ix]
-        except IndexError:
-            return []
-        
-        if item is None:
-            return []
-        
-        return [ix]
+    def __setitem__(self,ix,_):
+        self.add(ix)
     
-    def _append(self,attrib,value,ix):
-        """
-        Add to the lookup and update the modify time
-        """
-        # Final check but we should be guarded from this
-        if attrib in self.exclude_attributes:
-            print('BAD! Should guard against this in public methods!')
-            raise ValueError('Cannot reindex an excluded attribute') 
-        
-        valueL = _makelist(value)
-        for val in valueL: 
-            self._lookup[attrib][val].append(ix)
-        if len(valueL) == 0:
-            self._lookup[attrib][self._empty].append(ix) # empty list
-        self._time = time.time()
+    def __delitem__(self,ix):
+        if not self.discard(ix):
+            raise KeyError(ix)
     
-    def _remove(self,attrib,value,ix):
-        """
-        Remove from the lookup and update the modify time
-        """
-        
-        valueL = _makelist(value)
-        for val in valueL: 
-            self._lookup[attrib][val].remove(ix)
-        if len(valueL) == 0:
-            self._lookup[attrib][self._empty].remove(ix) # empty list
+    def update(self,other):
+        if not isinstance(other,_Bitmap):
+            for ix in other:
+                self.add(ix)
+            return
+        chunks = self._chunks
+        for chunk,word in other._chunks.items():
+            chunks[chunk] = chunks.get(chunk,0) | word
+        self._len = None
     
-        self._time = time.time()
+    def copy(self):
+        return _Bitmap(self)
+    
+    def __contains__(self,ix):
+        return (self._chunks.get(ix >> _CHUNK_BITS,0) >> (ix & _CHUNK_MASK)) & 1 == 1
     
-    def __contains__(self,check_diff):
-        check_diff = self._convert2dict(check_diff)
-        if not ( isinstance(check_diff,dict) or isinstance(check_diff,Qobj)):
-            raise ValueError('Python `in` queries should be a of {attribute:value} or Qobj')
-        return self.isin(check_diff)
-
     def __len__(self):
-        return self.N
-
-    def __getitem__(self,item):
-        item = self._convert2dict(item)
-        if isinstance(item,dict) or isinstance(item,Qobj):
-            return self.query(item)
-        elif isinstance(item,int): # numbered item
-            if self._list[item] is not None:
-                return self._list[item]
-            else:
-                raise ValueError("Index has been deleted")
-        else:
-            raise ValueError("Must specify DB[{'attribute':val}] or DB[index]'")
-    __call__ = query
+        if self._len is None:
+            self._len = sum(_popcount(word) for word in self._chunks.values())
+        return self._len
     
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        while self._i < len(self._list):
-            self._i += 1 # Increment it but then search back
-            if self._list[self._i-1] is not None:
-                return self._list[self._i-1]
-        raise StopIteration()
-    next = __next__ # For compatability
+        for chunk in sorted(self._chunks):
+            word = self._chunks[chunk]
+            base = chunk << _CHUNK_BITS
+            while word:
+                low = word & -word
+                yield base + low.bit_length() - 1
+                word ^= low
     
+    def __eq__(self,other):
+        if isinstance(other,_Bitmap):
+            return self._chunks == other._chunks
+        return set(self) == set(other)
     
-def _makelist(input):
-    if isinstance(input,list):
-        return input
-    return [input] 
+    def __ne__(self,other):
+        return not self == other
+    
+    __hash__ = None
+    
+    def _new(self,chunks):
+        new = _Bitmap()
+        new._chunks = chunks
+        new._len = None
+        return new
+    
+    def __and__(self,other):
+        A,B = self._chunks,other._chunks
+        if len(A) > len(B):
+            A,B = B,A
+        chunks = {}
+        for chunk,word in A.items():
+            word &= B.get(chunk,0)
+            if word:
+                chunks[chunk] = word
+        return self._new(chunks)
+    
+    def __or__(self,other):
+        new = self.copy()
+        new.update(other)
+        return new
+    
+    def __sub__(self,other):
+        B = other._chunks
+        chunks = {}
+        for chunk,word in self._chunks.items():
+            word &= ~B.get(chunk,0)
+            if word:
+                chunks[chunk] = word
+        return self._new(chunks)
+    
+    def __repr__(self):
+        return '_Bitmap({0})'.format(list(self))
 
 class _emptyList(object):
     def __init__(self):
@@ -625,24 +3305,86 @@ class Qobj(object):
     
     Calling 
         * Q.attribute sets attribute
-        * Q.attribute == val (or any other comparison) set the index of elements
-        * Q1 & Q1 or other boolean perform set operations
+        * Q.attribute == val (or any other comparison) creates a condition
+        * Q1 & Q1 or other boolean combine conditions
+    
+    Qobjs are never modified so they may be reused. They are also not 
+    evaluated until used in a query. Equality conditions that are and-ed 
+    together are intersected first and anything else is only checked against
+    what remains.
         
     Useful Methods:
         _filter : (or just `filter` if not an attribute): Apply a filter
                   to the DB
+        _between: (or just `between` if not an attribute): Inclusive range
+                  query. Q.attrib.between(low,high)
+        _startswith: (or just `startswith` if not an attribute): Prefix 
+                  query. Q.attrib.startswith(prefix)
+        _contains: (or just `contains` if not an attribute): Substring 
+                  query. Q.attrib.contains(text)
+        _matches: (or just `matches` if not an attribute): Regex query 
+                  (re.search). Q.attrib.matches(regex)
+        _vfilter: (or just `vfilter` if not an attribute): Vectorized filter
+                  on column attributes
     """
-    def __init__(self,DB,ixs=None,attr=None):
+    def __init__(self,DB,ixs=None,attr=None,op=None,args=()):
         self._DB = DB
-        self._ixs = ixs
         self._attr = attr
         
-        self._time = time.time()
+        if ixs is not None:
+            op,args = 'ixs',(ixs,)
+        self._op = op       # None is an incomplete query
+        self._args = args
+        
+        # The result once evaluated (without `within`) and the DB time
+        # (modification count) of it
+        self._result = None 
+        self._result_time = None
+        
+        self._time = DB._time
         
     
     def _valid(self):
         if self._time < self._DB._time:
-            raise ValueError('This query object is out of date from the DB. Create a new one')
+            # Conditions do not depend on the DB so, in threadsafe mode where
+            # another thread may change it at any time, only indices expire
+            if self._DB._lock is None or self._has_ixs():
+                raise ValueError('This query object is out of date from the DB. Create a new one')
+    
+    def _has_ixs(self):
+        """
+        Whether the query includes indices
+        """
+        if self._op == 'ixs':
+            return True
+        return self._op in ('and','or','not') and any(Q._has_ixs() for Q in self._args)
+    
+    def _new(self,op,*args):
+        """
+        New condition on this attribute
+        """
+        self._valid() # Actually, these would still work but still check
+        new = Qobj(self._DB,attr=self._attr,op=op,args=args)
+        new._time = self._time
+        return new
+    
+    def _combine(self,op,*Qs):
+        """
+        New condition from this and other Qobjs
+        """
+        Qs = (self,) + Qs
+        new = Qobj(self._DB,op=op,args=Qs)
+        new._time = min(Q._time for Q in Qs)
+        return new
+    
+    @property
+    def _ixs(self):
+        """
+        Set of matching indices. None if the query is incomplete
+        """
+        if self._op is None:
+            return None
+        return self._evaluate()
     
     def _filter(self,filter_func):
         """
@@ -653,146 +3395,497 @@ class Qobj(object):
         Apply a filter to the data that returns True if it matches and False 
         otherwise
         
-        Note that filters are O(N)
+        Note that filters are O(N) unless and-ed with equality conditions in
+        which case, only the items matching those are filtered
         """
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if filter_func(item):
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
-         
-            
-    # Comparisons   
-    def __eq__(self,value):
-        self._valid()
+        return self._new('filter',filter_func)
+    
+    def _vfilter(self,filter_func):
+        """
+        If 'vfilter' is NOT an attribute of the DB, this can be called 
+        with 'vfilter' instead of '_vfilter'
         
-        if self._DB.N == 0:
-            self._ixs = set()
-            return self.copy()
+        Apply a vectorized filter to the column attributes (see 
+        list_dict_DB.add_column_index()). filter_func is called with a dict 
+        of {attribute: NumPy array} and must return a boolean array. 
         
-        first_set = True
-        for val in _makelist(value): # Account for list inputs
-            if self._attr == '_index':
-                if first_set:
-                    ixs = set(self._DB._index(val))
-                    first_set = False
-                else:
-                    ixs = ixs.intersection(self._DB._index(val))
-                continue
-            if self._attr not in self._DB.attributes:
-                raise KeyError("'{:s}' is not an attribute".format(self._attr))
-                
-            ixs_at = self._DB._lookup[self._attr][val]
-            if first_set:
-                ixs = set(ixs_at)
-                first_set = False
-            else:
-                ixs = ixs.intersection(ixs_at)
+        >>> DB.query(Q.vfilter(lambda c: c['price']*c['qty'] > 1000))
+        
+        Items missing any of the values used never match
+        """
+        return self._new('vfilter',filter_func)
+    
+    def _startswith(self,prefix):
+        """
+        If 'startswith' is NOT an attribute of the DB, this can be called 
+        with 'startswith' instead of '_startswith'
+        
+        Match items where the (string) value starts with prefix. With a 
+        sorted index, the matching values are a contiguous range of it so
+        this is O(log N + k). Otherwise it is O(N)
+        
+        >>> DB.query(Q.path.startswith('/usr/'),order_by='path',limit=10)
+        """
+        return self._new('startswith',prefix)
+    
+    def _contains(self,text):
+        """
+        If 'contains' is NOT an attribute of the DB, this can be called 
+        with 'contains' instead of '_contains'
+        
+        Match items where the (string) value contains text. With a trigram
+        index (see list_dict_DB.add_trigram_index()), only the values with 
+        all of the trigrams of text are checked. Otherwise it is O(N)
+        
+        >>> DB.query(Q.message.contains('timed out'))
+        """
+        return self._new('contains',text)
+    
+    def _matches(self,regex):
+        """
+        If 'matches' is NOT an attribute of the DB, this can be called 
+        with 'matches' instead of '_matches'
+        
+        Match items where the regex (a string or compiled pattern) matches
+        somewhere in the (string) value (re.search). With a trigram index, 
+        only the values with the literal text that any match must contain 
+        are checked. Otherwise it is O(N)
+        
+        >>> DB.query(Q.message.matches(r'^GET /api/v\\d+/users'))
+        """
+        return self._new('matches',re.compile(regex))
+    
+    def _between(self,low,high):
+        """
+        If 'between' is NOT an attribute of the DB, this can be called 
+        with 'between' instead of '_between'
         
-        self._ixs = ixs
-        return self.copy()
+        Match items where low <= value <= high. Like `<` and the other 
+        comparisons, this is O(log N + k) if the attribute has a sorted index
+        and O(N) otherwise
+        """
+        return self._new('between',low,high)
+            
+    # Comparisons   
+    def __eq__(self,value):
+        return self._new('eq',value)
      
     def __ne__(self,value):
-        self._ixs = self._DB._ix - (self == value)._ixs
-        return self.copy()
+        return ~(self == value)
     
     def __lt__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item) 
-            if item is None:
-                continue
-            for ival in _makelist(item[self._attr]):
-                if ival < value:
-                    ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new('lt',value)
 
     def __le__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if item[self._attr] <= value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new('le',value)
         
     def __gt__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if item[self._attr] > value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new('gt',value)
     
     def __ge__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            item = self._DB._convert2dict(item)
-            if item is None:
-                continue
-            if item[self._attr] >= value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self.copy()
+        return self._new('ge',value)
     
     # Logic
     def __and__(self,Q2):               
-        if self._ixs == None:  # An empty object and another will just return other
+        if self._op is None:  # An empty object and another will just return other
             return Q2
-        self._ixs.intersection_update(Q2._ixs)
-        return self.copy()
+        if Q2._op is None:
+            return self
+        return self._combine('and',Q2)
+    
     def __or__(self,Q2):               
-        self._ixs.update(Q2._ixs)
-        return self.copy()
+        if self._op is None:
+            return Q2
+        if Q2._op is None:
+            return self
+        return self._combine('or',Q2)
+    
     def __invert__(self):
-        self._ixs = self._DB._ix - self._ixs
-        return self.copy()
+        if self._op is None:
+            raise ValueError('Cannot negate an incomplete query')
+        if self._op == 'not':
+            return self._args[0]
+        return self._combine('not')
     
     def __getattr__(self,attr):
+        if attr.startswith('__'): # Do not confuse copy, pickle, etc
+            raise AttributeError(attr)
         if attr == 'filter' and 'filter' not in self._DB.attributes:
             return self._filter
-        self._attr = attr
-        return self.copy()
+        if attr == 'between' and 'between' not in self._DB.attributes:
+            return self._between
+        if attr == 'vfilter' and 'vfilter' not in self._DB.attributes:
+            return self._vfilter
+        if attr == 'startswith' and 'startswith' not in self._DB.attributes:
+            return self._startswith
+        if attr == 'contains' and 'contains' not in self._DB.attributes:
+            return self._contains
+        if attr == 'matches' and 'matches' not in self._DB.attributes:
+            return self._matches
+        new = Qobj(self._DB,attr=attr)
+        new._time = self._time
+        return new
     
     def copy(self):
-        new = Qobj(self._DB,ixs=self._ixs,attr=self._attr)
+        new = Qobj(self._DB,attr=self._attr,op=self._op,args=self._args)
         # Reset the time
         new._time = self._time
         return new
     
+    # Evaluation
+    def _conjuncts(self):
+        """
+        List of the (complete) conditions that are and-ed together
+        """
+        if self._op == 'and':
+            return self._args[0]._conjuncts() + self._args[1]._conjuncts()
+        if self._op is None:
+            return []
+        return [self]
     
+    def _cost(self):
+        """
+        Rough rank of how expensive it is to evaluate this condition
+        """
+        if self._op in ('eq','ixs'):
+            return 0
+        if self._op in _TEXT_OPS:
+            return 1 if self._attr in self._DB._trigrams else 3
+        if self._op in _COMPARE and (self._attr in self._DB._sorted \
+                                     or self._op in _NP_COMPARE and self._attr in self._DB._columns):
+            return 1
+        if self._op == 'vfilter':
+            return 1
+        if self._op in ('and','or','not'):
+            return 2
+        return 3 # Scans
     
+    def _evaluate(self,within=None):
+        """
+        Return the set of matching indices. If `within` (a set) is given, only
+        those indices are considered. 
+        
+        The result without `within` is kept until the DB is changed so a 
+        reused Qobj is only evaluated once
+        """
+        self._valid()
+        DB = self._DB
+        
+        if self._result_time == DB._time:
+            if within is None:
+                return self._result
+            return _and(within,self._result)
+        
+        op,args = self._op,self._args
+        if op is None or DB.N == 0:
+            ixs = set()
+        elif op == 'ixs':
+            ixs = set(args[0]) if within is None else _and(within,args[0])
+        elif op == 'eq':
+            postings = DB._postings(self._attr,args[0])
+            if within is not None:
+                postings.append(within)
+            ixs = _intersect(postings)
+            if isinstance(ixs,list):
+                ixs = set(ixs)
+        elif op == 'and':
+            ixs = DB._match([self],within=within)
+        elif op == 'or':
+            ixs = args[0]._evaluate(within)
+            for Q in args[1:]:
+                ixs = _or(ixs,Q._evaluate(within))
+        elif op == 'not':
+            base = DB._ix if within is None else within
+            ixs = _sub(base,args[0]._evaluate(within))
+        elif op == 'filter':
+            ixs = self._scan(args[0],within)
+        elif op == 'vfilter':
+            ixs = _ColumnView(DB._columns,len(DB._list)).mask(args[0],within)
+        else:
+            ixs = self._compare(op,args,within)
+        
+        if within is None:
+            self._result,self._result_time = ixs,DB._time
+        return ixs
     
+    def _test(self,ix):
+        """
+        Whether the item at ix matches. Used to check candidates one at a time
+        """
+        DB = self._DB
+        if self._result_time == DB._time:
+            return ix in self._result
+        
+        op,args = self._op,self._args
+        if op is None:
+            return False
+        if op == 'eq':
+            return all(ix in ixs for ixs in DB._postings(self._attr,args[0]))
+        if op == 'ixs':
+            return ix in args[0]
+        if op == 'and':
+            return all(Q._test(ix) for Q in args)
+        if op == 'or':
+            return any(Q._test(ix) for Q in args)
+        if op == 'not':
+            return ix in DB._ix and not args[0]._test(ix)
+        if op == 'vfilter':
+            return len(_ColumnView(DB._columns,len(DB._list)).mask(args[0],[ix])) > 0
+        if op in _NP_COMPARE and self._attr in DB._columns:
+            return len(DB._columns[self._attr].compare(op,args,[ix])) > 0
+        
+        item = DB._convert2dict(DB._list[ix])
+        if item is None:
+            return False
+        if op == 'filter':
+            return bool(args[0](item))
+        test = _COMPARE[op]
+        return any(test(val,*args) for val in _makelist(DB._value(item,self._attr)))
     
+    def _compare(self,op,args,within):
+        """
+        Evaluate comparisons with the sorted (or trigram) index if there is
+        one or by scanning. Lists match if any of their elements do.
+        """
+        if op in _TEXT_OPS:
+            keys = None
+            if self._attr in self._DB._trigrams:
+                return self._from_trigrams(within)
+        else:
+            keys = self._DB._sorted.get(self._attr)
+        column = self._DB._columns.get(self._attr) if op in _NP_COMPARE else None
+        if keys is None and column is not None:
+            return column.compare(op,args,within)
+        
+        if keys is None:
+            test = _COMPARE[op]
+            attr,value = self._attr,self._DB._value
+            return self._scan(lambda item: any(test(val,*args) \
+                                    for val in _makelist(value(item,attr))),within)
+        
+        ixs = self._from_sorted(*self._sorted_range(keys))
+        if within is not None:
+            ixs = _and(ixs,within)
+        return ixs
     
+    def _sorted_range(self,keys):
+        """
+        The range [lo,hi) of the sorted values (keys) that match this 
+        comparison. hi may be None for the end
+        """
+        op,args = self._op,self._args
+        if op == 'lt':
+            return 0,bisect_left(keys,args[0])
+        if op == 'le':
+            return 0,bisect_right(keys,args[0])
+        if op == 'gt':
+            return bisect_right(keys,args[0]),None
+        if op == 'ge':
+            return bisect_left(keys,args[0]),None
+        if op == 'startswith':
+            return _prefix_range(keys,args[0])
+        return bisect_left(keys,args[0]),bisect_right(keys,args[1]) # between
     
+    def _from_sorted(self,lo,hi):
+        """
+        Return the indices of the sorted values keys[lo:hi]
+        """
+        ixs = _Bitmap() if self._attr in self._DB._bitmaps else set()
+        for val in self._DB._sorted[self._attr][lo:hi]:
+            ixs.update(self._DB._lookup[self._attr][val])
+        return ixs
     
+    def _from_trigrams(self,within=None):
+        """
+        Return the indices of the contains() or matches() condition using 
+        the trigram index. Only the values with every trigram of the 
+        literal text are checked (all of the string values if there are 
+        none), starting from the rarest trigram
+        """
+        DB = self._DB
+        op,args = self._op,self._args
+        lookup = DB._lookup[self._attr]
+        index = DB._trigrams[self._attr]
+        
+        literals = [args[0]] if op == 'contains' else _regex_literals(args[0])
+        grams = set()
+        for literal in literals:
+            if isinstance(literal,_STRING_TYPES):
+                grams.update(_trigrams(literal))
+        
+        if len(grams) > 0:
+            candidates = sorted((index.get(gram,()) for gram in grams),key=len)
+            values = set(candidates[0])
+            for other in candidates[1:]:
+                if len(values) == 0:
+                    break
+                values.intersection_update(other)
+        else:
+            values = [val for val in lookup if isinstance(val,_STRING_TYPES)]
+        
+        test = _COMPARE[op]
+        ixs = _Bitmap() if self._attr in DB._bitmaps else set()
+        for val in values:
+            if test(val,*args):
+                ixs.update(lookup[val])
+        if within is not None:
+            ixs = _and(ixs,within)
+        return ixs
     
+    def _scan(self,func,within=None):
+        """
+        Return the indices of items (all or those `within`) where func(item)
+        """
+        DB = self._DB
+        ixs = set()
+        for ix in (range(len(DB._list)) if within is None else within): 
+            item = DB._convert2dict(DB._list[ix])
+            if item is None:
+                continue
+            if func(item):
+                ixs.add(ix)
+        return ixs
+
+class _Column(object):
+    """
+    NumPy array of the values of a numeric attribute aligned with the item
+    indices along with a mask of which are valid (not missing or removed).
+    The arrays are over-allocated so they can be appended to.
+    """
+    def __init__(self,attribute,dtype,size=0):
+        self.attribute = attribute
+        self.values = np.zeros(max(size,16),dtype=dtype)
+        self.valid = np.zeros(len(self.values),dtype=bool)
     
+    def reserve(self,size):
+        """
+        Make sure there is room for `size` items
+        """
+        if size <= len(self.values):
+            return
+        size = max(2*len(self.values),size)
+        values = np.zeros(size,dtype=self.values.dtype)
+        values[:len(self.values)] = self.values
+        valid = np.zeros(size,dtype=bool)
+        valid[:len(self.valid)] = self.valid
+        self.values,self.valid = values,valid
     
+    def check(self,value):
+        """
+        Raise a TypeError if value can not be set (before changing anything)
+        """
+        if value is None:
+            return
+        try:
+            np.empty(1,dtype=self.values.dtype)[0] = value
+        except (TypeError,ValueError):
+            raise TypeError("Column attribute '{0}' must be numeric. Got {1!r}".format(
+                                self.attribute,value))
     
+    def set(self,ix,value):
+        self.reserve(ix + 1)
+        if value is None:
+            self.valid[ix] = False
+            return
+        try:
+            self.values[ix] = value
+        except (TypeError,ValueError):
+            raise TypeError("Column attribute '{0}' must be numeric. Got {1!r}".format(
+                                self.attribute,value))
+        self.valid[ix] = True
     
+    def unset(self,ix):
+        if ix < len(self.valid):
+            self.valid[ix] = False
     
+    def clear(self):
+        self.valid[:] = False
     
+    def take(self,ixs):
+        """
+        Keep only ixs (renumbered in order)
+        """
+        ixs = np.array(ixs,dtype=np.intp)
+        ixs = ixs[ixs < len(self.values)]
+        self.values = self.values[ixs]
+        self.valid = self.valid[ixs]
     
+    def compare(self,op,args,within=None):
+        """
+        Set of the valid indices (all or `within`) matching the comparison
+        """
+        if within is None:
+            values,valid,ixs = self.values,self.valid,None
+        else:
+            ixs = np.fromiter(within,dtype=np.intp,count=len(within))
+            ixs = ixs[ixs < len(self.values)]
+            values,valid = self.values[ixs],self.valid[ixs]
+        
+        if op == 'between':
+            mask = (values >= args[0]) & (values <= args[1])
+        else:
+            mask = _NP_COMPARE[op](values,args[0])
+        mask &= valid
+        
+        if ixs is None:
+            return set(np.flatnonzero(mask).tolist())
+        return set(ixs[mask].tolist())
+
+class _ColumnView(object):
+    """
+    Dict-like access to the column arrays for vectorized filters that keeps
+    track of which columns were used
+    """
+    def __init__(self,columns,size):
+        self._columns = columns
+        self._size = size
+        self._used = []
+        self._ixs = None
     
+    def __getitem__(self,attribute):
+        column = self._columns[attribute]
+        column.reserve(self._size)
+        self._used.append(column)
+        if self._ixs is None:
+            return column.values[:self._size]
+        return column.values[self._ixs]
     
-    
-    
-    
-    
+    def mask(self,filter_func,within=None):
+        """
+        Set of the indices (all or `within`) where filter_func is True and 
+        all of the columns it used are valid
+        """
+        if within is not None:
+            self._ixs = np.fromiter(within,dtype=np.intp,count=len(within))
+        
+        mask = np.array(filter_func(self),dtype=bool) # copy
+        
+        if self._ixs is None:
+            for column in self._used:
+                mask &= column.valid[:self._size]
+            return set(np.flatnonzero(mask).tolist())
+        
+        for column in self._used:
+            mask &= column.valid[self._ixs]
+        return set(self._ixs[mask].tolist())
+
+_NP_COMPARE = { # Also the comparisons that use column indices
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'between': None, # Handled in _Column.compare()
+}
+
+_COMPARE = {
+    'lt': lambda val,value: val < value,
+    'le': lambda val,value: val <= value,
+    'gt': lambda val,value: val > value,
+    'ge': lambda val,value: val >= value,
+    'between': lambda val,low,high: low <= val <= high,
+    'startswith': lambda val,prefix: isinstance(val,_STRING_TYPES) and val.startswith(prefix),
+    'contains': lambda val,text: isinstance(val,_STRING_TYPES) and text in val,
+    'matches': lambda val,regex: isinstance(val,_STRING_TYPES) and regex.search(val) is not None,
+}
+
+_TEXT_OPS = ('contains','matches') # Use trigram indices rather than sorted
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+"""
+asyncio front end to list_dict_DB. Python 3.5+ only (the rest of
+list_dict_DB also supports Python 2)
+"""
+import asyncio
+import heapq
+import itertools
+import types
+from collections import defaultdict
+
+from list_dict_DB import list_dict_DB,_Column,_chunks,_flatten,_read_rows, \
+                         _jsonl_rows,_csv_rows,_posting,_index_trigrams,_unique_index,Qobj
+
+def _sync(name):
+    """
+    Method that calls the DB's method directly
+    """
+    def method(self,*A,**K):
+        return getattr(self.DB,name)(*A,**K)
+    method.__name__ = name
+    method.__doc__ = getattr(list_dict_DB,name).__doc__
+    return method
+
+class AsyncListDictDB(object):
+    """
+    asyncio front end to a list_dict_DB so that heavy operations do not
+    block the event loop.
+
+    Queries (and other reads) are the same as the DB's and are synchronous
+    since they are fast. Changes are coroutines that run one at a time. The
+    heavy ones work in chunks of `chunksize` items and yield to the event
+    loop in between:
+
+        * reindex() and add_attribute() build the new lookups on the side
+          (queries keep using the current ones) and then swap them in
+        * add_items(), from_jsonl() and from_csv() add the items a chunk at
+          a time (queries may see part of them)
+        * scan() runs a query a chunk of items at a time (for filters and
+          other O(N) queries)
+        * Sorted indexes are sorted in chunks and then merged. Trigram
+          indexes are also built in chunks
+        * save() and load() run in the executor
+
+    Inputs:
+    -------
+    DB [None] (list_dict_DB)
+        The DB. If None, a new one is created with **kwargs
+
+    chunksize [1000] (int)
+        Number of items to process before yielding to the event loop. Smaller
+        keeps latency lower but is slower overall
+
+    executor [None] (concurrent.futures.Executor)
+        Executor for save() and load(). None is the loop's default
+
+    Usage
+    -----
+    >>> ADB = AsyncListDictDB(list_dict_DB(items))
+    >>> ADB.query(first='George')       # Same as the DB
+    >>> await ADB.add({'first':'Pete','last':'Best'})
+    >>> await ADB.reindex('first')
+    >>> await ADB.scan(ADB.Q().filter(func))
+
+    Notes:
+    ------
+        * The DB should only be changed through this while it is in use.
+          The DB is available as ADB.DB
+        * Use within a single event loop (thread). For multiple threads, see
+          the `threadsafe` option of list_dict_DB
+    """
+    def __init__(self,DB=None,chunksize=1000,executor=None,**kwargs):
+        if DB is None:
+            DB = list_dict_DB(**kwargs)
+        self.DB = DB
+        self.chunksize = chunksize
+        self.executor = executor
+        self._write_lock = None # Created in the loop
+
+    query = _sync('query')
+    iquery = _sync('iquery')
+    isin = _sync('isin')
+    exists = _sync('exists')
+    count = _sync('count')
+    get = _sync('get')
+    value_counts = _sync('value_counts')
+    group_by = _sync('group_by')
+    column = _sync('column')
+    items = _sync('items')
+    iteritems = _sync('iteritems')
+    cache_info = _sync('cache_info')
+    Qobj = _sync('Qobj')
+    Q = _sync('Q')
+
+    def __len__(self):
+        return len(self.DB)
+
+    def __contains__(self,check_diff):
+        return check_diff in self.DB
+
+    def __getitem__(self,item):
+        return self.DB[item]
+
+    def __iter__(self):
+        return iter(self.DB)
+
+    async def add(self,item):
+        """
+        Add an item (or items). See list_dict_DB.add() and add_items()
+        """
+        if isinstance(item,(list,tuple,types.GeneratorType)):
+            return await self.add_items(item)
+        async with self._lock():
+            self.DB.add(item)
+
+    async def add_items(self,items):
+        """
+        Add the items a chunk at a time. See list_dict_DB.add_items()
+        """
+        async with self._lock():
+            for chunk in _chunks(_flatten(items),self.chunksize):
+                self.DB.add_items(chunk)
+                await asyncio.sleep(0)
+
+    async def update(self,*args,**queryKWs):
+        """
+        See list_dict_DB.update()
+        """
+        async with self._lock():
+            self.DB.update(*args,**queryKWs)
+
+    async def remove(self,*A,**K):
+        """
+        See list_dict_DB.remove()
+        """
+        async with self._lock():
+            self.DB.remove(*A,**K)
+
+    async def reindex(self,*attributes):
+        """
+        Reindex the attributes (or all). The new lookups are built a chunk at
+        a time and then swapped in so that queries still use the current
+        ones until it is done. See list_dict_DB.reindex()
+        """
+        DB = self.DB
+        async with self._lock():
+            if len(attributes) == 0:
+                attributes = [attr for attr in DB.attributes \
+                                if attr not in DB.exclude_attributes]
+                attributes.extend(DB._expressions)
+            elif any(attr in DB.exclude_attributes for attr in attributes):
+                raise ValueError('Cannot reindex an excluded attribute')
+            if not hasattr(DB,'_lookup'):
+                return
+
+            lookups = {attr:DB._new_lookup(attr) for attr in attributes}
+            columns = {attr:_Column(attr,DB._columns[attr].values.dtype,len(DB._list)) \
+                            for attr in attributes if attr in DB._columns}
+
+            for ixs in self._ranges():
+                for ix in ixs:
+                    item = DB._list[ix]
+                    if item is None: continue
+                    item = DB._convert2dict(item)
+                    for attr,lookup in lookups.items():
+                        _index(DB,lookup,columns.get(attr),DB._value(item,attr),ix)
+                await asyncio.sleep(0)
+
+            sorted_values,trigrams,uniques = {},{},{}
+            for attr in attributes:
+                if attr in DB._sorted:
+                    sorted_values[attr] = await self._sort(DB,lookups[attr])
+                if attr in DB._trigrams:
+                    trigrams[attr] = await self._trigrams(lookups[attr])
+                if attr in DB._unique: # Raises before swapping if not unique
+                    uniques[attr] = await self._unique(DB,attr,lookups[attr])
+            composites = {}
+            for composite in list(DB._composite):
+                if any(attr in attributes for attr in composite):
+                    composites[composite] = await self._composite_lookup(composite,DB.attributes)
+
+            # Swap them in and then free the old ones
+            old = [DB._lookup.get(attr) for attr in lookups]
+            old += [DB._sorted[attr] for attr in sorted_values]
+            old += [DB._trigrams[attr] for attr in trigrams]
+            old += [DB._unique[attr] for attr in uniques]
+            old += [DB._composite[composite] for composite in composites]
+            DB._lookup.update(lookups)
+            DB._columns.update(columns)
+            DB._sorted.update(sorted_values)
+            DB._trigrams.update(trigrams)
+            DB._unique.update(uniques)
+            DB._composite.update(composites)
+            DB._modified()
+            del lookups,sorted_values,trigrams,uniques,composites
+            await self._free(old)
+
+    async def add_attribute(self,attribute,*default):
+        """
+        Add an attribute to the index attributes. The lookup is built a
+        chunk at a time and then added. See list_dict_DB.add_attribute()
+        """
+        DB = self.DB
+        async with self._lock():
+            if attribute in DB.exclude_attributes:
+                raise ValueError("Can't add exclude_attributes")
+            if attribute in DB._expressions:
+                raise ValueError("'{:s}' is the name of an expression index".format(attribute))
+            if not hasattr(DB,'_lookup'):
+                DB._lookup = {}
+
+            lookup = DB._new_lookup(attribute)
+            column = None
+            if attribute in DB._columns:
+                column = _Column(attribute,DB._columns[attribute].values.dtype,len(DB._list))
+
+            filled = []
+            for ixs in self._ranges():
+                for ix in ixs:
+                    item = DB._list[ix]
+                    if item is None: continue
+                    item = DB._convert2dict(item)
+                    if attribute not in item:
+                        if len(default) == 0:
+                            raise KeyError("Attribute {:s} not found".format(attribute))
+                        value = default[0]
+                        item[attribute] = value() if hasattr(value,'__call__') else value
+                        filled.append((ix,item[attribute]))
+                    _index(DB,lookup,column,item[attribute],ix)
+                await asyncio.sleep(0)
+
+            if attribute in DB._sorted:
+                DB._sorted[attribute] = await self._sort(DB,lookup)
+            if attribute in DB._trigrams:
+                DB._trigrams[attribute] = await self._trigrams(lookup)
+            if attribute in DB._unique:
+                DB._unique[attribute] = await self._unique(DB,attribute,lookup)
+            composites = {} # May now be complete
+            for composite in list(DB._composite):
+                if attribute in composite:
+                    composites[composite] = await self._composite_lookup(composite,
+                                                        DB.attributes + [attribute])
+
+            old = [DB._composite[composite] for composite in composites]
+            DB._lookup[attribute] = lookup
+            if column is not None:
+                DB._columns[attribute] = column
+            DB._composite.update(composites)
+            DB.attributes.append(attribute)
+            DB._modified()
+            DB._log('add_attribute',attribute,filled)
+            del composites
+            await self._free(old)
+
+    async def scan(self,*A,**K):
+        """
+        Same as query() (but always returns a list) for queries that need to
+        check every item (e.g. filters). The items are checked a chunk at a
+        time.
+
+        The limit, offset and order_by options are not supported. Use
+        query() for point queries
+        """
+        DB = self.DB
+        if len(A) == 0 and len(K) == 0: # Ensure one match
+            return []
+
+        async with self._lock():
+            items = []
+            for ixs in self._ranges():
+                chunk = Qobj(DB,ixs=set(ixs))
+                items.extend(DB._list[ix] for ix in DB._ixs(chunk,*A,**K))
+                await asyncio.sleep(0)
+            return items
+
+    async def save(self,path):
+        """
+        Save a snapshot in the executor. See list_dict_DB.save()
+        """
+        async with self._lock():
+            await self._run(self.DB.save,path)
+
+    @classmethod
+    async def load(cls,path,mmap=False,chunksize=1000,executor=None,keys=None):
+        """
+        Load a snapshot in the executor. See list_dict_DB.load()
+        """
+        loop = asyncio.get_event_loop()
+        DB = await loop.run_in_executor(executor,list_dict_DB.load,path,mmap,keys)
+        return cls(DB,chunksize=chunksize,executor=executor)
+
+    @classmethod
+    async def from_jsonl(cls,path,converters=None,chunksize=1000,progress=None,**kwargs):
+        """
+        Create a DB from a JSON-lines file a chunk at a time. See
+        list_dict_DB.from_jsonl()
+        """
+        rows = _read_rows(path,_jsonl_rows,converters)
+        return await cls._from_rows(rows,chunksize,progress,kwargs)
+
+    @classmethod
+    async def from_csv(cls,path,converters=None,chunksize=1000,progress=None,
+                       delimiter=',',**kwargs):
+        """
+        Create a DB from a CSV file a chunk at a time. See
+        list_dict_DB.from_csv()
+        """
+        rows = _read_rows(path,lambda F:_csv_rows(F,delimiter,converters),converters)
+        return await cls._from_rows(rows,chunksize,progress,kwargs)
+
+    @classmethod
+    async def _from_rows(cls,rows,chunksize,progress,kwargs):
+        ADB = cls(chunksize=chunksize,**kwargs)
+        n = 0
+        async with ADB._lock():
+            for chunk in _chunks(rows,chunksize):
+                ADB.DB.add_items(chunk)
+                n += len(chunk)
+                if progress is not None:
+                    progress(n)
+                await asyncio.sleep(0)
+        return ADB
+
+    def _lock(self):
+        """
+        The lock for changes (created in the running loop)
+        """
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    def _ranges(self):
+        """
+        Yield the item indices in chunks
+        """
+        n = len(self.DB._list)
+        for start in range(0,n,self.chunksize):
+            yield range(start,min(start + self.chunksize,n))
+
+    async def _composite_lookup(self,attributes,known):
+        """
+        Composite index of attributes built a chunk at a time. It is empty
+        unless all of them are in `known`. See
+        list_dict_DB.add_composite_index()
+        """
+        DB = self.DB
+        lookup = defaultdict(_posting)
+        if all(attr in known for attr in attributes):
+            for ixs in self._ranges():
+                for ix in ixs:
+                    item = DB._list[ix]
+                    if item is None: continue
+                    for key in DB._composite_keys(DB._convert2dict(item),attributes):
+                        lookup[key][ix] = None
+                await asyncio.sleep(0)
+        return lookup
+
+    async def _sort(self,DB,lookup):
+        """
+        Sorted distinct values of the lookup. Sorts runs of chunksize values
+        and then merges them, yielding in between. (Sorting in the executor
+        would still hold the GIL)
+        """
+        values = iter(lookup)
+        runs = []
+        while True:
+            run = [val for val in itertools.islice(values,self.chunksize) \
+                        if val is not DB._empty]
+            if len(run) == 0:
+                break
+            runs.append(sorted(run))
+            await asyncio.sleep(0)
+
+        merged = heapq.merge(*runs)
+        values = []
+        while True:
+            chunk = list(itertools.islice(merged,self.chunksize))
+            if len(chunk) == 0:
+                break
+            values.extend(chunk)
+            await asyncio.sleep(0)
+        return values
+
+    async def _trigrams(self,lookup):
+        """
+        Trigram index of the distinct values of the lookup, a chunk of 
+        values at a time. See list_dict_DB.add_trigram_index()
+        """
+        index = defaultdict(set)
+        values = list(lookup)
+        for start in range(0,len(values),self.chunksize):
+            for val in values[start:start + self.chunksize]:
+                _index_trigrams(index,val)
+            await asyncio.sleep(0)
+        return index
+
+    async def _unique(self,DB,attribute,lookup):
+        """
+        Unique index of the lookup, a chunk of values at a time. Raises a 
+        ValueError if a value is not unique. See 
+        list_dict_DB.add_unique_index()
+        """
+        unique = {}
+        values = iter(list(lookup.items()))
+        while True:
+            chunk = list(itertools.islice(values,self.chunksize))
+            if len(chunk) == 0:
+                break
+            _unique_index(attribute,chunk,DB._empty,unique)
+            await asyncio.sleep(0)
+        return unique
+
+    async def _free(self,objs):
+        """
+        Empty the (no longer used) lookups and lists a chunk at a time since
+        freeing a large one at once blocks
+        """
+        for obj in objs:
+            if obj is None: continue
+            while len(obj) > 0:
+                if isinstance(obj,list):
+                    del obj[-self.chunksize:]
+                else:
+                    for _ in range(min(self.chunksize,len(obj))):
+                        obj.popitem()
+                await asyncio.sleep(0)
+
+    async def _run(self,func,*args):
+        """
+        Run func(*args) in the executor
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor,func,*args)
+
+def _index(DB,lookup,column,value,ix):
+    """
+    Add the value of ix to the lookup (and column)
+    """
+    if column is not None:
+        column.set(ix,value)
+    if not isinstance(value,list):
+        lookup[value][ix] = None
+    elif len(value) == 0:
+        lookup[DB._empty][ix] = None # empty list
+    else:
+        for val in value:
+            lookup[val][ix] = None
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+"""
+Hash-sharded, multi-process front end to list_dict_DB
+"""
+from __future__ import unicode_literals
+
+import copy
+import multiprocessing
+import threading
+import zlib
+
+from list_dict_DB import list_dict_DB,Qobj,np,_chunks,_flatten,_options, \
+                         _order_keys,_sort_key
+
+class ShardedListDictDB(object):
+    """
+    A DB split into `shards` list_dict_DBs, each in its own worker process,
+    by the hash of the `shard_key` attribute of the items. This uses more
+    than one core and lets the DB grow past what one process handles well.
+
+    Queries with an equality on the shard key (keyword, dict or an and-ed
+    Qobj condition) go to one shard. Everything else, including range and
+    boolean Qobj queries, is sent to all of the shards which run it in
+    parallel and the results are combined.
+
+    Inputs:
+    -------
+    items [ *empty* ] (list)
+        List of dictionaries. Each must have the shard key
+
+    shard_key (str)
+        The attribute to shard by. Values may not be lists
+
+    shards [None] (int)
+        Number of shards (worker processes). Default is the number of CPUs
+
+    allowMultipleEdit, alwaysReturnList, indexObjects
+        Same as list_dict_DB
+
+    **kwargs
+        Passed to the list_dict_DB of each shard (attributes,
+        sorted_attributes, cacheSize, etc)
+
+    Usage
+    -----
+    >>> DB = ShardedListDictDB(items,shard_key='account',shards=4)
+    >>> DB.query(account=X)                      # One shard
+    >>> DB.query(DB.Q().time > t,order_by='-time',limit=20) # All shards
+    >>> DB.close()
+
+    Notes:
+    ------
+        * Items are copied to the workers. Changing an item that was added
+          or returned by a query does not change the DB. Use update()
+        * Qobjs are sent to the workers as the conditions they represent so
+          filter functions must be picklable (e.g. module-level functions,
+          not lambdas). Qobjs with indices are not supported
+        * Values are routed by their repr() so do not mix equal values of
+          different types (e.g. 1 and 1.0) in the shard key
+        * Results are grouped by shard rather than in the order added
+          unless `order_by` is given
+        * Workers are daemon processes. Call close() (or use `with`) to end
+          them sooner
+    """
+    def __init__(self,items=None,shard_key=None,shards=None, \
+                 allowMultipleEdit=False,alwaysReturnList=True, \
+                 indexObjects=False,**kwargs):
+        if shard_key is None:
+            raise ValueError('Must specify the shard_key')
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+
+        self.shard_key = shard_key
+        self.allowMultipleEdit = allowMultipleEdit
+        self.alwaysReturnList = alwaysReturnList
+        self.indexObjects = indexObjects
+
+        self.attributes = list(kwargs.get('attributes') or [])
+        self._time = 0 # Qobjs here never hold indices so they do not expire
+        self._lock = None
+        self._pipe_lock = threading.Lock()
+
+        # The workers enforce nothing themselves
+        kwargs.update(allowMultipleEdit=True,alwaysReturnList=True,
+                      indexObjects=indexObjects)
+        self._conns = []
+        self._workers = []
+        for _ in range(shards):
+            conn,child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_worker,args=(child,kwargs))
+            worker.daemon = True
+            worker.start()
+            child.close()
+            self._conns.append(conn)
+            self._workers.append(worker)
+
+        if items is not None:
+            self.add_items(items)
+
+    def add(self,item):
+        """
+        Add an item or items to the shard(s) of their shard key
+        """
+        self.add_items([item])
+
+    def add_items(self,items,chunksize=10000):
+        """
+        Add many items. They are sent to the shards `chunksize` at a time
+        """
+        for chunk in _chunks(_flatten(items),chunksize):
+            batches = {}
+            for item in chunk:
+                batches.setdefault(self._shard(item),[]).append(item)
+            shards = sorted(batches)
+            self._attributes(self._scatter('add_items',shards,
+                                           [(batches[s],) for s in shards]))
+
+    def query(self,*A,**K):
+        """
+        Query the shards. See list_dict_DB.query(). The `limit`, `offset`
+        and `order_by` options are applied to the combined results
+        """
+        limit,offset,order_by = _options(K,self.attributes,'limit','offset','order_by')
+        if limit is not None: # Each shard may have all of them
+            K['limit'] = limit + (offset or 0)
+        if order_by is not None:
+            K['order_by'] = order_by
+
+        results = self._gather('query',A,K)
+        items = [item for result in results for item in result]
+
+        if order_by is not None and len(results) > 1:
+            convert = _todict if self.indexObjects else None
+            key,reverse = _sort_key(_order_keys(order_by,self.attributes),items,convert)
+            ixs = sorted(range(len(items)),key=key,reverse=reverse)
+            items = [items[ix] for ix in ixs]
+
+        offset = offset or 0
+        items = items[offset:None if limit is None else offset + limit]
+        if len(items) == 1 and not self.alwaysReturnList:
+            return items[0]
+        return items
+
+    def isin(self,*A,**K):
+        """
+        See list_dict_DB.isin()
+        """
+        return self.exists(*A,**K)
+
+    def exists(self,*A,**K):
+        """
+        See list_dict_DB.exists()
+        """
+        return any(self._gather('exists',A,K))
+
+    def count(self,*A,**K):
+        """
+        See list_dict_DB.count()
+        """
+        return sum(self._gather('count',A,K))
+
+    def value_counts(self,attribute,*A,**K):
+        """
+        See list_dict_DB.value_counts()
+        """
+        counts = {}
+        for result in self._gather('value_counts',(attribute,) + A,K):
+            for value,n in result.items():
+                counts[value] = counts.get(value,0) + n
+        return counts
+
+    def group_by(self,attribute,*A,**K):
+        """
+        See list_dict_DB.group_by(). `agg` is applied to the combined
+        groups (here, so it need not be picklable)
+        """
+        agg, = _options(K,self.attributes,'agg')
+        groups = {}
+        for result in self._gather('group_by',(attribute,) + A,K):
+            for value,items in result.items():
+                groups.setdefault(value,[]).extend(items)
+        if agg is not None:
+            groups = {value:agg(items) for value,items in groups.items()}
+        return groups
+
+    def column(self,attribute,*A,**K):
+        """
+        See list_dict_DB.column()
+        """
+        if np is None:
+            raise ImportError('NumPy is required for column indices')
+        return np.concatenate(self._gather('column',(attribute,) + A,K))
+
+    def update(self,*args,**queryKWs):
+        """
+        Update the matching item(s). See list_dict_DB.update(). If the shard
+        key changes, the items are moved to their new shard
+        """
+        if len(args) == 1:
+            updated_dict,query = args[0],{}
+        elif len(args) == 2:
+            updated_dict,query = args
+        else:
+            raise ValueError('Incorrect number of inputs. See documentation')
+
+        updated_dict = _todict(updated_dict) if self.indexObjects else updated_dict
+        if not isinstance(updated_dict,dict):
+            raise ValueError('Must specify updated values as a dictionary')
+        if isinstance(updated_dict.get(self.shard_key),list):
+            raise ValueError('Shard key values cannot be lists')
+
+        if self.indexObjects and not isinstance(query,(dict,Qobj)) and hasattr(query,'__dict__'):
+            query = _todict(query)
+        if not isinstance(query,(dict,Qobj)):
+            raise TypeError('Unrecognized query {0}. Must be a dict or Qobj'.format(type(query)))
+        A = (query,) if isinstance(query,Qobj) else ()
+        if isinstance(query,dict):
+            queryKWs.update(query)
+        shards = self._edited(A,queryKWs,'Query did not match any results')
+
+        if self.shard_key not in updated_dict:
+            self._scatter('update',shards,[(updated_dict,) + A for _ in shards],queryKWs)
+            return
+
+        # All of the items move to the one shard of the new key. It adds all
+        # of them or none so the originals can be put back if one raises
+        originals = []
+        for result in self._scatter('pop',shards,[A]*len(shards),queryKWs):
+            originals.extend(result)
+        items = [copy.copy(item) for item in originals]
+        for item in items:
+            (_todict(item) if self.indexObjects else item).update(updated_dict)
+        try:
+            self._attributes(self._scatter('add_all',[self._shard(items[0])],[(items,)]))
+        except Exception:
+            self.add_items(originals)
+            raise
+
+    def remove(self,*A,**K):
+        """
+        Remove the matching item(s). See list_dict_DB.remove()
+        """
+        shards = self._edited(A,K,'No matching items')
+        self._scatter('remove',shards,[A]*len(shards),K)
+
+    def reindex(self,*args):
+        """
+        See list_dict_DB.reindex()
+        """
+        self._broadcast('reindex',*args)
+
+    def add_attribute(self,attribute,*default):
+        """
+        See list_dict_DB.add_attribute(). A default must be picklable
+        """
+        self._attributes(self._broadcast('add_attribute',attribute,*default))
+
+    def add_sorted_index(self,attribute):
+        """
+        See list_dict_DB.add_sorted_index()
+        """
+        self._broadcast('add_sorted_index',attribute)
+
+    def add_bitmap_index(self,attribute):
+        """
+        See list_dict_DB.add_bitmap_index()
+        """
+        self._broadcast('add_bitmap_index',attribute)
+
+    def add_column_index(self,attribute,dtype='float64'):
+        """
+        See list_dict_DB.add_column_index()
+        """
+        self._broadcast('add_column_index',attribute,dtype)
+
+    def vacuum(self):
+        """
+        See list_dict_DB.vacuum()
+        """
+        self._broadcast('vacuum')
+
+    def items(self):
+        """
+        All of the items (grouped by shard)
+        """
+        return [item for result in self._broadcast('items') for item in result]
+
+    def Qobj(self):
+        """
+        Query object for this DB
+        """
+        return Qobj(self)
+
+    def Q(self):
+        """
+        same as Qobj method
+        """
+        return Qobj(self)
+
+    def close(self):
+        """
+        End the worker processes
+        """
+        with self._pipe_lock:
+            for conn in self._conns:
+                try:
+                    conn.send(None)
+                except (IOError,OSError):
+                    pass # Already ended
+                conn.close()
+            for worker in self._workers:
+                worker.join()
+            self._conns,self._workers = [],[]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def __contains__(self,check_diff):
+        return self.exists(check_diff)
+
+    def __len__(self):
+        return sum(self._broadcast('__len__'))
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def _shard(self,value,is_item=True):
+        """
+        The shard of an item (or a value of the shard key)
+        """
+        if len(self._conns) == 0:
+            raise ValueError('The DB is closed')
+        if is_item:
+            item = _todict(value) if self.indexObjects else value
+            if self.shard_key not in item:
+                raise KeyError("Items must have the shard key '{:s}'".format(self.shard_key))
+            value = item[self.shard_key]
+            if isinstance(value,list):
+                raise ValueError('Shard key values cannot be lists')
+        return (zlib.crc32(repr(value).encode('utf8')) & 0xffffffff) % len(self._conns)
+
+    def _route(self,A,K):
+        """
+        The shards that may have matches of a query: the one of an equality
+        on the shard key or else all of them
+        """
+        values = []
+        for arg in A:
+            if isinstance(arg,dict):
+                arg = arg.items()
+            elif isinstance(arg,Qobj):
+                arg = [(Q._attr,Q._args[0]) for Q in arg._conjuncts() if Q._op == 'eq']
+            else:
+                continue
+            values.extend(value for attr,value in arg if attr == self.shard_key)
+        if self.shard_key in K:
+            values.append(K[self.shard_key])
+
+        for value in values:
+            if isinstance(value,list): # Lists are and-ed so only one can match
+                if len(value) != 1:
+                    continue
+                value = value[0]
+            return [self._shard(value,is_item=False)]
+        return list(range(len(self._conns)))
+
+    def _edited(self,A,K,message):
+        """
+        The shards with items to update or remove. Raises ValueError if
+        there are none or, unless allowMultipleEdit, more than one
+        """
+        shards = self._route(A,K)
+        counts = self._scatter('count',shards,[A]*len(shards),K)
+        if sum(counts) == 0:
+            raise ValueError(message)
+        if sum(counts) > 1 and not self.allowMultipleEdit:
+            raise ValueError("Query returned multiple results. Set 'allowMultipleEdit' or change query")
+        return [shard for shard,count in zip(shards,counts) if count > 0]
+
+    def _attributes(self,results):
+        """
+        Add any new attributes from the workers' results
+        """
+        for attributes in results:
+            self.attributes.extend(attr for attr in attributes if attr not in self.attributes)
+
+    def _gather(self,name,A,K):
+        """
+        Run a query method on the shards that may match
+        """
+        shards = self._route(A,K)
+        return self._scatter(name,shards,[A]*len(shards),K)
+
+    def _broadcast(self,name,*A):
+        """
+        Run a method on all of the shards
+        """
+        return self._scatter(name,range(len(self._conns)),[A]*len(self._conns))
+
+    def _scatter(self,name,shards,args,K=None):
+        """
+        Call `name` with args[i] on shards[i] in parallel. Returns the
+        results in order or raises the first error
+        """
+        shards = list(shards)
+        K = {} if K is None else K
+        with self._pipe_lock:
+            if len(self._conns) == 0:
+                raise ValueError('The DB is closed')
+            sent = 0
+            try:
+                for shard,A in zip(shards,args):
+                    A = tuple(_Query(arg) if isinstance(arg,Qobj) else arg for arg in A)
+                    self._conns[shard].send((name,A,K))
+                    sent += 1
+            finally: # Always read the replies of what was sent
+                replies = [self._conns[shard].recv() for shard in shards[:sent]]
+
+        for status,result in replies:
+            if status == 'error':
+                raise result
+        return [result for _,result in replies]
+
+class _Query(object):
+    """
+    A Qobj as the conditions it represents so it can be sent to a worker
+    (which has its own DB)
+    """
+    def __init__(self,Q):
+        self.tree = _tree(Q)
+
+    def qobj(self,DB):
+        return _qobj(DB,self.tree)
+
+def _tree(Q):
+    """
+    (attr,op,args) of a Qobj with the Qobjs in args also converted
+    """
+    if Q._op == 'ixs':
+        raise ValueError('Qobjs with indices cannot be sent to shards')
+    if Q._op in ('and','or','not'):
+        return (Q._attr,Q._op,tuple(_tree(Q2) for Q2 in Q._args))
+    return (Q._attr,Q._op,Q._args)
+
+def _qobj(DB,tree):
+    """
+    Rebuild the Qobj of a tree for DB
+    """
+    attr,op,args = tree
+    if op in ('and','or','not'):
+        args = tuple(_qobj(DB,arg) for arg in args)
+    return Qobj(DB,attr=attr,op=op,args=args)
+
+def _todict(obj):
+    return obj if isinstance(obj,dict) else obj.__dict__
+
+def _worker(conn,kwargs):
+    """
+    Worker process: Run the requested methods on its DB until sent None
+    """
+    DB = list_dict_DB(**kwargs)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        name,A,K = request
+        A = tuple(arg.qobj(DB) if isinstance(arg,_Query) else arg for arg in A)
+        try:
+            reply = ('ok',_call(DB,name,A,K))
+        except Exception as E:
+            reply = ('error',E)
+
+        try:
+            conn.send(reply)
+        except Exception as E: # e.g. unpicklable
+            conn.send(('error',RuntimeError(repr(E))))
+    conn.close()
+
+def _call(DB,name,A,K):
+    """
+    Call the method on the worker's DB
+    """
+    if name in ('add_items','add_attribute'): # Return the attributes
+        getattr(DB,name)(*A,**K)
+        return DB.attributes
+    if name == 'add_all': # Add all of the items or, if one raises, none
+        n = len(DB._list)
+        try:
+            DB.add_items(*A,**K)
+        except Exception:
+            ixs = [ix for ix in range(n,len(DB._list)) if ix in DB._ix]
+            if len(ixs) > 0:
+                DB._remove_ixs(ixs)
+                DB._log('remove',ixs)
+            raise
+        return DB.attributes
+    if name == 'pop': # Remove and return the items
+        ixs = list(DB._ixs(*A,**K))
+        items = [DB._list[ix] for ix in ixs]
+        DB._remove_ixs(ixs)
+        DB._log('remove',ixs)
+        return items
+    return getattr(DB,name)(*A,**K)
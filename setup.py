@@ -6,11 +6,12 @@ from setuptools import setup
 
 setup(
     name='list_dict_DB',
-    py_modules=['list_dict_DB'],
+    py_modules=['list_dict_DB','list_dict_DB_async','list_dict_DB_shard'],
     long_description=open('README.rst').read(),
     version='20170911.2',
     description='in memory database like object with O(1) queries',
     url='https://github.com/Jwink3101/list_dict_db',
     author='Justin Winokur',
     author_email='Jwink3101@gmail.com',
+    extras_require={'numpy':['numpy']},
 )
@@ -2,9 +2,11 @@
 import pytest
 
 import list_dict_DB
+list_dict_DB_module = list_dict_DB
 _emptyList = list_dict_DB._emptyList
 list_dict_DB=list_dict_DB.list_dict_DB
 
+import re
 import sys
 
 def test_list_val():
@@ -187,6 +189,8 @@ def test_empty():
     # Query    
     assert not {'a':'i'} in DB # should also not cause an error
     assert DB.query(DB.Q().a=='i') == []
+    DB.reindex()
+    DB.reindex('a')
 
     # Add attribute
     DB.add_attribute('bb',[])
@@ -777,6 +781,1806 @@ def test_default_attribs_not_callable():
     assert DB.query(a=8)['b'] is default
 
 
+def test_sorted_index():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':'guitar'},      # 0
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':'bass'},     # 1
+        {'first':'George','last':'Harrison','born':1943,'role':'guitar'},   # 2
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},        # 3
+        {'first':'George','last':'Martin','born':1926,'role':'producer'}    # 4
+    ]
+    
+    DB = list_dict_DB(items,sorted_attributes=['born'])
+    DBscan = list_dict_DB(items) # To compare against the O(N) versions
+    DB.alwaysReturnList = DBscan.alwaysReturnList = True
+    
+    assert DB._sorted['born'] == [1926,1940,1942,1943]
+    
+    def _same(func):
+        Q,Qs = DB.Q(),DBscan.Q()
+        A = sorted(DB.query(func(Q)),key=lambda a:a['last'])
+        B = sorted(DBscan.query(func(Qs)),key=lambda a:a['last'])
+        assert A == B
+        return len(A)
+    
+    for val in [1920,1926,1930,1940,1942,1943,1950]:
+        _same(lambda Q: Q.born < val)
+        _same(lambda Q: Q.born <= val)
+        _same(lambda Q: Q.born > val)
+        _same(lambda Q: Q.born >= val)
+        _same(lambda Q: Q.born.between(val,1942))
+    
+    assert _same(lambda Q: Q.born.between(1940,1942)) == 3
+    assert _same(lambda Q: (Q.born >= 1940) & (Q.role == 'guitar')) == 2
+    
+    # Maintained through update and remove
+    DB.update({'born':1927},last='Martin')
+    assert DB._sorted['born'] == [1927,1940,1942,1943]
+    assert len(DB.query(DB.Q().born < 1930)) == 1
+    
+    DB.allowMultipleEdit = True
+    DB.remove(born=1940)
+    assert DB._sorted['born'] == [1927,1942,1943]
+    assert len(DB.query(DB.Q().born <= 1940)) == 1
+    
+    # and add, reindex
+    DB.add({'first':'Pete','last':'Best','born':1941,'role':'drums'})
+    assert DB._sorted['born'] == [1927,1941,1942,1943]
+    DB.query(last='Best')[0]['born'] = 1960
+    DB.reindex()
+    assert DB._sorted['born'] == [1927,1942,1943,1960]
+    assert DB.query(DB.Q().born > 1950) == [DB.query(last='Best')[0]]
+    
+    # Added after the fact
+    DB.add_sorted_index('role')
+    assert DB._sorted['role'] == ['bass','drums','guitar','producer']
+    assert len(DB.query(DB.Q().role.between('c','h'))) == 2
+    
+    # Lists are expanded
+    DB.add_attribute('bands',[])
+    DB.add_sorted_index('bands')
+    DB.update({'bands':['Beatles','Wings']},first='Paul')
+    assert len(DB.query(DB.Q().bands >= 'C')) == 1
+    assert len(DB.query(DB.Q().bands < 'C')) == 1
+    
+    # Empty DB
+    DB = list_dict_DB(sorted_attributes=['a'])
+    assert DB.query(DB.Q().a > 1) == []
+    DB.add({'a':3})
+    DB.add({'a':1})
+    assert DB.query(DB.Q().a > 1) == [{'a':3}]
+    
+    with pytest.raises(ValueError):
+        list_dict_DB(exclude_attributes=['a'],sorted_attributes=['a'])
+
+def test_add_items():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','vocals']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','vocals']},
+        {'first':'George','last':'Harrison','born':1943,'role':'guitar'},
+        {'first':'Ringo','last':'Starr','born':1940,'role':[]},
+        {'first':'George','last':'Martin','born':1926,'role':'producer','extra':'test'}
+    ]
+    import copy
+    
+    # Compare to adding one at a time
+    DB1 = list_dict_DB(sorted_attributes=['born'])
+    for item in copy.deepcopy(items):
+        DB1.add(item)
+    
+    DB2 = list_dict_DB(copy.deepcopy(items),sorted_attributes=['born'])
+    
+    DB3 = list_dict_DB(sorted_attributes=['born'])
+    DB3.add_items(copy.deepcopy(items[:2]))
+    DB3.add_items(item for item in copy.deepcopy(items[2:])) # generator
+    
+    for DB in [DB2,DB3]:
+        assert DB.items() == DB1.items()
+        assert DB.attributes == DB1.attributes
+        assert DB._sorted == DB1._sorted == {'born':[1926,1940,1942,1943]}
+        for attrib in DB1.attributes:
+            for val,ixs in DB1._lookup[attrib].items():
+                if val is DB1._empty:
+                    val = DB._empty
+                assert DB._lookup[attrib][val] == ixs
+    
+    DB = DB2
+    assert len(DB.query(role='vocals')) == 2
+    assert len(DB.query(role=[])) == 1
+    assert len(DB.query(extra=None)) == 4
+    
+    # Batches are a single modification 
+    Q = DB.Q()
+    DB.add_items([])
+    assert len(DB.query(Q.born > 1940)) == 2 # Still valid
+    
+    DB.add_items([{'first':'Pete','last':'Best','born':1941}])
+    with pytest.raises(ValueError):
+        DB.query(Q.born > 1940)
+    assert len(DB.query(DB.Q().born > 1940)) == 3
+    assert DB._sorted['born'] == [1926,1940,1941,1942,1943]
+    assert DB.query(last='Best')[0]['role'] is None
+    
+    # None of a batch is kept if the sorted values can not be compared
+    if sys.version_info[0] >= 3:
+        DB = list_dict_DB([{'i':i,'x':i % 5} for i in range(10)],sorted_attributes=['x','i'],
+                          trigram_attributes=['s'],default_attribute='')
+        before = (DB.items(),dict(DB._lookup['x']),list(DB._sorted['x']),list(DB._sorted['i']))
+        with pytest.raises(TypeError):
+            DB.add_items([{'i':10,'x':7,'s':'abc'},{'i':11,'x':None}])
+        assert (DB.items(),dict(DB._lookup['x']),DB._sorted['x'],DB._sorted['i']) == before
+        assert len(DB) == 10 and len(DB._list) == 10 and DB.query(s='abc') == []
+        assert DB.query(DB.Q().s.contains('abc')) == []
+        assert len(DB.query(DB.Q().x >= 3)) == 4
+        DB.add_items([{'i':10,'x':7,'s':'abc'}])
+        assert DB.query(DB.Q().x > 5) == DB.query(DB.Q().s.contains('abc')) == [{'i':10,'x':7,'s':'abc'}]
+    
+    # Nested lists are still flattened
+    DB = list_dict_DB([items[:2],(items[2],items[3])])
+    assert len(DB) == 4
+
+def test_bulk_update_remove():
+    DB = list_dict_DB([{'i':i,'status':i%2} for i in range(1000)],
+                      allowMultipleEdit=True)
+    
+    DB.update({'status':'flipped'},status=0)
+    assert len(DB.query(status=0)) == 0
+    assert 0 not in DB._lookup['status'] # cleaned up
+    assert [item['i'] for item in DB.query(status='flipped')] == list(range(0,1000,2))
+    
+    # Order of the lookup is insertion order
+    assert list(DB._lookup['status'][1]) == list(range(1,1000,2))
+    
+    DB.remove(status=1)
+    assert len(DB) == 500
+    assert 1 not in DB._lookup['status']
+    assert len(DB.query(status='flipped')) == 500
+    
+    DB.update({'status':0},DB.Q().i < 10)
+    assert list(DB._lookup['status'][0]) == [0,2,4,6,8]
+
+def test_vacuum():
+    items = [{'i':i,'mod3':i%3,'tags':['a','b'] if i%2 else []} for i in range(30)]
+    DB = list_dict_DB(items,sorted_attributes=['i'],allowMultipleEdit=True)
+    
+    DB.vacuum() # Nothing to do
+    assert len(DB._list) == 30
+    
+    DB.remove(mod3=0)
+    assert len(DB._list) == 30 and len(DB) == 20
+    
+    Q = DB.Q()
+    DB.vacuum()
+    with pytest.raises(ValueError): # Q is out of date
+        DB.query(Q.i == 1)
+    
+    assert len(DB._list) == 20 and len(DB) == 20
+    assert None not in DB._list
+    assert DB._ix == set(range(20))
+    assert DB.items() == [item for item in items if item['mod3']]
+    
+    # Lookups have been renumbered
+    for ix,item in enumerate(DB.items()):
+        assert DB[ix] is item
+        assert DB.query(_index=ix) == [item]
+        assert DB.query(i=item['i']) == [item]
+    assert len(DB.query(mod3=1)) == 10
+    assert len(DB.query(tags='a')) == 10
+    assert len(DB.query(tags=[])) == 10
+    assert len(DB.query(DB.Q().i.between(10,19))) == 7
+    
+    # Everything still works after
+    DB.update({'mod3':100},i=1)
+    assert DB.query(mod3=100)[0]['i'] == 1
+    DB.add({'i':100,'mod3':1,'tags':[]})
+    assert DB[20]['i'] == 100
+    
+    # Automatic
+    DB = list_dict_DB(items,autoVacuum=0.5)
+    for i in range(15):
+        DB.remove(i=i)
+    assert len(DB._list) == 30 # Exactly half
+    DB.remove(i=15)
+    assert len(DB._list) == 14
+    assert [item['i'] for item in DB] == list(range(16,30))
+
+def test_query_planner():
+    DB = list_dict_DB([{'user':i%50,'active':i%10 != 0,'tags':['x','y'] if i%2 else []} 
+                        for i in range(1000)])
+    
+    result = DB.query(user=3,active=True)
+    assert [item['user'] for item in result] == [3]*20
+    assert all(item['active'] for item in result)
+    
+    # Same in any order or form
+    assert DB.query(active=True,user=3) == result
+    assert DB.query({'active':True},user=3) == result
+    assert DB.query(DB.Q().active == True,user=3) == result
+    assert DB.query(user=3,active=True,tags=['x','y']) == result
+    
+    # Short circuit on empty
+    assert DB.query(user=3,active=True,tags=[]) == []
+    assert DB.query(user=1000,active=True) == []
+    assert 1000 not in DB._lookup['user'] # Should not be added on lookup
+    assert len(DB.query(user=10,tags=[])) == 20
+    assert len(DB.query(DB.Q().tags == [])) == 500
+    
+    with pytest.raises(KeyError):
+        DB.query(user=3,bad=1)
+    
+    # Postings are intersected from the smallest
+    from list_dict_DB import _intersect
+    assert _intersect([{1:None,2:None,3:None},[3,2],set([2,3,4])]) == [3,2]
+    assert _intersect([[1,2]]) == [1,2]
+
+def test_query_cache():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','vocals']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','vocals']},
+        {'first':'George','last':'Harrison','born':1943,'role':'guitar'},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926,'role':'producer'}
+    ]
+    DB = list_dict_DB(items,cacheSize=2)
+    
+    assert DB.query(first='George') == [items[2],items[4]]
+    assert DB.cache_info() == (0,1,2,1)
+    
+    # Same query in a different form is a hit
+    assert DB.query({'first':'George'}) == [items[2],items[4]]
+    assert DB[{'first':'George'}] == [items[2],items[4]]
+    assert {'first':'George'} in DB
+    assert DB.cache_info() == (3,1,2,1)
+    
+    assert DB.query(first='George',born=1943) == [items[2]]
+    assert DB.query({'born':1943},first='George') == [items[2]]
+    assert DB.cache_info() == (4,2,2,2)
+    
+    # Lists are not tuples
+    assert len(DB.query(role=['guitar','vocals'])) == 1
+    assert DB.query(role=('guitar','vocals')) == []
+    assert DB.cache_info() == (4,4,2,2) # Evicted the others
+    
+    # Qobjs and unhashable values are not cached
+    DB.query(DB.Q().first == 'George')
+    with pytest.raises(TypeError):
+        DB.query(first={})
+    assert DB.cache_info() == (4,4,2,2)
+    
+    # Cleared by any change
+    DB.query(first='George')
+    DB.update({'first':'Georgie'},last='Martin')
+    assert DB.cache_info().currsize == 0
+    assert DB.query(first='George') == [items[2]]
+    
+    DB.add({'first':'George','last':'Best','born':1946,'role':'football'})
+    assert len(DB.query(first='George')) == 2
+    
+    DB.remove(last='Best')
+    assert DB.query(first='George') == [items[2]]
+    
+    DB.query(first='George')[0]['born'] = 1950
+    DB.reindex()
+    assert DB.query(born=1950) == [items[2]]
+    
+    DB.add_attribute('alive',True)
+    assert DB.query(born=1950,alive=True) == [items[2]]
+    
+    # Disabled by default
+    DB = list_dict_DB(items)
+    DB.query(first='George')
+    assert DB.cache_info() == (0,0,0,0)
+
+def test_lazy_Qobj():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':'guitar'},      # 0
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':'bass'},     # 1
+        {'first':'George','last':'Harrison','born':1943,'role':'guitar'},   # 2
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},        # 3
+        {'first':'George','last':'Martin','born':1926,'role':'producer'}    # 4
+    ]
+    DB = list_dict_DB(items)
+    Q = DB.Q()
+    
+    # Nothing is modified so they can be reused
+    A = Q.born >= 1940
+    B = A & (Q.role == 'guitar')
+    C = A | (Q.first == 'George')
+    D = ~A
+    assert len(DB.query(B)) == 2
+    assert len(DB.query(C)) == 5
+    assert len(DB.query(D)) == 1
+    assert len(DB.query(A)) == 4
+    assert len(DB.query(~D)) == 4
+    assert ~D is A
+    assert Q._attr is None and Q._op is None
+    
+    # Equality conditions are evaluated first and filters only check the 
+    # remaining items
+    checked = []
+    def filt(item):
+        checked.append(item['first'])
+        return item['born'] < 1940
+    
+    assert DB.query( Q.filter(filt) & (Q.first == 'George') ) == [items[4]]
+    assert sorted(checked) == ['George','George']
+    
+    del checked[:]
+    assert DB.query( Q.filter(filt),first='Paul' ) == []
+    assert checked == ['Paul']
+    
+    # Short circuit if nothing is left
+    del checked[:]
+    assert DB.query( Q.filter(filt) & (Q.first == 'Pete') ) == []
+    assert DB.query( Q.filter(filt) & (Q.born > 1900),first='Pete') == []
+    assert checked == []
+    
+    # Reused results are only evaluated once (until the DB changes)
+    F = Q.filter(filt)
+    assert len(DB.query( F | (F & (Q.role == 'guitar')) | ~F )) == 5
+    assert len(checked) == 5
+    assert DB.query(F) == [items[4]]
+    assert len(checked) == 5
+    
+    # Incomplete queries
+    assert DB.query(Q.first) == []
+    assert DB.query(Q.first & (Q.first == 'John')) == [items[0]]
+    assert DB.query(Q.first | (Q.first == 'John')) == [items[0]]
+    with pytest.raises(ValueError):
+        ~Q.first
+    
+    # Still expire
+    DB.update({'born':1941},first='John')
+    with pytest.raises(ValueError):
+        DB.query(B)
+    with pytest.raises(ValueError):
+        Q.born > 1940
+    
+    # Results expire on every change, even if the clock did not move
+    class _Clock(object):
+        def time(self):
+            return 1000.0
+    clock,list_dict_DB_module.time = list_dict_DB_module.time,_Clock()
+    try:
+        DB = list_dict_DB([{'a':i} for i in range(6)],sorted_attributes=['a'])
+        cond = DB.Q().a >= 3
+        assert len(DB.query(cond)) == 3
+        DB.update({'a':0},a=4)
+        assert sorted(item['a'] for item in DB.query(DB.Q().a >= 3)) == [3,5]
+        with pytest.raises(ValueError):
+            DB.query(cond)
+        with pytest.raises(RuntimeError):
+            for item in DB.iquery(DB.Q().a >= 0):
+                DB.add({'a':10})
+    finally:
+        list_dict_DB_module.time = clock
+
+def test_bitmap_index():
+    import random
+    random.seed(1)
+    
+    from list_dict_DB import _Bitmap
+    B = _Bitmap([1,5000,3,9000,5000])
+    assert list(B) == [1,3,5000,9000] and len(B) == 4
+    assert 5000 in B and 5001 not in B
+    assert list(B & _Bitmap([3,9000,10])) == [3,9000]
+    assert list(B | _Bitmap([2])) == [1,2,3,5000,9000]
+    assert list(B - _Bitmap([1,9000])) == [3,5000]
+    del B[5000]
+    assert list(B) == [1,3,9000] and len(B) == 3
+    with pytest.raises(KeyError):
+        del B[5000]
+    
+    items = [{'i':i,'flag':random.random() < 0.3,'status':random.choice('abc'),
+              'tags':random.sample(['x','y','z'],random.randint(0,2))} 
+             for i in range(10000)]
+    
+    DBb = list_dict_DB(items,bitmap_attributes=['flag','status','tags'],
+                       sorted_attributes=['status'],allowMultipleEdit=True)
+    DB = list_dict_DB([dict(item) for item in items],allowMultipleEdit=True)
+    assert isinstance(DBb._ix,_Bitmap)
+    assert isinstance(DBb._lookup['flag'][True],_Bitmap)
+    
+    def _check():
+        for func in [
+                lambda Q: Q.flag == True,
+                lambda Q: (Q.flag == True) & (Q.status == 'a'),
+                lambda Q: (Q.flag == True) | (Q.status != 'b'),
+                lambda Q: ~((Q.flag == True) | (Q.tags == 'x')),
+                lambda Q: (Q.tags == ['x','y']) & (Q.i < 5000),
+                lambda Q: (Q.tags == []) & ~(Q.status >= 'b'),
+                lambda Q: (Q.i == 10) | ((Q.status == 'c') & (Q.flag != True)),
+                ]:
+            A = DBb.query(func(DBb.Q()))
+            B = DB.query(func(DB.Q()))
+            assert sorted(a['i'] for a in A) == sorted(b['i'] for b in B)
+        
+        assert sorted(a['i'] for a in DBb.query(flag=False,status='b')) == \
+               sorted(b['i'] for b in DB.query(flag=False,status='b'))
+        assert sorted(a['i'] for a in DBb.query(tags=[])) == \
+               sorted(b['i'] for b in DB.query(tags=[]))
+    _check()
+    
+    # Modifications
+    for D in [DB,DBb]:
+        D.update({'status':'d'},DB.Q().i < 100)
+        D.update({'flag':True},D.Q().i.between(100,200))
+        D.remove(D.Q().i > 9000)
+        D.add({'i':20000,'flag':True,'status':'a','tags':['z']})
+    _check()
+    
+    DBb.vacuum()
+    assert isinstance(DBb._ix,_Bitmap) and len(DBb._ix) == len(DBb)
+    _check()
+    
+    # Convert after the fact
+    DB.add_bitmap_index('status')
+    assert isinstance(DB._lookup['status']['a'],_Bitmap)
+    assert len(DB.query(status='a')) == len(DBb.query(status='a'))
+
+def test_column_index():
+    np = pytest.importorskip('numpy')
+    import random
+    random.seed(2)
+    
+    items = [{'i':i,'price':round(random.uniform(0,100),2),'qty':random.randint(0,20)}
+             for i in range(2000)]
+    items[5]['price'] = None # Missing
+    
+    DBc = list_dict_DB(items,column_attributes=['price'],allowMultipleEdit=True)
+    DBc.add_column_index('qty',dtype='int64')
+    DB = list_dict_DB([dict(item) for item in items],allowMultipleEdit=True)
+    DB.update({'price':float('nan')},i=5) # Scans can not compare None
+    
+    def _check():
+        for func in [
+                lambda Q: Q.price < 50,
+                lambda Q: Q.price <= 50.5,
+                lambda Q: (Q.price > 10) & (Q.qty >= 5),
+                lambda Q: Q.price.between(10,20) | (Q.qty == 3),
+                lambda Q: (Q.i == 7) & (Q.qty > 0),
+                lambda Q: ~(Q.qty < 10),
+                ]:
+            A = DBc.query(func(DBc.Q()))
+            B = DB.query(func(DB.Q()))
+            assert sorted(a['i'] for a in A) == sorted(b['i'] for b in B)
+        
+        Q = DBc.Q()
+        A = DBc.query(Q.vfilter(lambda c: c['price']*c['qty'] > 1000))
+        B = DB.query(DB.Q().filter(lambda it: it['price']*it['qty'] > 1000))
+        assert sorted(a['i'] for a in A) == sorted(b['i'] for b in B)
+        
+        A = DBc.query(Q.vfilter(lambda c: c['price']*c['qty'] > 1000),i=[])
+        assert A == []
+        A = DBc.query(Q.vfilter(lambda c: c['price'] > 90) & (Q.qty == 2))
+        B = DB.query(DB.Q().filter(lambda it: it['price'] > 90) & (DB.Q().qty == 2))
+        assert sorted(a['i'] for a in A) == sorted(b['i'] for b in B)
+        
+        # Aggregations
+        prices = [it['price'] for it in DB.items() if it['price'] == it['price']]
+        assert np.isclose(DBc.column('price').sum(),sum(prices))
+        assert len(DBc.column('price')) == len(prices)
+        assert sorted(DBc.column('qty',qty=3)) == [3]*len(DB.query(qty=3))
+    _check()
+    
+    for D in [DB,DBc]:
+        D.update({'price':75.0},D.Q().i < 100)
+        D.remove(D.Q().i >= 1500)
+        D.add({'i':5000,'price':99.0,'qty':50})
+    _check()
+    DBc.vacuum()
+    _check()
+    
+    DBc.query(i=10)[0]['qty'] = 1000
+    DBc.reindex()
+    assert DBc.query(DBc.Q().qty > 999)[0]['i'] == 10
+    
+    with pytest.raises(TypeError):
+        DBc.add({'i':1,'price':'free','qty':1})
+    
+    # Rejected values leave the DB queryable and consistent
+    D = list_dict_DB([{'a':1,'price':1.0}],column_attributes=['price'])
+    with pytest.raises(TypeError):
+        D.add({'a':1,'price':'free'})
+    with pytest.raises(TypeError):
+        D.add_items([{'a':2,'price':2.0},{'a':1,'price':'free'}])
+    with pytest.raises(TypeError):
+        D.update({'price':'free'},a=1)
+    assert D.query(a=1) == [{'a':1,'price':1.0}]
+    assert D.query(a=2) == [{'a':2,'price':2.0}] # Added before the bad one
+    assert D.query(price='free') == []
+    assert sorted(D.column('price')) == [1.0,2.0]
+
+def test_iquery_limit_offset():
+    DB = list_dict_DB([{'i':i,'mod':i%4,'even':i%2==0} for i in range(1000)],
+                      sorted_attributes=['i'])
+    
+    import types
+    assert isinstance(DB.iquery(mod=1),types.GeneratorType)
+    assert list(DB.iquery(mod=1)) == DB.query(mod=1)
+    assert [it['i'] for it in DB.iquery(mod=1,limit=3)] == [1,5,9]
+    assert [it['i'] for it in DB.iquery(mod=1,limit=3,offset=2)] == [9,13,17]
+    assert [it['i'] for it in DB.query(mod=1,limit=3,offset=2)] == [9,13,17]
+    assert [it['i'] for it in DB.query(mod=1,even=False,offset=248)] == [993,997]
+    assert DB.query(mod=1,even=True,limit=3) == []
+    assert len(DB.query(mod=1,limit=0)) == 0
+    
+    # Only what is needed is checked
+    checked = []
+    def filt(item):
+        checked.append(item['i'])
+        return True
+    Q = DB.Q()
+    
+    assert len(DB.query(Q.filter(filt),mod=2,limit=5)) == 5
+    assert checked == [2,6,10,14,18]
+    
+    del checked[:]
+    assert len(DB.query(Q.filter(filt) & (Q.i > 500),mod=2,limit=1)) == 1
+    assert len(checked) == 1
+    
+    del checked[:]
+    items = DB.iquery(Q.filter(filt))
+    assert next(items)['i'] == 0 and checked == [0]
+    
+    # Other conditions are checked one at a time
+    for func in [lambda Q: Q.i < 20,
+                 lambda Q: (Q.i < 20) | (Q.mod == 3),
+                 lambda Q: ~((Q.i < 500) & (Q.even == True)),
+                 lambda Q: (Q.i.between(10,30)) & (Q.i != 15) & (Q.mod == 2),
+                 lambda Q: Q.filter(lambda it: it['i'] > 990),
+                 ]:
+        assert sorted(it['i'] for it in DB.iquery(func(DB.Q()))) == \
+               sorted(it['i'] for it in DB.query(func(DB.Q())))
+        assert sorted(it['i'] for it in DB.iquery(func(DB.Q()),even=True)) == \
+               sorted(it['i'] for it in DB.query(func(DB.Q()),even=True))
+    
+    # Errors are raised right away
+    with pytest.raises(KeyError):
+        DB.iquery(bad=1)
+    
+    items = DB.iquery(mod=1)
+    next(items)
+    DB.add({'i':1000,'mod':1,'even':True})
+    with pytest.raises(RuntimeError):
+        list(items)
+    
+    # limit and offset can be attributes
+    DB = list_dict_DB([{'limit':i} for i in range(5)])
+    assert DB.query(limit=3) == [{'limit':3}]
+
+def test_order_by():
+    import random
+    random.seed(2)
+    items = [{'account':random.randint(0,9),'time':random.randint(0,300),
+              'kind':random.choice('abc'),'i':i} for i in range(1000)]
+    items[5]['time'] = [400,-1]
+    items[6]['time'] = []
+    
+    def brute(match,attrib,reverse=False):
+        out = [item for item in items if match(item)]
+        values = [item for item in out if item[attrib] != []]
+        key = lambda item: (max if reverse else min)(_makelist(item[attrib]))
+        values.sort(key=key,reverse=reverse)
+        return values + [item for item in out if item[attrib] == []]
+    _makelist = lambda v: v if isinstance(v,list) else [v]
+    keyL = lambda L: [item['time'] for item in L]
+    
+    for sorted_attributes in [None,['time']]:
+        DB = list_dict_DB(items,sorted_attributes=sorted_attributes)
+        Q = DB.Q()
+        
+        assert DB.query(order_by='time') == [] # Same as query()
+        for A,kw,match in [([Q.i >= 0],{},lambda it:True),
+                           ([],{'account':3},lambda it:it['account'] == 3),
+                           ([Q.kind == 'a'],{'account':3},lambda it:it['account'] == 3 and it['kind'] == 'a')]:
+            for order_by,reverse in [('time',False),('-time',True)]:
+                expected = brute(match,'time',reverse)
+                
+                res = DB.query(*A,order_by=order_by,**kw)
+                assert keyL(res) == keyL(expected)
+                assert sorted(it['i'] for it in res) == sorted(it['i'] for it in expected)
+                
+                for limit,offset in [(1,None),(20,None),(5,7),(None,10),(0,None),(5000,None)]:
+                    res = DB.query(*A,order_by=order_by,limit=limit,offset=offset,**kw)
+                    exp = expected[offset or 0:]
+                    if limit is not None:
+                        exp = exp[:limit]
+                    assert keyL(res) == keyL(exp)
+                    assert keyL(DB.iquery(*A,order_by=order_by,limit=limit,offset=offset,**kw)) == keyL(exp)
+        
+        # With conditions
+        res = DB.query((Q.kind != 'b') & (Q.i < 500),order_by='-time',limit=10)
+        exp = brute(lambda it:it['kind'] != 'b' and it['i'] < 500,'time',True)[:10]
+        assert keyL(res) == keyL(exp)
+        
+        # Multiple keys break ties
+        res = DB.query(Q.i > 10,order_by=['account','-i'],limit=50)
+        assert res == sorted(res,key=lambda it:(it['account'],-it['i']))
+        exp = sorted((it for it in items if it['i'] > 10),key=lambda it:(it['account'],-it['i']))[:50]
+        assert res == exp
+        res = DB.query(order_by=['-time','i'],account=2,limit=30)
+        exp = brute(lambda it:it['account'] == 2,'time',True)
+        exp = sorted(exp,key=lambda it:(-max(_makelist(it['time']) or [-1e9]),it['i']))[:30]
+        assert res == exp
+        
+        with pytest.raises(KeyError):
+            DB.query(order_by='bad')
+        with pytest.raises(KeyError):
+            DB.query(bad=1,order_by='time')
+    
+    assert list_dict_DB().query(order_by='time') == []
+
+def test_count_exists():
+    items = [{'i':i,'mod':i%4,'flag':i%3==0,'tags':['a','b'] if i%5==0 else []} for i in range(1000)]
+    for kw in [{},{'bitmap_attributes':['mod','flag']},{'cacheSize':10}]:
+        DB = list_dict_DB(items,sorted_attributes=['i'],**kw)
+        Q = DB.Q()
+        for A,K in [([],{'mod':1}),
+                    ([],{'mod':1,'flag':True}),
+                    ([{'mod':2}],{'flag':False}),
+                    ([],{'tags':'a'}),
+                    ([],{'tags':[]}),
+                    ([],{'tags':['a','b']}),
+                    ([],{'mod':7}),
+                    ([],{'mod':[1,2]}),
+                    ([Q.i < 100],{'mod':1}),
+                    ([(Q.i < 100) | (Q.flag == True)],{}),
+                    ([~(Q.mod == 1)],{'flag':True}),
+                    ([Q.filter(lambda item:item['i'] == 7)],{}),
+                    ([],{}),
+                    ]:
+            n = len(DB.query(*A,**dict(K)))
+            assert DB.count(*A,**dict(K)) == n
+            assert DB.count(*A,**dict(K)) == n # Cached
+            assert DB.exists(*A,**dict(K)) == (n > 0)
+            assert DB.isin(*A,**dict(K)) == (n > 0)
+            if len(A) == 0 and len(K) > 0:
+                assert (K in DB) == (n > 0)
+        
+        with pytest.raises(KeyError):
+            DB.count(bad=1)
+        with pytest.raises(KeyError):
+            DB.exists(bad=1)
+    
+    # exists stops at the first match
+    checked = []
+    def filt(item):
+        checked.append(item['i'])
+        return True
+    assert DB.exists(Q.filter(filt),mod=3)
+    assert checked == [3]
+    
+    assert list_dict_DB().count(a=1) == 0
+    assert not list_dict_DB().exists(a=1)
+
+def test_value_counts_group_by():
+    from collections import Counter,defaultdict
+    items = [{'i':i,'mod':i%4,'flag':i%3==0,'tags':['a','b'] if i%5==0 else [],
+              'pair':[i//2,i//2+1,i//2]} for i in range(1000)]
+    
+    def brute(match,attrib):
+        counts = Counter()
+        groups = defaultdict(list)
+        for item in items:
+            if not match(item):
+                continue
+            values = set(item[attrib]) if isinstance(item[attrib],list) else [item[attrib]]
+            for value in values:
+                counts[value] += 1
+                groups[value].append(item['i'])
+        return dict(counts),dict(groups)
+    
+    for kw in [{},{'bitmap_attributes':['mod','flag']}]:
+        DB = list_dict_DB(items,**kw)
+        Q = DB.Q()
+        for A,K,match in [([],{},lambda item:True),
+                          ([Q.i < 10],{},lambda item:item['i'] < 10),
+                          ([],{'flag':True},lambda item:item['flag']),
+                          ([Q.mod != 1],{'flag':True},lambda item:item['flag'] and item['mod'] != 1),
+                          ([],{'mod':9},lambda item:False)]:
+            for attrib in ['mod','flag','tags','i','pair']:
+                counts,groups = brute(match,attrib)
+                assert DB.value_counts(attrib,*A,**dict(K)) == counts
+                res = DB.group_by(attrib,*A,**dict(K))
+                assert {k:sorted(item['i'] for item in v) for k,v in res.items()} == groups
+                res = DB.group_by(attrib,*A,agg=len,**dict(K))
+                assert res == counts
+        
+        with pytest.raises(KeyError):
+            DB.value_counts('bad')
+        
+        # The index is used, not the items
+        DB.update({'mod':100},{'i':5})
+        assert DB.value_counts('mod')[100] == 1
+    
+    with pytest.raises(KeyError):
+        list_dict_DB().value_counts('a')
+    assert list_dict_DB(attributes=['a']).value_counts('a') == {}
+
+def test_save_load():
+    import os,tempfile
+    from list_dict_DB import _Bitmap
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp,'DB.snapshot')
+    
+    items = [{'i':i,'mod':i%4,'flag':i%3==0,'tags':['a','b'] if i%5==0 else [],
+              'x':float(i)/3} for i in range(500)]
+    kw = dict(sorted_attributes=['i'],bitmap_attributes=['flag'],autoVacuum=0.9,
+              cacheSize=5)
+    try:
+        import numpy
+        kw['column_attributes'] = ['x']
+    except ImportError:
+        numpy = None
+    DB = list_dict_DB(items,**kw)
+    DB.remove(i=7)
+    DB.update({'mod':9},{'i':8})
+    
+    queries = [lambda Q:Q.mod == 1,
+               lambda Q:(Q.i > 480) | (Q.tags == []),
+               lambda Q:(Q.flag == True) & (Q.x < 10),
+               lambda Q:Q.mod == 9,
+               lambda Q:Q._index == 7]
+    
+    DB.query(mod=1) # Fill the cache
+    DB.save(path)
+    assert not os.path.exists(path + '.tmp')
+    
+    for mmap in [False,True]:
+        DB2 = list_dict_DB.load(path,mmap=mmap)
+        assert DB2.N == DB.N == 499
+        assert DB2.cache_info() == (0,0,5,0)
+        assert DB2.autoVacuum == 0.9
+        for query in queries:
+            assert DB2.query(query(DB2.Q())) == DB.query(query(DB.Q()))
+        assert DB2.value_counts('tags') == DB.value_counts('tags')
+        assert DB2._sorted == DB._sorted
+        assert isinstance(DB2._lookup['flag'][True],_Bitmap)
+        assert DB2.query(tags=[]) == DB.query(tags=[])
+        if numpy is not None:
+            assert numpy.allclose(DB2.column('x'),DB.column('x'))
+        
+        # Still works as a DB
+        DB2.add({'i':1000,'mod':1,'flag':True,'tags':[],'x':5.0})
+        DB2.update({'mod':2},{'i':1000})
+        DB2.remove(i=1)
+        DB2.vacuum()
+        assert DB2.query(i=1000) == [{'i':1000,'mod':2,'flag':True,'tags':[],'x':5.0}]
+        assert DB2.query((DB2.Q().i >= 998) & (DB2.Q().x < 6)) == \
+                [{'i':1000,'mod':2,'flag':True,'tags':[],'x':5.0}]
+        assert len(DB2) == 499
+        
+        # The original is unchanged
+        DB3 = list_dict_DB.load(path)
+        assert DB3.query(DB3.Q().i > 490) == DB.query(DB.Q().i > 490)
+    
+    # Empty
+    list_dict_DB().save(path)
+    DB = list_dict_DB.load(path)
+    assert len(DB) == 0 and DB.query(a=1) == []
+    DB.add({'a':1})
+    assert DB.query(a=1) == [{'a':1}]
+    
+    with open(path,'wb') as F:
+        F.write(b'not a snapshot')
+    with pytest.raises(ValueError):
+        list_dict_DB.load(path)
+
+def test_journal():
+    import os,tempfile
+    tmp = tempfile.mkdtemp()
+    snapshot = os.path.join(tmp,'DB.snapshot')
+    journal = os.path.join(tmp,'DB.journal')
+    
+    def same(DB1,DB2):
+        assert DB1.items() == DB2.items()
+        assert len(DB1._list) == len(DB2._list)
+        assert DB1.attributes == DB2.attributes
+        assert DB1._sorted == DB2._sorted
+        for attrib in DB1.attributes:
+            assert DB1.value_counts(attrib) == DB2.value_counts(attrib)
+        assert DB1.query(DB1.Q().i >= 0) == DB2.query(DB2.Q().i >= 0)
+    
+    items = [{'i':i,'mod':i%4} for i in range(20)]
+    DB = list_dict_DB(items,sorted_attributes=['i'],allowMultipleEdit=True,
+                      journalSync='always')
+    DB.save(snapshot)
+    DB.open_journal(journal)
+    with pytest.raises(ValueError):
+        DB.open_journal(journal)
+    
+    DB.add({'i':20,'mod':0})
+    DB.add_items([{'i':21,'mod':1},[{'i':22,'mod':2},({'i':23,'mod':3},)]])
+    DB.update({'mod':9,'new':'x'},{'mod':1})
+    DB.remove(mod=2)
+    DB.add_attribute('sq',lambda:[]) # Not picklable. The values are saved
+    DB.update({'sq':[1,2]},i=3)
+    DB.add_sorted_index('mod')
+    DB.add_bitmap_index('mod')
+    DB.autoVacuum = 0.1
+    DB.remove(mod=3) # vacuums
+    assert len(DB._list) == DB.N
+    DB.add({'i':100,'mod':0,'sq':[]})
+    
+    DB2 = list_dict_DB.load(snapshot)
+    DB2.open_journal(journal)
+    same(DB,DB2)
+    
+    # More changes are appended and replayed
+    DB2.close_journal()
+    DB.add({'i':101,'mod':1,'sq':[5]})
+    DB.close_journal()
+    size = os.path.getsize(journal)
+    DB.close_journal() # Does nothing
+    DB.query(i=101)
+    assert os.path.getsize(journal) == size
+    
+    DB2 = list_dict_DB.load(snapshot)
+    DB2.open_journal(journal)
+    DB2.close_journal()
+    same(DB,DB2)
+    
+    # A torn final record is dropped (and later records are still read)
+    size = os.path.getsize(journal)
+    with open(journal,'ab') as F:
+        F.write(b'\x40\x00\x00\x00\x01\x02partial')
+    DB2 = list_dict_DB.load(snapshot)
+    DB2.open_journal(journal)
+    assert os.path.getsize(journal) == size
+    same(DB,DB2)
+    DB2.add({'i':103,'mod':1,'sq':[]})
+    DB2.close_journal()
+    DB3 = list_dict_DB.load(snapshot)
+    DB3.open_journal(journal)
+    same(DB2,DB3)
+    
+    # Compaction
+    DB3.journalSync = 'batch'
+    DB3.update({'mod':5},i=103)
+    DB3.compact_journal(snapshot)
+    assert os.path.getsize(journal) == 0
+    DB3.remove(i=103)
+    DB3.journalSync = 'never'
+    DB3.add({'i':104,'mod':1,'sq':[]})
+    DB3.close_journal()
+    
+    DB4 = list_dict_DB.load(snapshot)
+    DB4.open_journal(journal)
+    same(DB3,DB4)
+    
+    # The old journal is skipped if compaction is interrupted
+    DB4.close_journal()
+    with open(journal,'rb') as F:
+        data = F.read()
+    DB4 = list_dict_DB.load(snapshot)
+    DB4.open_journal(journal)
+    DB4.compact_journal(snapshot)
+    DB4.close_journal()
+    with open(journal,'wb') as F:
+        F.write(data)
+    DB5 = list_dict_DB.load(snapshot)
+    DB5.open_journal(journal)
+    same(DB3,DB5)
+    DB5.close_journal()
+    
+    # From nothing
+    os.remove(journal)
+    DB = list_dict_DB()
+    DB.open_journal(journal)
+    DB.add([{'a':1,'b':[1,2]},{'a':2,'c':3}])
+    DB.update({'a':3},{'a':2})
+    DB.close_journal()
+    DB2 = list_dict_DB()
+    DB2.open_journal(journal)
+    assert DB2.items() == DB.items() == [{'a':1,'b':[1,2],'c':None},{'a':3,'b':None,'c':3}]
+    assert DB2.query(c=None) == [{'a':1,'b':[1,2],'c':None}]
+    DB2.close_journal()
+
+def test_from_jsonl_csv():
+    import os,io,json,tempfile
+    tmp = tempfile.mkdtemp()
+    
+    items = [{'i':i,'mod':i%4,'name':'n{0}'.format(i),'x':float(i)/2 if i%5 else None} 
+             for i in range(250)]
+    
+    path = os.path.join(tmp,'items.jsonl')
+    with io.open(path,'w',encoding='utf-8') as F:
+        for item in items:
+            F.write(json.dumps(dict(item,i=str(item['i']))) + '\n')
+        F.write('\n')
+    
+    path_csv = os.path.join(tmp,'items.csv')
+    with io.open(path_csv,'w',encoding='utf-8') as F:
+        F.write('i;mod;name;x\n')
+        for item in items:
+            x = '' if item['x'] is None else repr(item['x'])
+            F.write('{i};{mod};{name};{0}\n'.format(x,**item))
+    
+    done = []
+    DB = list_dict_DB.from_jsonl(path,converters={'i':int},chunksize=100,
+                                 progress=done.append,sorted_attributes=['i'])
+    assert done == [100,200,250]
+    assert DB.items() == items
+    assert DB.query(DB.Q().i >= 248) == items[248:]
+    
+    with io.open(path,encoding='utf-8') as F:
+        DB = list_dict_DB.from_jsonl(F)
+    assert DB.query(i='3') == [dict(items[3],i='3')]
+    
+    DB = list_dict_DB.from_csv(path_csv,delimiter=';',
+                               converters={'i':int,'mod':int,'x':float})
+    assert DB.items() == items
+    assert DB.query(x=None) == [item for item in items if item['x'] is None]
+    
+    DB = list_dict_DB.from_csv(path_csv,delimiter=';')
+    assert DB.query(i='3') == [{'i':'3','mod':'3','name':'n3','x':'1.5'}]
+    
+    with pytest.raises(ValueError):
+        list_dict_DB.from_csv(path_csv,delimiter=';',converters={'name':int})
+
+def test_threadsafe():
+    import threading
+    from list_dict_DB import _RWLock
+    
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) # Switch threads often
+    try:
+        DB = list_dict_DB([{'i':i,'a':i%10,'b':i%10} for i in range(500)],
+                          threadsafe=True,allowMultipleEdit=True,cacheSize=4,
+                          sorted_attributes=['a'])
+        errors = []
+        stop = threading.Event()
+        
+        def read():
+            try:
+                while not stop.is_set():
+                    v = len(errors) % 10
+                    items = DB.query(a=v)
+                    assert all(item['b'] == item['a'] == v for item in items)
+                    Q = DB.Q()
+                    assert DB.count((Q.a == v) & (Q.b != v)) == 0
+                    assert all(DB.group_by('a',agg=lambda items: all(item['a'] == item['b'] for item in items)).values())
+                    assert all(item['a'] == item['b'] for item in DB.iquery(Q.a >= 5))
+                    assert all(item['a'] == item['b'] for item in DB.query(Q.a >= 5,order_by='a',limit=5))
+                    for item in DB: # Per call iterator
+                        pass
+            except Exception as E:
+                errors.append(E)
+        
+        def write(w):
+            try:
+                for n in range(200):
+                    DB.update({'a':n%10,'b':n%10},i=n)
+                    DB.add({'i':1000*w+n,'a':n%10,'b':n%10})
+                    DB.remove(i=1000*w+n)
+                    if n % 50 == 0:
+                        DB.vacuum()
+            except Exception as E:
+                errors.append(E)
+        
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        writers = [threading.Thread(target=write,args=(w,)) for w in (1,2)]
+        for thread in threads + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(DB) == 500
+    finally:
+        sys.setswitchinterval(interval)
+    
+    # Iterating is per call
+    DB = list_dict_DB([{'i':i} for i in range(3)],threadsafe=True)
+    assert [item['i'] for item in DB] == [item['i'] for item in DB] == [0,1,2]
+    assert [item['i'] for item in DB.iquery(DB.Q().i > 0)] == [1,2]
+    
+    # Reentrant but not while reading
+    DB.add([{'i':3}]) # add --> add_items
+    with pytest.raises(RuntimeError):
+        DB.query(DB.Q().filter(lambda item: DB.add({'i':5})))
+    assert DB.query(DB.Q().filter(lambda item: DB.exists(i=item['i']+1))) == DB.query(DB.Q().i < 3)
+    DB.add({'i':4})
+    assert len(DB) == 5
+    
+    # Readers at the same time
+    lock = _RWLock()
+    both = threading.Barrier(2) if hasattr(threading,'Barrier') else None
+    if both is not None:
+        def read():
+            lock.acquire_read()
+            both.wait(timeout=5) # Fails unless both are reading
+            lock.release_read()
+        threads = [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not both.broken
+
+def test_async():
+    if sys.version_info < (3,5):
+        pytest.skip('asyncio front end requires Python 3.5+')
+    import asyncio,os,tempfile,time
+    from list_dict_DB_async import AsyncListDictDB
+    
+    def run(coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+    
+    items = [{'i':i,'mod':i%4,'tags':['a'] if i%3 else []} for i in range(1000)]
+    
+    async def main():
+        DB = list_dict_DB(items,sorted_attributes=['i'],allowMultipleEdit=True,
+                          composite_indexes=[('mod','i')])
+        ADB = AsyncListDictDB(DB,chunksize=64)
+        Q = ADB.Q()
+        
+        # Reads are synchronous
+        assert ADB.query(i=5) == [items[5]]
+        assert ADB.count(mod=1) == 250 and len(ADB) == 1000
+        assert {'i':5} in ADB
+        
+        await ADB.add({'i':1000,'mod':0,'tags':[]})
+        await ADB.add_items([{'i':1001+n,'mod':n%4,'tags':[]} for n in range(200)])
+        await ADB.update({'mod':9},i=3)
+        await ADB.remove(i=1000)
+        assert len(ADB) == 1200
+        
+        # Scans
+        Q = ADB.Q()
+        filt = lambda item: item['i'] % 7 == 0
+        key = lambda item: item['i']
+        for A,K in [((Q.filter(filt),),{}),((Q.filter(filt),),{'mod':1}),((Q.i > 1190,),{})]:
+            assert sorted(await ADB.scan(*A,**K),key=key) == sorted(DB.query(*A,**K),key=key)
+        assert await ADB.scan() == []
+        
+        DB.alwaysReturnList = False # A single match is still in a list
+        assert await ADB.scan(Q.filter(filt),i=7) == [DB.query(i=7)]
+        DB.alwaysReturnList = True
+        
+        # Reindex after changing items directly
+        for item in DB.items():
+            item['mod'] = -item['i']
+        assert ADB.query(mod=-10) == []
+        await ADB.reindex('mod')
+        assert ADB.query(mod=-10) == [DB[10]]
+        assert ADB.query(mod=-10,i=10) == [DB[10]] and ADB.query(mod=0,i=10) == []
+        await ADB.reindex()
+        assert DB._sorted['i'] == list(range(1000)) + list(range(1001,1201))
+        assert ADB.query(tags=[]) == DB.query(tags=[])
+        
+        await ADB.add_attribute('sq',lambda:0)
+        assert ADB.count(sq=0) == 1200
+        with pytest.raises(KeyError):
+            await ADB.add_attribute('missing')
+        
+        # Queries keep working (on the current lookups) while reindexing
+        seen = []
+        async def query():
+            for _ in range(20):
+                seen.append(len(ADB.query(mod=-10)))
+                await asyncio.sleep(0)
+        await asyncio.gather(ADB.reindex(),query())
+        assert seen == [1]*20
+        
+        # Including the composite indices
+        for item in DB.items():
+            item['mod'] = item['i'] % 4
+        seen = []
+        task = asyncio.ensure_future(ADB.reindex('mod'))
+        while not task.done():
+            seen.append((len(ADB.query(mod=-10)),len(ADB.query(mod=-10,i=10))))
+            await asyncio.sleep(0)
+        await task
+        assert set(seen) == {(1,1),(0,0)}
+        assert ADB.query(mod=2,i=10) == [DB[10]]
+        
+        ADBh = AsyncListDictDB(list_dict_DB([{'i':0},{'i':1}],composite_indexes=[('half','i')]))
+        await ADBh.add_attribute('half',0.5) # Completes the composite index
+        assert len(ADBh.DB._composite[('half','i')]) == 2
+        assert ADBh.query(half=0.5,i=1) == [{'i':1,'half':0.5}]
+        
+        # Snapshots and loaders
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp,'DB.snapshot')
+        await ADB.save(path)
+        ADB2 = await AsyncListDictDB.load(path)
+        assert ADB2.items() == ADB.items()
+        
+        # Expression indices: their names are not attributes and unsaved keys
+        # are given to load()
+        DBx = list_dict_DB([{'x':x} for x in range(5)])
+        DBx.add_index('dbl',lambda item: item['x']*2)
+        ADBx = AsyncListDictDB(DBx)
+        with pytest.raises(ValueError):
+            await ADBx.add_attribute('dbl',0)
+        assert ADBx.query(dbl=4) == [{'x':2}] and 'dbl' not in DBx.items()[0]
+        await ADBx.save(path)
+        with pytest.raises(ValueError):
+            await AsyncListDictDB.load(path)
+        ADBx = await AsyncListDictDB.load(path,keys={'dbl':lambda item: item['x']*2})
+        assert ADBx.query(dbl=4) == [{'x':2}]
+        
+        path = os.path.join(tmp,'items.jsonl')
+        with open(path,'w') as F:
+            F.write('{"a":1}\n{"a":2}\n')
+        done = []
+        ADB3 = await AsyncListDictDB.from_jsonl(path,chunksize=1,progress=done.append,
+                                                sorted_attributes=['a'])
+        assert ADB3.items() == [{'a':1},{'a':2}] and done == [1,2]
+        assert ADB3.query(ADB3.Q().a > 1) == [{'a':2}]
+        
+        path = os.path.join(tmp,'items.csv')
+        with open(path,'w') as F:
+            F.write('a,b\n1,x\n2,\n')
+        ADB3 = await AsyncListDictDB.from_csv(path,converters={'a':int})
+        assert ADB3.items() == [{'a':1,'b':'x'},{'a':2,'b':''}]
+    run(main())
+    
+    # The event loop is not blocked for long
+    async def latency():
+        ADB = AsyncListDictDB(list_dict_DB([{'i':i,'j':i%100} for i in range(100000)]),
+                              chunksize=1000)
+        gaps = []
+        done = []
+        async def tick():
+            last = time.time()
+            while not done:
+                await asyncio.sleep(0)
+                now = time.time()
+                gaps.append(now - last)
+                last = now
+        
+        ticker = asyncio.ensure_future(tick())
+        t0 = time.time()
+        await ADB.reindex()
+        duration = time.time() - t0
+        done.append(True)
+        await ticker
+        return max(gaps),duration
+    
+    gap,duration = run(latency())
+    assert gap < duration/5
+
+def _odd(item): # Filters sent to the shards must be picklable
+    return item['i'] % 2 == 1
+
+def test_shard():
+    from list_dict_DB_shard import ShardedListDictDB
+    
+    items = [{'acct':i % 20,'i':i,'tags':['a','b'][:i % 3]} for i in range(600)]
+    DB = list_dict_DB([dict(item) for item in items],sorted_attributes=['i'])
+    SDB = ShardedListDictDB([dict(item) for item in items],shard_key='acct',
+                            shards=3,sorted_attributes=['i'])
+    Q,QS = DB.Q(),SDB.Q()
+    key = lambda item: item['i']
+    
+    with SDB:
+        assert len(SDB) == 600
+        assert len(SDB.items()) == 600 and SDB.attributes == ['acct','i','tags']
+        
+        # Equality on the shard key goes to one shard
+        assert len(SDB._route((),{'acct':3})) == 1
+        assert len(SDB._route(((QS.acct == 3) & (QS.i > 4),),{})) == 1
+        assert len(SDB._route(({'acct':3},),{})) == 1
+        assert len(SDB._route(((QS.acct == 3) | (QS.i > 4),),{})) == 3
+        
+        for A,K,QA in [((),{'acct':3},()),
+                       (({'acct':3,'tags':'a'},),{},({'acct':3,'tags':'a'},)),
+                       ((QS.i.between(10,20) | (QS.acct == 7),),{},(Q.i.between(10,20) | (Q.acct == 7),)),
+                       ((~(QS.tags == 'a') & (QS.i < 100),),{},(~(Q.tags == 'a') & (Q.i < 100),)),
+                       ((QS.filter(_odd),),{'tags':[]},(Q.filter(_odd),))]:
+            KD = dict(K)
+            assert sorted(SDB.query(*A,**K),key=key) == sorted(DB.query(*QA,**KD),key=key)
+            assert SDB.count(*A,**K) == DB.count(*QA,**KD)
+            assert SDB.exists(*A,**K) == DB.exists(*QA,**KD)
+        
+        # Options apply to the combined results
+        assert SDB.query(QS.i > 100,order_by='-i',limit=5,offset=2) == \
+                DB.query(Q.i > 100,order_by='-i',limit=5,offset=2)
+        assert SDB.query(order_by=['tags','-i'],tags=[],limit=3) == \
+                DB.query(order_by=['tags','-i'],tags=[],limit=3)
+        assert len(SDB.query(QS.i >= 0,limit=7,offset=3)) == 7
+        
+        assert SDB.value_counts('acct') == DB.value_counts('acct')
+        assert SDB.value_counts('tags',QS.i < 50) == DB.value_counts('tags',Q.i < 50)
+        assert SDB.group_by('acct',agg=len) == DB.group_by('acct',agg=len)
+        assert {value:sorted(items,key=key) for value,items in SDB.group_by('tags').items()} \
+                == {value:sorted(items,key=key) for value,items in DB.group_by('tags').items()}
+        
+        # Filters must be picklable. The shards are still usable after
+        with pytest.raises(Exception):
+            SDB.query(QS.filter(lambda item: True))
+        assert {'acct':3,'i':3,'tags':[]} in SDB
+        
+        with pytest.raises(KeyError):
+            SDB.add({'i':1000})
+        with pytest.raises(ValueError):
+            SDB.add({'acct':[1],'i':1000})
+        with pytest.raises(KeyError): # Errors from the shards
+            SDB.add_attribute('missing')
+        
+        # Changes
+        SDB.add({'acct':3,'i':1000,'tags':[],'new':True})
+        assert SDB.query(i=1000) == [{'acct':3,'i':1000,'tags':[],'new':True}]
+        assert 'new' in SDB.attributes
+        
+        with pytest.raises(ValueError):
+            SDB.update({'tags':'x'},acct=5)
+        with pytest.raises(ValueError):
+            SDB.update({'tags':'x'},acct=100)
+        SDB.update({'tags':'x'},i=5)
+        assert SDB.query(tags='x') == [{'acct':5,'i':5,'tags':'x','new':None}]
+        class _Obj(object):
+            def __init__(self,**kwargs):
+                self.__dict__.update(kwargs)
+        with pytest.raises(TypeError):
+            SDB.update({'tags':'x'},5)
+        SDB.indexObjects = True # Objects query by their attributes
+        SDB.update({'tags':'y'},_Obj(i=5))
+        SDB.indexObjects = False
+        with pytest.raises(TypeError):
+            SDB.update({'tags':'x'},_Obj(i=5))
+        assert SDB.query(tags='y') == [{'acct':5,'i':5,'tags':'y','new':None}]
+        
+        SDB.allowMultipleEdit = True
+        SDB.update({'acct':99},QS.acct == 5) # Moves the items
+        assert SDB.count(acct=5) == 0 and SDB.count(acct=99) == 30
+        assert len(SDB._route((),{'acct':99})) == 1
+        
+        with pytest.raises(ValueError):
+            SDB.remove(acct=5)
+        SDB.remove(QS.i < 10)
+        assert len(SDB) == 591
+        
+        SDB.alwaysReturnList = False
+        assert SDB.query(i=11)['i'] == 11
+        
+        SDB.add_sorted_index('acct')
+        SDB.vacuum()
+        SDB.reindex()
+        assert sorted(SDB.query(QS.acct > 98),key=key) == SDB.query(acct=99,order_by='i')
+    
+    with pytest.raises(ValueError):
+        SDB.query(acct=3)
+
+def test_shard_update_error():
+    pytest.importorskip('numpy')
+    from list_dict_DB_shard import ShardedListDictDB
+    
+    items = [{'acct':i % 5,'i':i,'price':float(i)} for i in range(20)]
+    with ShardedListDictDB(items,shard_key='acct',shards=3,
+                           column_attributes=['price']) as SDB:
+        # The item is not lost if it can not be added to its new shard
+        with pytest.raises(TypeError):
+            SDB.update({'acct':9,'price':'free'},i=3)
+        assert SDB.query(i=3) == [{'acct':3,'i':3,'price':3.0}]
+        assert SDB.query(acct=9) == [] and len(SDB) == 20
+        
+        SDB.allowMultipleEdit = True
+        with pytest.raises(TypeError):
+            SDB.update({'acct':9,'price':'free'},SDB.Q().i < 8)
+        assert sorted(item['i'] for item in SDB.query(SDB.Q().i < 8)) == list(range(8))
+        assert SDB.query(acct=9) == [] and len(SDB) == 20
+        
+        SDB.update({'acct':9},SDB.Q().i < 8)
+        assert SDB.count(acct=9) == 8 and len(SDB) == 20
+
+def test_parallel_index():
+    np = pytest.importorskip('numpy')
+    items = [{'i':i,'mod':i % 7,'tags':['a','b','c'][:i % 4],'flag':i % 2 == 0,
+              'x':float(i)} for i in range(12000)]
+    kwargs = dict(sorted_attributes=['mod'],bitmap_attributes=['flag'],
+                  column_attributes=['x'],allowMultipleEdit=True)
+    DB = list_dict_DB([dict(item) for item in items],indexProcesses=3,**kwargs)
+    DB0 = list_dict_DB([dict(item) for item in items],**kwargs)
+    
+    def lookup(D,attr): # Including the order
+        return {('[]' if val is D._empty else val):list(ixs) \
+                    for val,ixs in D._lookup[attr].items() if len(ixs) > 0}
+    
+    def same():
+        for attr in DB0.attributes:
+            assert lookup(DB,attr) == lookup(DB0,attr)
+        assert DB._sorted == DB0._sorted
+        assert np.array_equal(DB.column('x'),DB0.column('x'))
+    
+    for D in (DB,DB0):
+        D.remove(D.Q().i < 100)
+        for item in D.items():
+            item['mod'] = item['i'] % 5
+            item['x'] = -item['x']
+    
+    DB.reindex() # More processes than attributes
+    DB0.reindex()
+    same()
+    assert isinstance(DB._lookup['flag'][True],list_dict_DB_module._Bitmap)
+    
+    DB.indexProcesses = 2
+    DB.reindex('mod','i')
+    same()
+    
+    for D in (DB,DB0):
+        for item in D.items():
+            if item['i'] % 3 == 0:
+                item['new'] = [item['i']]
+        D.add_attribute('new',list)
+    same()
+    assert DB.query(new=[]) == DB0.query(new=[])
+    assert DB.count(new=300) == 1
+    
+    with pytest.raises(KeyError):
+        DB.add_attribute('missing')
+
+def test_composite_index():
+    import os,tempfile
+    items = [{'tenant':i % 3,'sku':i % 10,'tags':['a','b'][:i % 3],'i':i} for i in range(300)]
+    DB = list_dict_DB([dict(item) for item in items],composite_indexes=[('tenant','sku')],
+                      allowMultipleEdit=True)
+    DB0 = list_dict_DB([dict(item) for item in items],allowMultipleEdit=True)
+    
+    def same(*A,**K):
+        assert DB.query(*A,**K) == DB0.query(*A,**K)
+        assert DB.count(*A,**K) == DB0.count(*A,**K)
+    
+    def check():
+        key = lambda item: item['i']
+        for tenant in range(4):
+            for sku in range(11):
+                assert sorted(DB.query(tenant=tenant,sku=sku),key=key) == \
+                       sorted(DB0.query(tenant=tenant,sku=sku),key=key)
+                assert DB.count(tenant=tenant,sku=sku) == DB0.count(tenant=tenant,sku=sku)
+        for (tenant,sku),ixs in DB._composite[('tenant','sku')].items():
+            assert len(ixs) > 0
+            assert all(DB[ix]['tenant'] == tenant and DB[ix]['sku'] == sku for ix in ixs)
+    
+    check()
+    assert DB._composite[('tenant','sku')][(1,1)] == {1:None,31:None,61:None,91:None,
+                                                      121:None,151:None,181:None,211:None,
+                                                      241:None,271:None}
+    
+    # Used for keywords, dicts and Qobjs (together)
+    Q = DB.Q()
+    assert DB._eq_postings({'tenant':[1],'sku':[1]}) == [DB._composite[('tenant','sku')][(1,1)]]
+    assert len(DB._split([(Q.tenant == 1) & (Q.sku == 1)])[0]) == 1
+    same({'tenant':1},sku=1)
+    same({'tenant':1,'sku':1,'i':31})
+    same(tenant=1,sku=[1,2]) # No match
+    assert sorted(item['i'] for item in DB.query((Q.tenant == 2) & (Q.sku == 2) & (Q.i < 100))) \
+            == [2,32,62,92]
+    
+    # List values
+    DB.add_composite_index('tags','sku')
+    DB0 = list_dict_DB(DB.items())
+    for A,K in [((),{'tags':'a','sku':1}),((),{'tags':['a','b'],'sku':2}),((),{'tags':[],'sku':0}),
+                (({'tags':[]},),{'sku':3}),(({'tags':'b'},{'tags':'a'}),{'sku':5})]:
+        assert DB.query(*A,**K) == DB0.query(*A,**K)
+    Q = DB.Q()
+    assert DB.query((Q.tags == []) & (Q.sku == 3)) == DB0.query(tags=[],sku=3)
+    
+    # Changes
+    DB0 = list_dict_DB([dict(item) for item in items],allowMultipleEdit=True)
+    for D in (DB,DB0):
+        D.update({'sku':10},tenant=1,sku=1)
+        D.update({'tags':['c']},i=5)
+        D.remove(tenant=2,sku=2)
+        D.add({'tenant':3,'sku':3,'tags':[],'i':300})
+        D.add_items([{'tenant':0,'sku':10,'tags':'x','i':301 + n} for n in range(3)])
+    check()
+    assert DB.count(tenant=1,sku=1) == 0 and DB.count(tenant=1,sku=10) == 10
+    
+    for D in (DB,DB0):
+        for item in D.items():
+            item['sku'] = item['i'] % 4
+        D.reindex('sku')
+    check()
+    
+    DB.vacuum()
+    DB0.vacuum()
+    check()
+    
+    # Snapshots and journals
+    tmp = tempfile.mkdtemp()
+    DB.save(os.path.join(tmp,'DB.snapshot'))
+    DB2 = list_dict_DB.load(os.path.join(tmp,'DB.snapshot'))
+    assert DB2.query(tags=[],sku=0) == DB.query(tags=[],sku=0)
+    
+    DB2.open_journal(os.path.join(tmp,'DB.journal'))
+    DB2.add_composite_index('i','tenant')
+    DB2.update({'tenant':7},i=20)
+    DB2.close_journal()
+    DB3 = list_dict_DB.load(os.path.join(tmp,'DB.snapshot'))
+    DB3.open_journal(os.path.join(tmp,'DB.journal'))
+    assert DB3._composite[('i','tenant')] == DB2._composite[('i','tenant')]
+    assert DB3.query(i=20,tenant=7) == DB2.query(i=20,tenant=7) != []
+    DB3.close_journal()
+    
+    # Attributes that are not (yet) there
+    DB = list_dict_DB(composite_indexes=[('a','b')])
+    DB.add({'a':1,'c':1})
+    assert DB._composites() == []
+    DB.add_attribute('b',2)
+    assert DB.query(a=1,b=2) == [{'a':1,'b':2,'c':1}]
+    assert dict(DB._composite[('a','b')]) == {(1,2):{0:None}}
+    
+    with pytest.raises(ValueError):
+        DB.add_composite_index('a')
+    with pytest.raises(ValueError):
+        DB.add_composite_index('a','a')
+    with pytest.raises(KeyError):
+        DB.add_composite_index('a','d')
+
+def test_startswith():
+    paths = ['/usr/bin','/usr/lib','/usr','/var/log','/u','/usr\U0010ffff/x','/usr\U0010ffff',
+             '/usr\U0010ffffz','/v','/empty']
+    items = [{'path':path,'n':i,'alt':[path,'/alt' + path] if i % 2 else path} \
+                for i,path in enumerate(paths)]
+    items[-1]['alt'] = []
+    DB = list_dict_DB(items,sorted_attributes=['path','alt'])
+    DB0 = list_dict_DB(items) # No sorted index
+    Q,Q0 = DB.Q(),DB0.Q()
+    
+    def paths_of(D,Q,attr,prefix,**K):
+        return sorted(item['path'] for item in D.query(getattr(Q,attr).startswith(prefix),**K))
+    
+    for prefix in ['/usr','/usr/','/u','','/usr\U0010ffff','/x','/var/log']:
+        expected = sorted(p for p in paths if p.startswith(prefix))
+        assert paths_of(DB,Q,'path',prefix) == paths_of(DB0,Q0,'path',prefix) == expected
+        assert DB.count(Q.path.startswith(prefix)) == len(expected)
+        expected = sorted(set(p for p,n in zip(paths,range(len(paths))) \
+                              if p != '/empty' and (p.startswith(prefix) or \
+                                    n % 2 and ('/alt' + p).startswith(prefix))))
+        assert paths_of(DB,Q,'alt',prefix) == paths_of(DB0,Q0,'alt',prefix) == expected
+    
+    # Combined and ordered
+    assert paths_of(DB,Q,'path','/usr',n=1) == ['/usr/lib']
+    assert [item['path'] for item in DB.query(Q.path.startswith('/usr'),order_by='-path',limit=3)] \
+            == ['/usr\U0010ffffz','/usr\U0010ffff/x','/usr\U0010ffff']
+    assert [item['path'] for item in DB.query(~Q.path.startswith('/usr') & (Q.n >= 0),order_by='path')] \
+            == ['/empty','/u','/v','/var/log']
+    
+    # Walking only the range of a list attribute must still order by the 
+    # smallest element
+    for order_by in ['alt','-alt']:
+        for limit in [1,3,None]:
+            A = (Q.alt.startswith('/alt'),)
+            assert DB.query(*A,order_by=order_by,limit=limit) == \
+                   DB0.query(Q0.alt.startswith('/alt'),order_by=order_by,limit=limit)
+    assert DB._walk_sorted([('path',False)],(Q.path.startswith('/usr/'),),{}) == [0,1]
+    
+    # Including when enough matches are found before reaching a list value
+    for sorted_attributes in [['l'],[]]:
+        DBl = list_dict_DB([{'l':[1,5]},{'l':4},{'l':2}],sorted_attributes=sorted_attributes)
+        Ql = DBl.Q()
+        assert DBl.query(Ql.l.between(1,4),order_by='-l',limit=1) == [{'l':[1,5]}]
+        assert DBl.query(Ql.l.between(1,4),order_by='l',limit=2) == [{'l':[1,5]},{'l':2}]
+        assert DBl.query(Ql.l >= 4,order_by='l',limit=1) == [{'l':[1,5]}]
+    DBl.remove(l=[1,5])
+    assert not DBl._multivalued('l')
+    
+    # Not for numbers or with columns
+    DB = list_dict_DB([{'x':1.0,'s':'a'},{'x':2.0,'s':'b'}],column_attributes=['x'] \
+                      if list_dict_DB_module.np is not None else None)
+    assert DB.query(DB.Q().x.startswith('1')) == []
+    assert DB.query(DB.Q().s.startswith('a')) == [{'x':1.0,'s':'a'}]
+    
+    DB = list_dict_DB([{'startswith':'a'}])
+    assert DB.query(DB.Q().startswith == 'a') == [{'startswith':'a'}]
+
+def test_trigram_index():
+    messages = ['GET /api/v1/users 200','GET /api/v2/users 404','POST /api/v1/login 200',
+                'user 42 logged in','user 7 logged out','timed out','ok','',
+                'GET /api/v1/users 200'] # repeated
+    items = [{'msg':msg,'n':i,'tags':[msg,'tag%d' % i] if i % 3 == 0 else msg} \
+                for i,msg in enumerate(messages)]
+    items.append({'msg':5,'n':len(items),'tags':[]}) # Not a string
+    DB = list_dict_DB(items,trigram_attributes=['msg','tags'])
+    DB0 = list_dict_DB(items) # No index
+    Q,Q0 = DB.Q(),DB0.Q()
+    
+    def ns(D,Q,attr,op,arg,**K):
+        return sorted(item['n'] for item in D.query(getattr(getattr(Q,attr),op)(arg),**K))
+    
+    texts = ['/api/v1/','users','user','us','','logged','x','200','GET /api/v1/users 200','timed out ']
+    regexes = [r'/api/v\d+/users',r'^GET .* 200$',r'user \d+ logged (in|out)',r'us(er)?s',
+               r'log+ed',r'logged|timed',r'(?i)GET',r'[Pp]OST /api',r'\buser\b',r'v1\/lo',
+               r'users{0}',r'z*timed',r'ok$',r'\x75ser',re.compile('get',re.IGNORECASE)]
+    for attr in ['msg','tags']:
+        for text in texts:
+            expected = sorted(item['n'] for item in items if any(isinstance(v,str) and text in v \
+                                            for v in (item[attr] if isinstance(item[attr],list) else [item[attr]])))
+            assert ns(DB,Q,attr,'contains',text) == ns(DB0,Q0,attr,'contains',text) == expected,text
+            assert DB.count(getattr(Q,attr).contains(text)) == len(expected)
+        for regex in regexes:
+            compiled = re.compile(regex)
+            expected = sorted(item['n'] for item in items if any(isinstance(v,str) and compiled.search(v) \
+                                            for v in (item[attr] if isinstance(item[attr],list) else [item[attr]])))
+            assert ns(DB,Q,attr,'matches',regex) == ns(DB0,Q0,attr,'matches',regex) == expected,regex
+    
+    # Literals required by regexes
+    lits = list_dict_DB_module._regex_literals
+    assert lits(r'/api/v\d+/users') == ['/api/v','/users']
+    assert lits(r'ab*c?d+e{2}f') == ['a','d','f']
+    assert lits(r'a(bcd)?e[xyz]f\.g') == ['a','e','f.g']
+    assert lits(r'a|b') == lits(r'(?i)abc') == lits(re.compile('abc',re.I)) == []
+    assert lits(r'x\x41yz\1w') == ['x','yz','w']
+    assert lits(r'ab{2,}c{,3}de{}f') == ['a','d','f']
+    assert lits(r'abcd{x|zzz}') == lits(r'ab{') == lits(r'a{,x}b') == [] # Literal '{'
+    D = list_dict_DB([{'s':'hello zzz}'},{'s':'abcd{x'},{'s':'abcdx'}],trigram_attributes=['s'])
+    assert D.query(D.Q().s.matches('abcd{x|zzz}')) == [{'s':'hello zzz}'},{'s':'abcd{x'}]
+    
+    # Maintained by changes
+    DB.add({'msg':'connection timed out','n':100,'tags':'t'})
+    DB.update({'n':1000},msg='user 42 logged in') # Not the indexed attribute
+    DB.update({'msg':'retrying'},msg='timed out')
+    DB.remove(n=4)
+    Q = DB.Q()
+    assert ns(DB,Q,'msg','contains','timed out') == [100]
+    assert ns(DB,Q,'msg','contains','retry') == [5]
+    assert ns(DB,Q,'msg','contains','logged') == [1000]
+    assert 'user 7 logged out' not in DB._trigrams['msg']['ged']
+    assert 'timed out' not in DB._trigrams['msg']['tim']
+    assert ns(DB,Q,'msg','matches',r'^GET') == [0,1,8]
+    
+    # Combined and ordered
+    assert ns(DB,Q,'msg','contains','/api/',n=8) == [8]
+    assert [item['n'] for item in DB.query(Q.msg.contains('api') & (Q.n > 0),order_by='-n',limit=2)] \
+            == [8,2]
+    assert [item['n'] for item in DB.query(~Q.msg.contains('api') & Q.msg.matches('o'),order_by='n')] \
+            == [6,100,1000]
+    
+    # Rebuilt
+    DB.reindex()
+    DB.vacuum()
+    Q = DB.Q()
+    assert sorted(item['msg'] for item in DB.query(Q.msg.contains('out'))) == ['connection timed out']
+    DB2 = list_dict_DB(items)
+    DB2.add_trigram_index('msg')
+    assert DB2._trigrams['msg'] == DB0.__class__(items,trigram_attributes=['msg'])._trigrams['msg']
+    
+    DB = list_dict_DB([{'contains':'a','matches':'b'}])
+    assert DB.query(DB.Q().contains == 'a') == [{'contains':'a','matches':'b'}]
+    assert DB.query(DB.Q().matches == 'b') == [{'contains':'a','matches':'b'}]
+
+def _day(item):
+    return item['t'] // 10
+
+def test_expression_index():
+    import os,tempfile
+    from collections import defaultdict
+    items = [{'email':e,'t':t,'tags':tags} for e,t,tags in \
+                [('Paul@X.com',5,['a']),('paul@x.com',12,[]),('John@Y.com',25,['a','b']),
+                 ('george@z.com',31,['b']),('RINGO@Z.com',38,['c'])]]
+    email_lc = lambda item: item['email'].lower()
+    domain = lambda item: item['email'].split('@')[1].lower()
+    ntags = lambda item: [len(item['tags'])] + item['tags'] # List values are expanded
+    DB = list_dict_DB(items,expression_indexes={'email_lc':email_lc,'day':_day},
+                      sorted_attributes=['day'])
+    DB.add_index('domain',key=domain)
+    DB.add_index('ntags',key=ntags)
+    DB0 = list_dict_DB([dict(item) for item in items]) # Filters only
+    Q = DB.Q()
+    
+    def check():
+        Q,Q0 = DB.Q(),DB0.Q()
+        for name,key in [('email_lc',email_lc),('day',_day),('domain',domain),('ntags',ntags)]:
+            expected = defaultdict(set)
+            for item in DB0.items():
+                for val in (key(item) if isinstance(key(item),list) else [key(item)]):
+                    expected[val].add(item['t'])
+            lookup = {val:set(DB._list[ix]['t'] for ix in ixs) for val,ixs in DB._lookup[name].items()}
+            assert lookup == expected,name
+            for val in expected:
+                assert sorted(item['t'] for item in DB.query(**{name:val})) == sorted(expected[val])
+                assert sorted(item['t'] for item in DB.query(getattr(Q,name) == val)) == \
+                       sorted(item['t'] for item in DB0.query(Q0.filter(lambda item: val in _list(key(item)))))
+        assert DB._sorted['day'] == sorted(set(_day(item) for item in DB0.items()))
+        assert len(DB._list) - len(DB0._list) == len(DB) - len(DB0) == 0
+    _list = lambda value: value if isinstance(value,list) else [value]
+    check()
+    
+    assert [item['t'] for item in DB.query(email_lc='paul@x.com')] == [5,12]
+    assert DB.count(domain='z.com') == 2
+    assert [item['t'] for item in DB.query(Q.day >= 2)] == [25,31,38]
+    assert [item['t'] for item in DB.query(Q.day.between(1,2) & (Q.ntags == 'a'))] == [25]
+    assert [item['t'] for item in DB.query(Q.domain != 'z.com',order_by='-email_lc')] == [5,12,25]
+    assert [item['t'] for item in DB.query(domain='z.com',order_by=['day','-t'],limit=1)] == [38]
+    assert DB.value_counts('domain') == {'x.com':2,'y.com':1,'z.com':2}
+    assert DB.value_counts('ntags',Q.day < 3) == {0:1,1:1,2:1,'a':2,'b':1}
+    assert 'email_lc' not in DB.items()[0] # Items are not changed
+    
+    # Scans of expressions without other indices
+    assert [item['t'] for item in DB.query(Q.email_lc.startswith('p'))] == [5,12]
+    assert [item['t'] for item in DB.query(Q.email_lc > 'p')] == [5,12,38]
+    
+    # Maintained by changes
+    for D in (DB,DB0):
+        D.add({'email':'Yoko@Y.com','t':41,'tags':['a']})
+        D.add([{'email':'Pete@Y.com','t':55,'tags':[]},{'email':'stu@x.com','t':61,'tags':['d']}])
+        D.update({'email':'PAUL@x.com'},t=5)
+        D.update({'t':3},t=25)
+        D.remove(t=31)
+    check()
+    assert [item['t'] for item in DB.query(email_lc='paul@x.com')] == [5,12]
+    DB.allowMultipleEdit = DB0.allowMultipleEdit = True
+    DB.update({'email':'x@q.com'},domain='y.com')
+    DB0.update({'email':'x@q.com'},DB0.Q().filter(lambda item: domain(item) == 'y.com'))
+    check()
+    
+    # A key that raises leaves the DB as it was
+    bad = {'email':None,'t':70,'tags':[]}
+    for change in [lambda: DB.add(bad),lambda: DB.add_items([bad]),
+                   lambda: DB.update({'email':None},t=61)]:
+        with pytest.raises(AttributeError):
+            change()
+        check()
+    with pytest.raises(ValueError):
+        DB.add_index('t',key=_day) # An attribute
+    with pytest.raises(ValueError):
+        DB.add({'email':'a@b.c','t':1,'tags':[],'day':1}) # Or the other way
+    assert DB.count(t=1) == 0
+    check()
+    
+    DB.reindex()
+    DB.vacuum()
+    DB0.vacuum()
+    check()
+    DB.reindex('day')
+    check()
+    
+    # Snapshots and journals. Lambdas are given to load()
+    tmp = tempfile.mkdtemp()
+    DB.save(os.path.join(tmp,'DB.snapshot'))
+    with pytest.raises(ValueError):
+        list_dict_DB.load(os.path.join(tmp,'DB.snapshot'))
+    DB2 = list_dict_DB.load(os.path.join(tmp,'DB.snapshot'),
+                            keys={'email_lc':email_lc,'domain':domain,'ntags':ntags})
+    assert DB2._expressions['day'] is _day
+    DB2.open_journal(os.path.join(tmp,'DB.journal'))
+    with pytest.raises(ValueError):
+        DB2.add_index('email_domain',key=lambda item: item['email'])
+    DB2.add_index('day2',key=_day)
+    DB2.add({'email':'new@x.com','t':80,'tags':[]})
+    DB2.close_journal()
+    DB3 = list_dict_DB.load(os.path.join(tmp,'DB.snapshot'),
+                            keys={'email_lc':email_lc,'domain':domain,'ntags':ntags})
+    DB3.open_journal(os.path.join(tmp,'DB.journal'))
+    assert DB3.query(day2=8) == DB2.query(day2=8) == [{'email':'new@x.com','t':80,'tags':[]}]
+    assert DB3.query(email_lc='new@x.com') != []
+    DB3.close_journal()
+    
+    # Before any items
+    DB = list_dict_DB(expression_indexes={'day':_day})
+    DB.add({'t':15})
+    assert DB.query(day=1) == [{'t':15}]
+
+def test_unique_index():
+    items = [{'id':i,'email':'User%d@X.com' % i,'alias':['a%d' % i] if i % 2 else None} \
+                for i in range(10)]
+    DB = list_dict_DB(items,unique_attributes=['id','alias'],
+                      expression_indexes={'email_lc':lambda item: item['email'].lower()})
+    DB.add_unique_index('email_lc')
+    
+    def check():
+        for attrib,unique in DB._unique.items():
+            expected = {}
+            for ix,item in enumerate(DB._list):
+                if item is None: continue
+                value = DB._value(item,attrib)
+                for val in (value if isinstance(value,list) else [value]):
+                    if val is not None:
+                        assert val not in expected
+                        expected[val] = ix
+            assert unique == expected,attrib
+    check()
+    
+    assert DB.get(id=3) is items[3]
+    assert DB.get(email_lc='user4@x.com') is items[4]
+    assert DB.get(alias='a5') is items[5]
+    with pytest.raises(KeyError):
+        DB.get(id=30)
+    assert DB.get(id=30,default=None) is None
+    assert DB.get(id=3,default=None) is items[3]
+    assert DB.get({'id':3,'email':'User3@X.com'}) is items[3] # Any query
+    assert DB.get(DB.Q().id > 8) is items[9]
+    with pytest.raises(ValueError):
+        DB.get(DB.Q().id > 7)
+    with pytest.raises(ValueError):
+        DB.get(alias=None) # Not unique
+    
+    # Duplicates are rejected before anything changes (but add_items() keeps
+    # the items before the duplicate)
+    N = len(DB)
+    for change in [lambda: DB.add({'id':3,'email':'new@x.com','alias':None}),
+                   lambda: DB.add({'id':30,'email':'USER3@x.com','alias':None}),
+                   lambda: DB.add({'id':30,'email':'new@x.com','alias':['b','a1']}),
+                   lambda: DB.add_items([{'id':30,'email':'new@x.com','alias':None},
+                                         {'id':30,'email':'new2@x.com','alias':None}]),
+                   lambda: DB.update({'id':4},id=3),
+                   lambda: DB.update({'email':'user4@X.COM'},id=3),
+                   lambda: DB.update({'alias':['a1']},id=2)]:
+        with pytest.raises(ValueError):
+            change()
+        check()
+    assert len(DB) == N + 1 and DB.get(id=30)['email'] == 'new@x.com' # The first of add_items
+    
+    # Including new attributes of the item
+    for kwargs in [{},{'sorted_attributes':['new'],'composite_indexes':[('id','new')]}]:
+        D = list_dict_DB([{'id':1},{'id':2}],unique_attributes=['id'],default_attribute=0,**kwargs)
+        with pytest.raises(ValueError):
+            D.add({'id':1,'new':5})
+        assert D.attributes == ['id'] and D.items() == [{'id':1},{'id':2}]
+        D.add({'id':3,'new':5})
+        assert D.query(new=5) == [{'id':3,'new':5}] and D.query(new=0,id=1) == [{'id':1,'new':0}]
+        assert D.query(D.Q().new > 1) == [{'id':3,'new':5}]
+    
+    # Values may move between items in one update
+    DB.allowMultipleEdit = True
+    DB.update({'alias':None},DB.Q().id < 4)
+    DB.update({'alias':['a1']},id=2)
+    check()
+    assert DB.get(alias='a1') is items[2]
+    DB.update({'id':50},id=30)
+    DB.update({'id':3},DB.Q().id == 3) # Same item
+    check()
+    with pytest.raises(ValueError):
+        DB.update({'id':60},DB.Q().id < 2) # Both would be 60
+    
+    DB.remove(id=3)
+    DB.add({'id':3,'email':'User3@X.com','alias':None})
+    assert DB.get(id=3)['alias'] is None
+    DB.vacuum()
+    check()
+    DB.reindex()
+    check()
+    assert DB.get(email_lc='user3@x.com') is DB.get(id=3)
+    
+    # Existing duplicates
+    DB.add({'id':100,'email':'a@b.c','alias':None,'n':1})
+    DB.add({'id':101,'email':'b@b.c','alias':None,'n':1})
+    with pytest.raises(ValueError):
+        DB.add_unique_index('n')
+    assert 'n' not in DB._unique
+    
+    # Reindexing changes nothing if the values are no longer unique
+    items = [{'id':i,'n':i} for i in range(5)]
+    DB = list_dict_DB(items,unique_attributes=['id'],sorted_attributes=['id'])
+    items[1]['id'] = 1 # Changed directly
+    items[2]['id'] = 1
+    with pytest.raises(ValueError):
+        DB.reindex()
+    assert DB.get(id=2) is DB.query(id=2)[0] is items[2]
+    assert DB.query(DB.Q().id.between(1,2),order_by='id') == [items[1],items[2]]
+    items[2]['id'] = 2
+    DB.reindex()
+    assert DB.get(id=1) is items[1] and DB.get(id=2) is items[2]
+    
+    # Before items and through journals/snapshots
+    import os,tempfile
+    tmp = tempfile.mkdtemp()
+    DB = list_dict_DB(unique_attributes=['id'])
+    DB.open_journal(os.path.join(tmp,'DB.journal'))
+    DB.add([{'id':1},{'id':2}])
+    DB.add_unique_index('x')
+    DB.add_attribute('x',None)
+    DB.update({'x':'a'},id=1)
+    DB.close_journal()
+    DB2 = list_dict_DB(unique_attributes=['id']) # Options are not journaled
+    DB2.open_journal(os.path.join(tmp,'DB.journal'))
+    assert DB2._unique == DB._unique == {'id':{1:0,2:1},'x':{'a':0}}
+    with pytest.raises(ValueError):
+        DB2.update({'x':'a'},id=2)
+    DB2.save(os.path.join(tmp,'DB.snapshot'))
+    DB3 = list_dict_DB.load(os.path.join(tmp,'DB.snapshot'))
+    assert DB3.get(x='a') == {'id':1,'x':'a'}
+    DB2.close_journal()
 
 if __name__ == '__main__':
     test_add_attribute()
@@ -796,4 +2600,29 @@ if __name__ == '__main__':
     test_queries()
     test_reindex_update()
     test_removal()
-
+    test_sorted_index()
+    test_add_items()
+    test_bulk_update_remove()
+    test_vacuum()
+    test_query_planner()
+    test_query_cache()
+    test_lazy_Qobj()
+    test_bitmap_index()
+    test_column_index()
+    test_iquery_limit_offset()
+    test_order_by()
+    test_count_exists()
+    test_value_counts_group_by()
+    test_save_load()
+    test_journal()
+    test_from_jsonl_csv()
+    test_threadsafe()
+    test_async()
+    test_shard()
+    test_shard_update_error()
+    test_parallel_index()
+    test_composite_index()
+    test_startswith()
+    test_trigram_index()
+    test_expression_index()
+    test_unique_index()